@@ -1,26 +1,137 @@
+from collections import Counter
+
+from django.conf import settings
 from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.forms.models import BaseInlineFormSet
+from django.http import QueryDict
+from django.urls import reverse
+from django.utils.html import format_html
 
 from django_object_actions import DjangoObjectActions
 
-from api.models import Item, Transaction
+from api import batch, shards, state_machine, stats
+from api.models import ArchivedItem, ArchivedTransaction, Event, Item, Transaction, TransitionConflict
+from api.paginators import EstimatedCountPaginator
+from api.state_machine import InvalidTransition
+
+
+class ShardFilter(admin.SimpleListFilter):
+    """
+    Picks the shard a changelist reads, the default database unless set.
+    Only shown with more than one shard.
+    """
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        if len(settings.DATABASE_SHARDS) < 2:
+            return []
+        return [(alias, alias) for alias in settings.DATABASE_SHARDS]
+
+    def queryset(self, request, queryset):
+        if self.value() in settings.DATABASE_SHARDS:
+            return queryset.using(self.value())
+        return queryset
+
+
+class ShardedModelAdmin(admin.ModelAdmin):
+    """
+    Finds the objects of change, history and delete pages on their shard,
+    the one of the changelist they were opened from, or else the first
+    shard holding them.
+    """
+
+    def get_object_shards(self, request, object_id):
+        filters = QueryDict(request.GET.get('_changelist_filters', ''))
+        if filters.get(ShardFilter.parameter_name) in settings.DATABASE_SHARDS:
+            return [filters[ShardFilter.parameter_name]]
+        return settings.DATABASE_SHARDS
+
+    def get_object(self, request, object_id, from_field=None):
+        queryset = self.get_queryset(request)
+        opts = queryset.model._meta
+        field = opts.pk if from_field is None else opts.get_field(from_field)
+        try:
+            object_id = field.to_python(object_id)
+        except (ValidationError, ValueError):
+            return None
+        for using in self.get_object_shards(request, object_id):
+            obj = queryset.using(using).filter(**{field.name: object_id}).first()
+            if obj is not None:
+                return obj
+        return None
+
+
+class RecentTransactionFormSet(BaseInlineFormSet):
+    """
+    Limits the inline to the item's most recent transactions, read from the
+    item's shard.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not queryset.query.is_sliced:
+            if self.instance._state.db:
+                queryset = queryset.using(self.instance._state.db)
+            queryset = self._queryset = queryset[:settings.ADMIN_RECENT_TRANSACTIONS]
+        return queryset
+
 
 class TransactionInline(admin.TabularInline):
     model = Transaction
+    formset = RecentTransactionFormSet
     fields = ('id', 'status', 'location', 'is_active', 'created_at', 'updated_at')
     readonly_fields = ('id', 'created_at', 'updated_at')
     extra = 0
 
 
-class ItemAdmin(DjangoObjectActions, admin.ModelAdmin):
+class ItemAdmin(DjangoObjectActions, ShardedModelAdmin):
     inlines = [
         TransactionInline,
     ]
     list_display = ('id', 'amount', 'created_at', 'updated_at', 'state')
+    list_filter = ('state', ShardFilter)
+    date_hierarchy = 'created_at'
+    readonly_fields = ('all_transactions', )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # the changelist also runs bulk refunds of up to ITEM_BATCH_UPDATE_SIZE
+    # items and bulk deletes, autocomplete is a 404 without search_fields
+    query_budgets = {
+        'changelist': 17, 'add': 5, 'change': 7, 'history': 4, 'delete': 6,
+        'autocomplete': 2, 'actions': 14,
+    }
+
+    def get_object_shards(self, request, object_id):
+        return [shards.for_item(object_id)]
+
+    def delete_queryset(self, request, queryset):
+        using = queryset.db
+        changes = stats.Changes()
+        with transaction.atomic(using=using):
+            changes.remove(
+                items=queryset,
+                transactions=Transaction.objects.using(using).filter(item__in=queryset)
+            )
+            queryset.delete()
+            changes.save(using)
+
+    def all_transactions(self, obj):
+        if obj is None or obj.pk is None:
+            return '-'
+        url = reverse('admin:api_transaction_changelist')
+        return format_html(
+            '<a href="{}?item__id__exact={}&shard={}">All transactions</a>',
+            url, obj.pk, obj._state.db or DEFAULT_DB_ALIAS
+        )
 
     def refund(self, request, obj):
+        using = shards.for_item(obj.id)
         trans = None
         try:
-            trans = Transaction.objects.get(
+            trans = Transaction.objects.using(using).get(
                 item__pk=obj.id, 
                 is_active=True,
                 status=Transaction.ERROR
@@ -33,19 +144,33 @@ class ItemAdmin(DjangoObjectActions, admin.ModelAdmin):
             )
         
         if trans:
-            # deactivate current active transaction in error state.
-            trans.deactivate_transaction()
-
-            # Create new item transaction 
-            trans_obj = Transaction.objects.create(
-                item_id=obj.id, 
-                status="refunding",
-                location="routable"
-            )
+            try:
+                new_status, new_location = state_machine.get_transition(
+                    state_machine.REFUNDS, trans.status, trans.location
+                )
+            except InvalidTransition:
+                self.message_user(
+                    request,
+                    "Action failed, Item transaction can not be refunded", 
+                    level=messages.ERROR
+                )
+                return
+
+            try:
+                with transaction.atomic(using=using):
+                    # deactivate current active transaction in error state and
+                    # create a new one
+                    trans_obj = trans.replace_transaction(new_status, new_location)
 
-            # update item state
-            item_obj = Item.objects.get(pk=obj.id)
-            item_obj.update_item_state(trans_obj.status)
+                    # update item state
+                    obj.update_item_state(trans_obj.status)
+            except TransitionConflict:
+                self.message_user(
+                    request,
+                    "Action failed, Item transaction was changed by another request", 
+                    level=messages.ERROR
+                )
+                return
 
             self.message_user(
                 request,
@@ -56,10 +181,96 @@ class ItemAdmin(DjangoObjectActions, admin.ModelAdmin):
     refund.label = "Refund" 
     change_actions = ('refund', )
 
+    def refund_selected(self, request, queryset):
+        refunded, skipped = batch.refund_items(queryset.values_list('pk', flat=True))
+        self.message_user(
+            request,
+            "Refunding %d Items" % len(refunded), 
+            level=messages.SUCCESS
+        )
+        for reason, count in Counter(skipped.values()).most_common():
+            self.message_user(
+                request,
+                "Skipped %d Items: %s" % (count, reason), 
+                level=messages.WARNING
+            )
+    refund_selected.short_description = "Refund selected Items"
+    actions = ('refund_selected', )
 
-class TransactionAdmin(admin.ModelAdmin):
+
+class TransactionAdmin(ShardedModelAdmin):
     list_display = ('id', 'item', 'status', 'location', 'created_at', 'updated_at', 'is_active')
+    list_select_related = ('item', )
+    list_filter = ('status', 'location', ShardFilter)
+    date_hierarchy = 'created_at'
+    raw_id_fields = ('item', )
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    query_budgets = {
+        'changelist': 7, 'add': 5, 'change': 6, 'history': 4, 'delete': 5, 'autocomplete': 2,
+    }
+
+    def delete_queryset(self, request, queryset):
+        using = queryset.db
+        changes = stats.Changes()
+        with transaction.atomic(using=using):
+            changes.remove(transactions=queryset)
+            queryset.delete()
+            changes.save(using)
+
+
+class EventAdmin(ShardedModelAdmin):
+    list_display = ('id', 'type', 'created_at', 'attempts', 'next_attempt_at', 'delivered_at')
+    list_filter = (ShardFilter, )
+    readonly_fields = ('type', 'payload', 'created_at')
+    query_budgets = {
+        'changelist': 5, 'add': 5, 'change': 5, 'history': 4, 'delete': 5, 'autocomplete': 2,
+    }
+
+
+class ArchivedTransactionInline(admin.TabularInline):
+    model = ArchivedTransaction
+    fields = ('id', 'status', 'location', 'is_active', 'created_at', 'updated_at')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class ArchivedItemAdmin(ShardedModelAdmin):
+    """
+    Read-only pages of archived items, see api/archive.py.
+    """
+    inlines = [
+        ArchivedTransactionInline,
+    ]
+    list_display = ('id', 'amount', 'created_at', 'updated_at', 'archived_at')
+    list_filter = (ShardFilter, )
+    date_hierarchy = 'created_at'
+    readonly_fields = ('id', 'amount', 'state', 'created_at', 'updated_at', 'archived_at')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    # add and delete pages are refused
+    query_budgets = {
+        'changelist': 7, 'add': 5, 'change': 7, 'history': 4, 'delete': 5, 'autocomplete': 2,
+    }
+
+    def get_object_shards(self, request, object_id):
+        return [shards.for_item(object_id)]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
 
 
 admin.site.register(Item, ItemAdmin)
 admin.site.register(Transaction, TransactionAdmin)
+admin.site.register(Event, EventAdmin)
+admin.site.register(ArchivedItem, ArchivedItemAdmin)
@@ -1,5 +1,10 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from api import sqlite
+        connection_created.connect(sqlite.set_pragmas, dispatch_uid='api.sqlite.set_pragmas')
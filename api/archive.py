@@ -0,0 +1,88 @@
+"""
+Archival of resolved items into the ArchivedItem and ArchivedTransaction
+tables, by `manage.py archive`.
+
+Resolved items never change again, so once resolved for longer than a
+cutoff they are moved, with their transactions, out of the hot tables,
+whose indexes and listings then only cover work in flight. The archive
+tables live on the item's shard, so a batch is moved in one database
+transaction. Lookups by id fall back to them, see get_item; listings and
+exports read the hot tables only.
+"""
+from django.conf import settings
+from django.db import transaction
+
+from api import item_cache, paginators, shards
+from api.models import ArchivedItem, ArchivedTransaction, Item, Transaction
+
+
+ITEM_FIELDS = ('id', 'amount', 'state', 'created_at', 'updated_at')
+TRANSACTION_FIELDS = ('id', 'item_id', 'status', 'location', 'is_active', 'created_at', 'updated_at')
+
+
+def archivable(using, cutoff):
+    """
+    Returns the items of shard using resolved before cutoff.
+    """
+    return Item.objects.using(using).filter(state=Item.RESOLVED, updated_at__lt=cutoff)
+
+
+def archive_batch(using, cutoff, batch_size=None):
+    """
+    Moves up to batch_size archivable items of shard using, with their
+    transactions, in one database transaction.
+    Returns the number of (items, transactions) moved.
+    """
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    with transaction.atomic(using=using):
+        items = list(archivable(using, cutoff).values(*ITEM_FIELDS)[:batch_size])
+        if not items:
+            return 0, 0
+        item_ids = [item['id'] for item in items]
+        transactions = list(
+            Transaction.objects.using(using).filter(item_id__in=item_ids).values(*TRANSACTION_FIELDS)
+        )
+
+        ArchivedItem.objects.using(using).bulk_create([ArchivedItem(**item) for item in items])
+        ArchivedTransaction.objects.using(using).bulk_create(
+            [ArchivedTransaction(**trans) for trans in transactions]
+        )
+        Transaction.objects.using(using).filter(item_id__in=item_ids).delete()
+        Item.objects.using(using).filter(pk__in=item_ids).delete()
+        item_cache.invalidate(item_ids, using=using)
+    return len(items), len(transactions)
+
+
+def archive(cutoff, batch_size=None):
+    """
+    Archives every item resolved before cutoff, batch by batch and shard by
+    shard, then refreshes the size estimates of the shards' hot tables.
+    Yields (alias, items, transactions) for each batch moved.
+    """
+    for using in settings.DATABASE_SHARDS:
+        archived = False
+        while True:
+            items, transactions = archive_batch(using, cutoff, batch_size)
+            if not items:
+                break
+            archived = True
+            yield using, items, transactions
+        if archived:
+            # the admin changelists page through the estimated table sizes
+            paginators.refresh_estimates([Item, Transaction], using)
+
+
+def get_item(pk, using=None):
+    """
+    Returns item pk from the hot table, or else from the archive, or None.
+    """
+    using = using or shards.for_item(pk)
+    item = Item.objects.using(using).filter(pk=pk).first()
+    if item is None:
+        item = ArchivedItem.objects.using(using).filter(pk=pk).first()
+    return item
+
+
+def is_archived(pk):
+    return ArchivedItem.objects.using(shards.for_item(pk)).filter(pk=pk).exists()
+
@@ -0,0 +1,229 @@
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from api import item_cache, metrics, shards, sqlite, state_machine, stats
+from api.models import Event, Item, Transaction
+
+
+NO_ACTIVE_TRANSACTION = 'Item has no active transaction or Item doesnt exist'
+TRANSACTION_ERRORED = 'Transaction errored, can not be moved'
+ALREADY_ERRORED = 'Item transaction already errored'
+INVALID_STATE = 'Transaction can not be moved from its current state'
+
+
+def chunks(values, size=None):
+    """
+    Splits values into lists of at most `size` entries, keeping the
+    IN (...) clauses below the database parameter limit.
+    """
+    size = size or settings.ITEM_BATCH_UPDATE_SIZE
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _active_transactions(using, item_ids):
+    """
+    Locks and returns (id, item_id, status, location, item state, item
+    amount) of the active transactions of the given items.
+    """
+    for chunk in chunks(item_ids):
+        yield from Transaction.objects.using(using).select_for_update().filter(
+            item_id__in=chunk,
+            is_active=True
+        ).values_list('id', 'item_id', 'status', 'location', 'item__state', 'item__amount')
+
+
+def _group(using, item_ids, table, reasons=None):
+    """
+    Groups the active transactions of item_ids by their current
+    (status, location), see state_machine.group_transitions.
+    Items without an active transaction, or without a transition through
+    table, are rejected with a reason looked up by status in reasons.
+    Also returns {item_id: (state, amount)} of the items, for the counters.
+    """
+    reasons = reasons or {}
+    rows = list(_active_transactions(using, item_ids))
+    groups, stuck = state_machine.group_transitions([row[:4] for row in rows], table)
+
+    rejected = dict.fromkeys(item_ids, NO_ACTIVE_TRANSACTION)
+    for _, item_id, _, _, _, _ in rows:
+        del rejected[item_id]
+    for item_id, (status_, _) in stuck.items():
+        rejected[item_id] = reasons.get(status_, INVALID_STATE)
+    items = {item_id: (state, amount) for _, item_id, _, _, state, amount in rows}
+    return groups, rejected, items
+
+
+def _record_transaction_events(using, members, status_, location, is_active):
+    Event.objects.using(using).bulk_create(
+        [
+            Event.for_transaction(Transaction(
+                id=trans_id,
+                item_id=item_id,
+                status=status_,
+                location=location,
+                is_active=is_active
+            ))
+            for trans_id, item_id in members
+        ],
+        batch_size=settings.ITEM_BULK_CREATE_BATCH_SIZE
+    )
+
+
+def _update_items(using, item_ids, trans_status, now, items, changes):
+    new_state = state_machine.get_item_state(trans_status)
+    for item_id in item_ids:
+        state, amount = items[item_id]
+        changes.move_items(state, new_state, 1, amount)
+    for chunk in chunks(item_ids):
+        Item.objects.using(using).filter(pk__in=chunk).update(state=new_state, updated_at=now)
+    item_cache.invalidate(item_ids, using=using)
+    Event.objects.using(using).bulk_create(
+        [Event.for_item(item_id, new_state) for item_id in item_ids],
+        batch_size=settings.ITEM_BULK_CREATE_BATCH_SIZE
+    )
+
+
+def _result(item_ids, rejected):
+    """
+    Splits item_ids, in input order, into moved ids and rejected ids with reasons.
+    """
+    moved = [item_id for item_id in item_ids if item_id not in rejected]
+    rejected = OrderedDict(
+        (item_id, rejected[item_id]) for item_id in item_ids if item_id in rejected
+    )
+    return moved, rejected
+
+
+def _apply_updates(using, groups, items, changes, now):
+    """
+    Moves each group of transactions to its target with one UPDATE per
+    chunk on both tables.
+    """
+    for (status_, location), ((new_status, new_location), members) in groups.items():
+        changes.move_transactions((status_, location), (new_status, new_location), len(members))
+        is_active = state_machine.is_active(new_status)
+        for chunk in chunks(members):
+            Transaction.objects.using(using).filter(
+                pk__in=[trans_id for trans_id, _ in chunk],
+                status=status_,
+                location=location,
+                is_active=True
+            ).update(
+                status=new_status,
+                location=new_location,
+                is_active=is_active,
+                updated_at=now
+            )
+        _record_transaction_events(using, members, new_status, new_location, is_active)
+        metrics.record_transition(status_, new_status, new_location, len(members), using=using)
+        _update_items(using, [item_id for _, item_id in members], new_status, now, items, changes)
+
+
+def _replace_transactions(using, groups, items, changes, now):
+    """
+    Deactivates each group of transactions and creates the transactions
+    replacing them at their target.
+    """
+    for (status_, location), ((new_status, new_location), members) in groups.items():
+        for chunk in chunks(members):
+            Transaction.objects.using(using).filter(
+                pk__in=[trans_id for trans_id, _ in chunk],
+                is_active=True
+            ).update(is_active=False, updated_at=now)
+        _record_transaction_events(using, members, status_, location, False)
+
+        created = [
+            Transaction(item_id=item_id, status=new_status, location=new_location)
+            for _, item_id in members
+        ]
+        Transaction.objects.using(using).bulk_create(
+            created, batch_size=settings.ITEM_BULK_CREATE_BATCH_SIZE
+        )
+        changes.add_transactions(new_status, new_location, len(created))
+        _record_transaction_events(
+            using, [(trans.id, trans.item_id) for trans in created], new_status, new_location, True
+        )
+        metrics.record_transition(status_, new_status, new_location, len(members), using=using)
+        _update_items(using, [item_id for _, item_id in members], new_status, now, items, changes)
+
+
+def _transition(item_ids, table, reasons, apply, on_retry=None):
+    """
+    Groups and applies a transition on every shard of item_ids, each shard
+    in its own database transaction, retried on its own when the database
+    is locked. on_retry is called before every retry.
+    """
+    item_ids = list(OrderedDict.fromkeys(item_ids))
+    rejected = {}
+    for using, shard_ids in shards.partition(item_ids).items():
+        rejected.update(sqlite.run_retrying_busy(
+            lambda: _apply_shard(using, shard_ids, table, reasons, apply), on_retry
+        ))
+    return _result(item_ids, rejected)
+
+
+def _apply_shard(using, item_ids, table, reasons, apply):
+    """
+    Groups and applies a transition on the items of one shard in a database
+    transaction. Returns the {item_id: reason} dict of rejected items.
+    """
+    with transaction.atomic(using=using):
+        groups, rejected, items = _group(using, item_ids, table, reasons)
+        changes = stats.Changes()
+        apply(using, groups, items, changes, timezone.now())
+        changes.save(using)
+    return rejected
+
+
+def move_items(item_ids, on_retry=None):
+    """
+    Moves the active transaction of each item to its next status and location.
+    Returns the moved item ids and a {item_id: reason} dict of rejected items.
+    """
+    return _transition(
+        item_ids, state_machine.MOVES, {Transaction.ERROR: TRANSACTION_ERRORED}, _apply_updates,
+        on_retry
+    )
+
+
+def error_items(item_ids, on_retry=None):
+    """
+    Marks the active processing transaction of each item, at routable, as errored.
+    Returns the errored item ids and a {item_id: reason} dict of rejected items.
+    """
+    return _transition(
+        item_ids, state_machine.ERRORS, {Transaction.ERROR: ALREADY_ERRORED}, _apply_updates,
+        on_retry
+    )
+
+
+def fix_items(item_ids, on_retry=None):
+    """
+    Deactivates the errored transaction of each item and starts a new
+    fixing transaction for it.
+    Returns the fixed item ids and a {item_id: reason} dict of rejected items.
+    """
+    return _transition(item_ids, state_machine.FIXES, None, _replace_transactions, on_retry)
+
+
+def refund_items(item_ids):
+    """
+    Deactivates the errored transaction of each item and starts a new
+    refunding transaction for it. Items are processed in chunks of
+    ITEM_BATCH_UPDATE_SIZE per shard, each in its own database transaction,
+    retried on its own when the database is locked.
+    Returns the refunded item ids and a {item_id: reason} dict of skipped items.
+    """
+    item_ids = list(OrderedDict.fromkeys(item_ids))
+    rejected = {}
+    for using, shard_ids in shards.partition(item_ids).items():
+        for chunk in chunks(shard_ids):
+            rejected.update(sqlite.run_retrying_busy(
+                lambda: _apply_shard(using, chunk, state_machine.REFUNDS, None, _replace_transactions)
+            ))
+    return _result(item_ids, rejected)
@@ -0,0 +1,28 @@
+import threading
+
+from django.core.cache.backends import filebased
+
+
+class FileBasedCache(filebased.FileBasedCache):
+    """
+    File cache that checks its size once every CULL_EVERY writes instead of
+    on every write: the stock backend lists the whole cache directory each
+    time, which makes writes slower as the cache grows. MAX_ENTRIES becomes
+    a soft limit, exceeded by at most CULL_EVERY entries per process.
+    """
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        options = params.get('OPTIONS') or {}
+        self._cull_every = int(options.get('CULL_EVERY', 1000))
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+
+    def _cull(self):
+        with self._writes_lock:
+            self._writes += 1
+            due = self._writes >= self._cull_every
+            if due:
+                self._writes = 0
+        if due:
+            super()._cull()
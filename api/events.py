@@ -0,0 +1,138 @@
+"""
+Delivery of the event outbox to the webhook.
+
+Every shard has its own outbox, next to the items it holds. Event ids are
+only unique within a shard, so deliveries carry the shard's alias too.
+"""
+import json
+import logging
+import time
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+from api.models import EVENT_MAX_ATTEMPTS, Event
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_backoff(attempts):
+    """
+    Returns the delay before retrying an event that failed `attempts` times,
+    doubling from WEBHOOK_BACKOFF_BASE up to WEBHOOK_BACKOFF_MAX seconds.
+    """
+    seconds = settings.WEBHOOK_BACKOFF_BASE * 2 ** (attempts - 1)
+    return timedelta(seconds=min(seconds, settings.WEBHOOK_BACKOFF_MAX))
+
+
+def deliver(event, url):
+    """
+    POSTs one event to url. Returns None on success or the error message.
+    """
+    body = json.dumps({
+        'id': event.id,
+        'shard': event._state.db,
+        'type': event.type,
+        'created_at': event.created_at.isoformat(),
+        'data': json.loads(event.payload),
+    }).encode()
+    request = urllib.request.Request(
+        url,
+        data=body,
+        headers={'Content-Type': 'application/json'},
+        method='POST'
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=settings.WEBHOOK_TIMEOUT) as response:
+            response.read()
+    except Exception as exc:
+        return str(exc) or exc.__class__.__name__
+    return None
+
+
+def claim(batch_size, using=DEFAULT_DB_ALIAS):
+    """
+    Leases up to batch_size due events of shard using to this dispatcher by
+    pushing their next attempt past WEBHOOK_LEASE, so concurrent
+    dispatchers skip them and no lock is held while delivering.
+
+    The events are leased with a single UPDATE, which checks again that
+    each one is still due: it runs under the database's write lock, so two
+    dispatchers never lease the same event, where SQLite ignores the row
+    locks of SELECT ... FOR UPDATE SKIP LOCKED. The UPDATE tags the events
+    with a token of this call, by which they are read back.
+    """
+    events = Event.objects.using(using)
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=settings.WEBHOOK_LEASE)
+    token = uuid.uuid4()
+    pending = events.filter(delivered_at__isnull=True, attempts__lt=EVENT_MAX_ATTEMPTS)
+    due = pending.filter(next_attempt_at__lte=now)
+    due.filter(pk__in=due.order_by('id').values('id')[:batch_size]).update(
+        next_attempt_at=lease_until,
+        lease_token=token
+    )
+    # next_attempt_at keeps the read on the pending events index
+    return list(pending.filter(next_attempt_at=lease_until, lease_token=token).order_by('id'))
+
+
+def dispatch_batch(executor, url, batch_size, using=DEFAULT_DB_ALIAS):
+    """
+    Delivers up to batch_size due events of shard using concurrently on executor.
+    Delivered events are marked with one UPDATE, failed ones are rescheduled
+    with exponential backoff.
+    Returns the number of (delivered, failed) events.
+    """
+    events = claim(batch_size, using)
+    if not events:
+        return 0, 0
+
+    errors = list(executor.map(lambda event: deliver(event, url), events))
+    now = timezone.now()
+
+    delivered = [event.id for event, error in zip(events, errors) if error is None]
+    Event.objects.using(using).filter(pk__in=delivered).update(delivered_at=now)
+
+    failed = [(event, error) for event, error in zip(events, errors) if error is not None]
+    for event, error in failed:
+        event.attempts += 1
+        event.next_attempt_at = now + get_backoff(event.attempts)
+        event.last_error = error
+        logger.warning('Delivery of event %s failed: %s', event.id, error)
+    Event.objects.using(using).bulk_update(
+        [event for event, _ in failed],
+        ['attempts', 'next_attempt_at', 'last_error']
+    )
+    return len(delivered), len(failed)
+
+
+def dispatch(url, batch_size=None, workers=None, once=False, poll_interval=None):
+    """
+    Delivers due events in batches, from every shard in turn. With once set,
+    returns when no events are due, otherwise polls every poll_interval
+    seconds when idle.
+    Returns the number of (delivered, failed) deliveries.
+    """
+    batch_size = batch_size or settings.WEBHOOK_BATCH_SIZE
+    poll_interval = settings.WEBHOOK_POLL_INTERVAL if poll_interval is None else poll_interval
+    total_delivered = total_failed = 0
+
+    with ThreadPoolExecutor(max_workers=workers or settings.WEBHOOK_WORKERS) as executor:
+        while True:
+            busy = False
+            for using in settings.DATABASE_SHARDS:
+                delivered, failed = dispatch_batch(executor, url, batch_size, using)
+                total_delivered += delivered
+                total_failed += failed
+                busy = busy or delivered + failed == batch_size
+            if busy:
+                continue
+            if once:
+                return total_delivered, total_failed
+            time.sleep(poll_interval)
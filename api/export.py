@@ -0,0 +1,170 @@
+import csv
+import datetime
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from api import shards
+from api.models import Item, Transaction
+
+
+ITEM_FIELDS = ('id', 'amount', 'state', 'created_at', 'updated_at')
+TRANSACTION_FIELDS = ('id', 'status', 'location', 'is_active', 'created_at', 'updated_at')
+
+CSV_HEADER = (
+    ['item_' + field for field in ITEM_FIELDS] +
+    ['transaction_' + field for field in TRANSACTION_FIELDS]
+)
+
+FORMATS = ('csv', 'ndjson')
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def filter_items(state=None, created_after=None, created_before=None):
+    queryset = Item.objects.all()
+    if state:
+        queryset = queryset.filter(state=state)
+    if created_after:
+        queryset = queryset.filter(created_at__gte=created_after)
+    if created_before:
+        queryset = queryset.filter(created_at__lt=created_before)
+    return queryset
+
+
+def _after(queryset, item):
+    """
+    Returns the items of queryset following item in export order.
+    """
+    if item is None:
+        return queryset
+    return queryset.filter(
+        Q(created_at__gt=item['created_at']) | Q(created_at=item['created_at'], id__gt=item['id'])
+    )
+
+
+def read_chunk(queryset, chunk_size):
+    """
+    Returns the first chunk_size items of queryset, oldest first, as
+    (item, transactions) pairs of dicts. The transactions are fetched with
+    one query, from the same database.
+    """
+    items = list(queryset.order_by('created_at', 'id').values(*ITEM_FIELDS)[:chunk_size])
+    transactions = defaultdict(list)
+    if items:
+        history = Transaction.objects.using(queryset.db).filter(
+            item_id__in=[item['id'] for item in items]
+        ).order_by('created_at', 'id').values('item_id', *TRANSACTION_FIELDS)
+        for trans in history:
+            transactions[trans.pop('item_id')].append(trans)
+    return [(item, transactions[item['id']]) for item in items]
+
+
+def iter_items(queryset, chunk_size=None):
+    """
+    Yields (item, transactions) pairs as dicts, oldest item first. Items are
+    read in chunks following the last one read, so memory use depends on
+    chunk_size only.
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    last = None
+    while True:
+        pairs = read_chunk(_after(queryset, last), chunk_size)
+        yield from pairs
+        if len(pairs) < chunk_size:
+            return
+        last = pairs[-1][0]
+
+
+class _Echo:
+    """
+    File-like object handing back what is written to it, so csv.writer
+    rows can be yielded instead of buffered.
+    """
+    def write(self, value):
+        return value
+
+
+def iter_csv(pairs):
+    """
+    Yields CSV lines, one per transaction. Items without transactions get a
+    single line with empty transaction columns.
+    """
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_HEADER)
+    empty = [''] * len(TRANSACTION_FIELDS)
+    for item, transactions in pairs:
+        item_values = [item[field] for field in ITEM_FIELDS]
+        if not transactions:
+            yield writer.writerow(item_values + empty)
+        for trans in transactions:
+            yield writer.writerow(item_values + [trans[field] for field in TRANSACTION_FIELDS])
+
+
+class _LedgerEncoder(DjangoJSONEncoder):
+    """
+    Writes datetimes with their microseconds, DjangoJSONEncoder cuts them
+    to milliseconds, so imports restore the exported timestamps.
+    """
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def iter_ndjson(pairs):
+    """
+    Yields one JSON line per item, with its transactions nested.
+    """
+    encoder = _LedgerEncoder()
+    for item, transactions in pairs:
+        item['transactions'] = transactions
+        yield encoder.encode(item) + '\n'
+
+
+def iter_merged(querysets, chunk_size=None):
+    """
+    Yields the iter_items pairs of several querysets, e.g. of every shard,
+    merged oldest item first. The next chunks of the querysets are read in
+    parallel, through shards.fan_out, for every queryset with less than a
+    chunk left, so memory use grows with the number of querysets only.
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    if len(querysets) == 1:
+        yield from iter_items(querysets[0], chunk_size)
+        return
+
+    buffers = [deque() for _ in querysets]
+    # the last item read of each queryset, None before the first chunk
+    last = [None] * len(querysets)
+    remaining = set(range(len(querysets)))
+    while True:
+        if any(not buffers[index] for index in remaining):
+            refill = sorted(index for index in remaining if len(buffers[index]) < chunk_size)
+            chunks = shards.fan_out(
+                lambda queryset: read_chunk(queryset, chunk_size),
+                [_after(querysets[index], last[index]) for index in refill]
+            )
+            for index, pairs in zip(refill, chunks):
+                buffers[index].extend(pairs)
+                if pairs:
+                    last[index] = pairs[-1][0]
+                if len(pairs) < chunk_size:
+                    remaining.discard(index)
+        heads = [buffer for buffer in buffers if buffer]
+        if not heads:
+            return
+        # every queryset not read to its end has a buffered head
+        oldest = min(heads, key=lambda buffer: (buffer[0][0]['created_at'], buffer[0][0]['id']))
+        yield oldest.popleft()
+
+
+def iter_export(querysets, output='csv', chunk_size=None):
+    pairs = iter_merged(querysets, chunk_size)
+    if output == 'ndjson':
+        return iter_ndjson(pairs)
+    return iter_csv(pairs)
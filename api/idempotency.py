@@ -0,0 +1,156 @@
+"""
+Idempotency-Key support for POST endpoints.
+
+The first request with a key runs the view and stores its response; retries
+with the same key get the stored response back. Completed responses are
+also kept in the Django cache, so replays served by the same process run
+no serializer and no query. A row is inserted before the view runs, which
+makes concurrent requests with the same key wait for the first one instead
+of doing the work twice. The first request holds the row for
+IDEMPOTENCY_LEASE seconds; a worker killed while running it can not
+release the row, so a retry coming after the lease takes it over.
+"""
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from api.models import IdempotencyKey
+from routable.middleware import exempt_from_query_budget
+
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+IN_PROGRESS = 'A request with this Idempotency-Key is still in progress'
+KEY_REUSED = 'This Idempotency-Key was used for a different request'
+
+# Queries the bookkeeping of a key adds to a request, at most: claiming it,
+# replacing an expired row, and storing the response.
+QUERY_BUDGET = 10
+
+
+def _cache_key(key, path):
+    return 'idempotency:%s' % hashlib.sha256(('%s\n%s' % (path, key)).encode()).hexdigest()
+
+
+def _fingerprint(request):
+    return hashlib.sha256(request.body).hexdigest()
+
+
+def _replay(fingerprint, stored_fingerprint, status_code, body):
+    if fingerprint != stored_fingerprint:
+        return Response(KEY_REUSED, status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+    response = Response(json.loads(body), status=status_code)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _claim(key, path, fingerprint):
+    """
+    Inserts the row of a new key. Returns (claimed_at, None) when this
+    request owns the key, or (None, the existing row) otherwise. Expired
+    rows are replaced and rows in progress past their lease taken over.
+    """
+    now = timezone.now()
+    expires_at = now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(
+                    key=key, path=path, fingerprint=fingerprint,
+                    claimed_at=now, expires_at=expires_at
+                )
+            return now, None
+        except IntegrityError:
+            pass
+        record = IdempotencyKey.objects.filter(key=key, path=path).first()
+        if record is None:
+            continue
+        if record.expires_at <= now:
+            IdempotencyKey.objects.filter(pk=record.pk, expires_at=record.expires_at).delete()
+            continue
+        if record.status_code is None and (
+            record.claimed_at + timedelta(seconds=settings.IDEMPOTENCY_LEASE) <= now
+        ):
+            taken_over = IdempotencyKey.objects.filter(
+                pk=record.pk, status_code__isnull=True, claimed_at=record.claimed_at
+            ).update(fingerprint=fingerprint, claimed_at=now, expires_at=expires_at)
+            if taken_over:
+                return now, None
+            continue
+        return None, record
+    return None, IdempotencyKey.objects.filter(key=key, path=path).first()
+
+
+def _wait_for(record):
+    """
+    Polls a key owned by a concurrent request until its response is stored.
+    Returns the completed row, or None on timeout or if the owner failed.
+    """
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT_TIMEOUT
+    while record is not None and record.status_code is None:
+        if time.monotonic() > deadline:
+            return None
+        time.sleep(settings.IDEMPOTENCY_POLL_INTERVAL)
+        record = IdempotencyKey.objects.filter(pk=record.pk).first()
+    return record
+
+
+def idempotent(view_method):
+    """
+    Makes a view method idempotent for requests with an Idempotency-Key
+    header. Responses with a 5xx status are not stored, so the request can
+    be retried.
+    """
+    @functools.wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        key = request.META.get(HEADER)
+        if not key:
+            return view_method(view, request, *args, **kwargs)
+
+        path = request.path
+        fingerprint = _fingerprint(request)
+        cache_key = _cache_key(key, path)
+
+        stored = cache.get(cache_key)
+        if stored is not None:
+            return _replay(fingerprint, *stored)
+
+        claimed_at, record = _claim(key, path, fingerprint)
+        if claimed_at is None:
+            # the number of polls depends on the concurrent request
+            exempt_from_query_budget(request)
+            record = _wait_for(record)
+            if record is None:
+                return Response(IN_PROGRESS, status=status.HTTP_409_CONFLICT)
+            return _replay(fingerprint, record.fingerprint, record.status_code, record.body)
+
+        # the row while this request holds it, not once taken over
+        owned = IdempotencyKey.objects.filter(key=key, path=path, claimed_at=claimed_at)
+        try:
+            response = view_method(view, request, *args, **kwargs)
+        except Exception:
+            owned.delete()
+            raise
+
+        if response.status_code >= 500:
+            owned.delete()
+            return response
+
+        body = json.dumps(response.data, cls=JSONEncoder)
+        owned.update(status_code=response.status_code, body=body)
+        cache.set(
+            cache_key,
+            (fingerprint, response.status_code, body),
+            settings.IDEMPOTENCY_KEY_TTL
+        )
+        return response
+    return wrapper
@@ -0,0 +1,50 @@
+"""
+Time-ordered UUIDs (version 7, RFC 9562) for the primary keys of items and
+transactions.
+
+The first 48 bits are the Unix time in milliseconds, so new keys sort after
+older ones and inserts append to the right end of the primary key index
+instead of landing on random pages. The next 12 bits count the ids made in
+the same millisecond by this process, keeping them ordered as well, and
+the remaining 62 bits are random. Rows created before keep their UUID4
+keys; both versions are plain UUIDs to the database and the URLs.
+"""
+import os
+import threading
+import time
+import uuid
+
+
+_COUNTER_MAX = 0xfff
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+
+def uuid7():
+    """
+    Returns a new version 7 UUID, greater than the ones returned before by
+    this process.
+    """
+    global _last_ms, _counter
+    with _lock:
+        now_ms = time.time_ns() // 1000000
+        if now_ms > _last_ms:
+            # start low in the counter space, leaving room for the ids to come
+            _last_ms, _counter = now_ms, int.from_bytes(os.urandom(2), 'big') & 0x1ff
+        elif _counter < _COUNTER_MAX:
+            _counter += 1
+        else:
+            # counter exhausted, or the clock went back: borrow the next millisecond
+            _last_ms, _counter = _last_ms + 1, 0
+        timestamp, counter = _last_ms, _counter
+
+    random_bits = int.from_bytes(os.urandom(8), 'big') & ((1 << 62) - 1)
+    value = (timestamp & ((1 << 48) - 1)) << 80
+    value |= 0x7 << 76
+    value |= counter << 64
+    value |= 0b10 << 62
+    value |= random_bits
+    return uuid.UUID(int=value)
+
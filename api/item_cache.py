@@ -0,0 +1,82 @@
+"""
+Read-through cache of item detail responses.
+
+Every cached value is tagged with the item's generation token, which is
+replaced whenever the item is written: once when the write happens and
+once more after its transaction commits. A value read from the database
+before a transition committed is therefore tagged with a stale token and
+never served, so the cache can not return a state older than the last
+committed transition.
+"""
+import uuid
+
+from django.core.cache import caches
+from django.db import transaction
+
+from api import metrics
+
+
+CACHE_ALIAS = 'items'
+
+def _value_key(pk):
+    return 'item:%s' % pk
+
+
+def _generation_key(pk):
+    return 'item-generation:%s' % pk
+
+
+def _bump(pks):
+    caches[CACHE_ALIAS].set_many(
+        {_generation_key(pk): uuid.uuid4().hex for pk in pks}, timeout=None
+    )
+
+
+def get(pk, load):
+    """
+    Returns the cached data of item pk, or calls load() to read it from the
+    database and caches the result unless it is None.
+    """
+    cache = caches[CACHE_ALIAS]
+    cached = cache.get_many([_value_key(pk), _generation_key(pk)])
+    generation = cached.get(_generation_key(pk))
+    value = cached.get(_value_key(pk))
+
+    if generation is not None and value is not None and value[0] == generation:
+        metrics.ITEM_CACHE_LOOKUPS.inc(outcome='hit')
+        return value[1]
+
+    metrics.ITEM_CACHE_LOOKUPS.inc(outcome='miss')
+    if generation is None:
+        cache.add(_generation_key(pk), uuid.uuid4().hex, timeout=None)
+        generation = cache.get(_generation_key(pk))
+
+    data = load()
+    if data is not None:
+        cache.set(_value_key(pk), (generation, data))
+    return data
+
+
+def invalidate(pks, using=None):
+    """
+    Invalidates the cached data of the given items now, and again once the
+    current transaction of database using commits.
+    """
+    pks = list(pks)
+    _bump(pks)
+    transaction.on_commit(lambda: _bump(pks), using=using)
+
+
+def get_stats():
+    """
+    Returns the hits and misses of the cache and its hit rate, counted by
+    the metrics registry, so summed over the worker processes sharing
+    METRICS_DIR.
+    """
+    lookups = metrics.REGISTRY.collect()[metrics.ITEM_CACHE_LOOKUPS.name]
+    hits, misses = int(lookups.get(('hit', ), 0)), int(lookups.get(('miss', ), 0))
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses else None,
+    }
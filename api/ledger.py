@@ -0,0 +1,311 @@
+"""
+Bulk import of items with their transaction history, by `manage.py
+import_ledger`.
+
+The input has the layout of the exports, see api/export.py: CSV with one
+row per transaction, the rows of an item following each other, or NDJSON
+with one item per line and its transactions nested. Rows are checked by
+plain functions instead of serializers, and written with one executemany
+per table and shard for every batch of items, keeping the timestamps of
+the input. Imported history writes no outbox events.
+"""
+import csv
+import datetime
+import json
+import uuid
+from decimal import Decimal, InvalidOperation
+
+from django.db import connections, models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api import ids, shards, state_machine, stats
+from api.export import ITEM_FIELDS, TRANSACTION_FIELDS
+from api.models import Item, Transaction
+
+
+FORMATS = ('csv', 'ndjson')
+ITEM_COLUMNS = ('id', 'amount', 'state', 'created_at', 'updated_at')
+TRANSACTION_COLUMNS = ('id', 'item', 'status', 'location', 'is_active', 'created_at', 'updated_at')
+
+ITEM_STATES = {state for state, _ in Item.STATE_CHOICES}
+TRANSACTION_STATUSES = {status for status, _ in Transaction.STATUS_CHOICES}
+TRANSACTION_LOCATIONS = {location for location, _ in Transaction.LOCATION_CHOICES}
+TRUE_VALUES = {'true', '1', 'yes'}
+FALSE_VALUES = {'false', '0', 'no', ''}
+
+AMOUNT_FIELD = Item._meta.get_field('amount')
+AMOUNT_QUANTUM = Decimal(1).scaleb(-AMOUNT_FIELD.decimal_places)
+
+
+class InvalidRow(Exception):
+    pass
+
+
+def read_records(stream, format):
+    """
+    Yields (line number, record) for every item of stream: a list of CSV
+    row dicts, or an NDJSON line.
+    """
+    if format == 'ndjson':
+        for line_no, line in enumerate(stream, start=1):
+            if line.strip():
+                yield line_no, line
+        return
+
+    reader = csv.DictReader(stream)
+    item_id, rows, first_line = None, [], None
+    for row in reader:
+        if rows and row.get('item_id') != item_id:
+            yield first_line, rows
+            rows = []
+        if not rows:
+            item_id, first_line = row.get('item_id'), reader.line_num
+        rows.append(row)
+    if rows:
+        yield first_line, rows
+
+
+def _uuid(value, name):
+    try:
+        return uuid.UUID(str(value))
+    except (TypeError, ValueError):
+        raise InvalidRow('Invalid %s: %r' % (name, value))
+
+
+def _choice(value, choices, name, default):
+    if value in (None, ''):
+        return default
+    if value not in choices:
+        raise InvalidRow('Invalid %s: %r' % (name, value))
+    return value
+
+
+def _datetime(value, name, default):
+    if value in (None, ''):
+        return default
+    try:
+        # the C parser reads the exports' formats, Django's the others
+        parsed = datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        try:
+            parsed = parse_datetime(str(value))
+        except ValueError:
+            parsed = None
+    if parsed is None:
+        raise InvalidRow('Invalid %s: %r' % (name, value))
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, timezone.utc)
+    return parsed
+
+
+def _amount(value):
+    try:
+        amount = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        raise InvalidRow('Invalid amount: %r' % (value, ))
+    if not amount.is_finite() or amount.quantize(AMOUNT_QUANTUM) != amount:
+        raise InvalidRow('Invalid amount: %r' % (value, ))
+    amount = amount.quantize(AMOUNT_QUANTUM)
+    if len(amount.as_tuple().digits) > AMOUNT_FIELD.max_digits:
+        raise InvalidRow('Amount out of range: %r' % (value, ))
+    return amount
+
+
+def _boolean(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise InvalidRow('Invalid is_active: %r' % (value, ))
+
+
+def _split(record, format):
+    """
+    Returns the item dict and the transaction dicts of a record, with the
+    field names of the exports.
+    """
+    if format == 'ndjson':
+        try:
+            item = json.loads(record)
+        except ValueError:
+            raise InvalidRow('Invalid JSON')
+        if not isinstance(item, dict):
+            raise InvalidRow('Expected an object')
+        transactions = item.get('transactions') or []
+        if not isinstance(transactions, list) or not all(isinstance(t, dict) for t in transactions):
+            raise InvalidRow('Invalid transactions')
+        return item, transactions
+
+    item = {field: record[0].get('item_' + field) for field in ITEM_FIELDS}
+    transactions = [
+        {field: row.get('transaction_' + field) for field in TRANSACTION_FIELDS}
+        for row in record
+        if any(row.get('transaction_' + field) for field in TRANSACTION_FIELDS)
+    ]
+    return item, transactions
+
+
+def validate(record, format, now):
+    """
+    Returns the item row and the transaction rows of a record as tuples in
+    the column order of ITEM_COLUMNS and TRANSACTION_COLUMNS.
+    Raises InvalidRow when the record can not be imported.
+    """
+    item, transactions = _split(record, format)
+    if item.get('id') in (None, ''):
+        raise InvalidRow('Missing item id')
+    item_id = _uuid(item['id'], 'item id')
+    created_at = _datetime(item.get('created_at'), 'created_at', now)
+    item_row = (
+        item_id,
+        _amount(item.get('amount')),
+        _choice(item.get('state'), ITEM_STATES, 'state', Item.PROCESSING),
+        created_at,
+        _datetime(item.get('updated_at'), 'updated_at', created_at),
+    )
+
+    transaction_rows = []
+    for trans in transactions:
+        status = _choice(trans.get('status'), TRANSACTION_STATUSES, 'status', Transaction.PROCESSING)
+        trans_created_at = _datetime(trans.get('created_at'), 'transaction created_at', now)
+        transaction_rows.append((
+            _uuid(trans['id'], 'transaction id') if trans.get('id') else ids.uuid7(),
+            item_id,
+            status,
+            _choice(trans.get('location'), TRANSACTION_LOCATIONS, 'location', Transaction.ORIGIN),
+            # as Transaction.save does, finished transactions are inactive
+            _boolean(trans.get('is_active', True)) and state_machine.is_active(status),
+            trans_created_at,
+            _datetime(trans.get('updated_at'), 'transaction updated_at', trans_created_at),
+        ))
+    if sum(1 for row in transaction_rows if row[4]) > 1:
+        raise InvalidRow('More than one active transaction')
+    return item_row, transaction_rows
+
+
+def validate_batch(batch, format):
+    """
+    Validates a batch of (line number, record). Returns the item rows, the
+    transaction rows and (line number, error) of the rejected records.
+    Runs in the import's worker processes, it does not touch the database.
+    """
+    now = timezone.now()
+    items, transactions, errors = [], [], []
+    seen = set()
+    for line_no, record in batch:
+        try:
+            item_row, transaction_rows = validate(record, format, now)
+            if item_row[0] in seen:
+                raise InvalidRow('Duplicate item id %s' % item_row[0])
+        except InvalidRow as exc:
+            errors.append((line_no, str(exc)))
+            continue
+        seen.add(item_row[0])
+        items.append(item_row)
+        transactions.extend(transaction_rows)
+    return items, transactions, errors
+
+
+def _insert(using, model, field_names, rows):
+    """
+    Inserts rows with one executemany, converting the values as the ORM
+    would, but keeping auto_now fields as given.
+    """
+    if not rows:
+        return
+    connection = connections[using]
+    fields = [model._meta.get_field(name) for name in field_names]
+    converters = [_get_converter(field, connection) for field in fields]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        connection.ops.quote_name(model._meta.db_table),
+        ', '.join(connection.ops.quote_name(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    params = [[convert(value) for convert, value in zip(converters, row)] for row in rows]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, params)
+
+
+def _get_converter(field, connection):
+    if isinstance(field, models.DateTimeField):
+        # validated datetimes are aware already, which is all get_prep_value
+        # would make sure of
+        return connection.ops.adapt_datetimefield_value
+    return lambda value: field.get_db_prep_save(value, connection)
+
+
+def _existing_items(using, item_ids):
+    existing = set()
+    for start in range(0, len(item_ids), 500):
+        existing.update(
+            Item.objects.using(using).filter(pk__in=item_ids[start:start + 500])
+            .values_list('pk', flat=True)
+        )
+    return existing
+
+
+def insert_batch(items, transactions, skip_existing=False):
+    """
+    Inserts validated rows, and adds them to the summary counters, in one
+    database transaction per shard. With skip_existing, items already
+    stored, e.g. by an interrupted run, are left out with their transactions.
+    Returns the number of (items, transactions) inserted.
+    """
+    transactions_by_shard = shards.partition(transactions, key=lambda row: row[1])
+    inserted_items = inserted_transactions = 0
+    for using, shard_items in shards.partition(items, key=lambda row: row[0]).items():
+        shard_transactions = transactions_by_shard.get(using, [])
+        with transaction.atomic(using=using):
+            if skip_existing:
+                existing = _existing_items(using, [row[0] for row in shard_items])
+                shard_items = [row for row in shard_items if row[0] not in existing]
+                shard_transactions = [row for row in shard_transactions if row[1] not in existing]
+            _insert(using, Item, ITEM_COLUMNS, shard_items)
+            _insert(using, Transaction, TRANSACTION_COLUMNS, shard_transactions)
+            changes = stats.Changes()
+            for _, amount, state, _, _ in shard_items:
+                changes.add_items(state, 1, amount)
+            for _, _, status, location, _, _, _ in shard_transactions:
+                changes.add_transactions(status, location)
+            changes.save(using)
+        inserted_items += len(shard_items)
+        inserted_transactions += len(shard_transactions)
+    return inserted_items, inserted_transactions
+
+
+def drop_indexes(using):
+    """
+    Drops the secondary indexes of the item and transaction tables, which
+    are faster to rebuild once than to update row by row on a large load.
+    Indexes already dropped, by an import that was interrupted, are skipped.
+    """
+    _run_index_sql(using, lambda index, model, editor: index.remove_sql(model, editor), exists=True)
+
+
+def create_indexes(using):
+    """
+    Creates the secondary indexes of the item and transaction tables that
+    are missing.
+    """
+    _run_index_sql(using, lambda index, model, editor: index.create_sql(model, editor), exists=False)
+
+
+def _run_index_sql(using, statement, exists):
+    """
+    Runs statement for each index of the item and transaction tables that
+    exists, or is missing, in database using.
+    """
+    connection = connections[using]
+    # the statements are run directly, the SQLite schema editor refuses to
+    # open inside a transaction
+    editor = connection.schema_editor()
+    with connection.cursor() as cursor:
+        for model in (Item, Transaction):
+            names = connection.introspection.get_constraints(cursor, model._meta.db_table)
+            for index in model._meta.indexes:
+                if (index.name in names) == exists:
+                    cursor.execute(str(statement(index, model, editor)))
@@ -0,0 +1,40 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api import archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves items resolved more than --days days ago, with their transactions, '
+        'to the archive tables.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.ARCHIVE_AFTER_DAYS,
+            help='Archive items resolved at least this many days ago.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.ARCHIVE_BATCH_SIZE,
+            help='Items moved per database transaction.'
+        )
+
+    def handle(self, *args, **options):
+        if options['days'] < 0 or options['batch_size'] < 1:
+            raise CommandError('--days can not be negative and --batch-size must be positive.')
+
+        cutoff = timezone.now() - datetime.timedelta(days=options['days'])
+        total_items = total_transactions = 0
+        for using, items, transactions in archive.archive(cutoff, options['batch_size']):
+            total_items += items
+            total_transactions += transactions
+            if options['verbosity'] > 1:
+                self.stdout.write('%s: %d items, %d transactions' % (using, items, transactions))
+        self.stdout.write(
+            'Archived %d items and %d transactions resolved before %s'
+            % (total_items, total_transactions, cutoff.isoformat())
+        )
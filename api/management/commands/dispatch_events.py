@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import events
+
+
+class Command(BaseCommand):
+    help = 'Delivers outbox events to the webhook at WEBHOOK_URL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Webhook URL, defaults to the WEBHOOK_URL setting.')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--workers', type=int)
+        parser.add_argument('--poll-interval', type=float)
+        parser.add_argument(
+            '--once', 
+            action='store_true', 
+            help='Exit once there are no events due instead of polling.'
+        )
+
+    def handle(self, *args, **options):
+        url = options['url'] or settings.WEBHOOK_URL
+        if not url:
+            raise CommandError('No webhook url, set WEBHOOK_URL or pass --url')
+
+        delivered, failed = events.dispatch(
+            url,
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            once=options['once'],
+            poll_interval=options['poll_interval']
+        )
+        self.stdout.write('Delivered %d events, %d failed deliveries' % (delivered, failed))
@@ -0,0 +1,55 @@
+
+import argparse
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from api import export, shards
+from api.models import Item
+from routable import routers
+
+
+def _parse_datetime(value):
+    """
+    Parses an ISO datetime, or a date meaning its midnight.
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise argparse.ArgumentTypeError('Invalid datetime: %s' % value)
+        parsed = datetime.datetime.combine(date, datetime.time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = 'Exports items with their transaction history as CSV or NDJSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=export.FORMATS, default='csv')
+        parser.add_argument('--output', help='File to write to, defaults to stdout.')
+        parser.add_argument('--state', choices=[choice for choice, _ in Item.STATE_CHOICES])
+        parser.add_argument('--created-after', type=_parse_datetime)
+        parser.add_argument('--created-before', type=_parse_datetime)
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        queryset = export.filter_items(
+            state=options['state'],
+            created_after=options['created_after'],
+            created_before=options['created_before'],
+        )
+        with routers.replica_reads():
+            querysets = shards.across(queryset)
+        lines = export.iter_export(querysets, options['format'], options['chunk_size'])
+
+        if options['output']:
+            with open(options['output'], 'w', newline='') as stream:
+                stream.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from routable import schema
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes the OpenAPI schema, as JSON and YAML, and the Swagger UI settings to '
+        'SCHEMA_DIR, from where they are served. Run it on deploy, before starting the workers.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', default=settings.SCHEMA_DIR,
+            help='Directory to write the artifacts to, SCHEMA_DIR by default.'
+        )
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Only compare the artifacts with the current schema, failing when they differ.'
+        )
+
+    def handle(self, *args, **options):
+        artifacts = schema.build()
+        if options['check']:
+            if schema.read(options['output']) != artifacts:
+                raise CommandError('The schema in %s is out of date.' % options['output'])
+            self.stdout.write('The schema in %s is up to date' % options['output'])
+            return
+
+        schema.write(options['output'], artifacts)
+        self.stdout.write('Wrote %s to %s' % (', '.join(sorted(artifacts)), options['output']))
@@ -0,0 +1,141 @@
+import collections
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connections
+
+from api import ledger
+
+
+class Command(BaseCommand):
+    help = (
+        'Imports items with their transaction history from a CSV or NDJSON file '
+        'laid out like the exports.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='CSV or NDJSON file.')
+        parser.add_argument('--format', choices=ledger.FORMATS, help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, help='Items per database transaction.')
+        parser.add_argument(
+            '--workers', type=int, default=0,
+            help='Processes parsing and validating rows, 0 to do it in this process.'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='File recording the progress, the import resumes from it when it exists.'
+        )
+        parser.add_argument(
+            '--defer-indexes', action='store_true',
+            help='Drop the secondary indexes during the import and rebuild them at the end.'
+        )
+
+    def handle(self, *args, **options):
+        path = options['input']
+        format = options['format'] or os.path.splitext(path)[1].lstrip('.').lower()
+        if format not in ledger.FORMATS:
+            raise CommandError('Unknown format, pass --format %s' % ' or --format '.join(ledger.FORMATS))
+        batch_size = options['batch_size'] or settings.LEDGER_IMPORT_BATCH_SIZE
+        self.verbosity = options['verbosity']
+
+        self.checkpoint_path = options['checkpoint']
+        self.progress = {'records': 0, 'items': 0, 'transactions': 0, 'rejected': 0}
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as checkpoint:
+                self.progress.update(json.load(checkpoint))
+            self.stdout.write('Resuming after %d records' % self.progress['records'])
+
+        if options['defer_indexes']:
+            for using in settings.DATABASE_SHARDS:
+                ledger.drop_indexes(using)
+        try:
+            with open(path, newline='') as stream:
+                if format == 'csv':
+                    if 'item_id' not in next(csv.reader([stream.readline()]), []):
+                        raise CommandError('The CSV file has no item_id column')
+                    stream.seek(0)
+                records = itertools.islice(
+                    ledger.read_records(stream, format), self.progress['records'], None
+                )
+                batches = iter(lambda: list(itertools.islice(records, batch_size)), [])
+                self.run(batches, format, options['workers'])
+        finally:
+            if options['defer_indexes']:
+                start = time.perf_counter()
+                for using in settings.DATABASE_SHARDS:
+                    ledger.create_indexes(using)
+                self.stdout.write('Rebuilt indexes in %.1fs' % (time.perf_counter() - start))
+
+        self.stdout.write(
+            'Imported %(items)d items and %(transactions)d transactions, '
+            'rejected %(rejected)d records' % self.progress
+        )
+
+    def run(self, batches, format, workers):
+        start = time.perf_counter()
+        rows = 0
+        # the first batch may have been written by an interrupted run
+        skip_existing = bool(self.checkpoint_path)
+        for size, (items, transactions, errors) in self.validated(batches, format, workers):
+            for line_no, error in errors:
+                if self.verbosity > 1:
+                    self.stderr.write('Line %d: %s' % (line_no, error))
+            try:
+                inserted = ledger.insert_batch(items, transactions, skip_existing)
+            except IntegrityError as exc:
+                raise CommandError(
+                    'Import stopped after %d records: %s' % (self.progress['records'], exc)
+                )
+            skip_existing = False
+
+            self.progress['records'] += size
+            self.progress['items'] += inserted[0]
+            self.progress['transactions'] += inserted[1]
+            self.progress['rejected'] += len(errors)
+            self.save_checkpoint()
+
+            rows += sum(inserted)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                '%d items, %d transactions, %.0f rows/s' % (
+                    self.progress['items'], self.progress['transactions'], rows / elapsed
+                )
+            )
+
+    def validated(self, batches, format, workers):
+        """
+        Yields (batch size, validate_batch result) in input order, validating
+        on a pool of worker processes when workers is set, with at most two
+        batches per worker in flight.
+        """
+        if not workers:
+            for batch in batches:
+                yield len(batch), ledger.validate_batch(batch, format)
+            return
+
+        # forked workers must not share the database connections
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            pending = collections.deque()
+            for batch in batches:
+                pending.append((len(batch), pool.apply_async(ledger.validate_batch, (batch, format))))
+                if len(pending) >= 2 * workers:
+                    size, result = pending.popleft()
+                    yield size, result.get()
+            while pending:
+                size, result = pending.popleft()
+                yield size, result.get()
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        tmp_path = '%s.tmp' % self.checkpoint_path
+        with open(tmp_path, 'w') as checkpoint:
+            json.dump(self.progress, checkpoint)
+        os.replace(tmp_path, self.checkpoint_path)
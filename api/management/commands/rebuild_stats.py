@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api import stats
+from api.models import StatCounter
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the summary counters of GET /api/stats from the item and '
+        'transaction tables, and reports the counters that had drifted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report the drift, leave the counters as they are.'
+        )
+
+    def handle(self, *args, **options):
+        drifted = 0
+        for using in settings.DATABASE_SHARDS:
+            with transaction.atomic(using=using):
+                actual = stats.count_rows(using)
+                counted = stats.read_counters([StatCounter.objects.using(using)])
+                for kind, key in sorted(set(actual) | set(counted)):
+                    expected = actual.get((kind, key), (0, 0))
+                    found = counted.get((kind, key), (0, 0))
+                    if found != expected:
+                        drifted += 1
+                        self.stdout.write(
+                            '%s: %s %s counted %d (%s), actually %d (%s)' % (
+                                using, kind, key,
+                                found[0], stats.format_cents(found[1]),
+                                expected[0], stats.format_cents(expected[1]),
+                            )
+                        )
+                if not options['dry_run']:
+                    stats.reset(using, actual)
+        action = 'Found' if options['dry_run'] else 'Rebuilt counters, fixed'
+        self.stdout.write('%s %d drifted counters' % (action, drifted))
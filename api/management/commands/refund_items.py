@@ -0,0 +1,55 @@
+import uuid
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import batch, shards
+from api.models import Item
+
+
+class Command(BaseCommand):
+    help = (
+        'Refunds items whose active transaction errored. Items are read from '
+        '--ids-file, one id per line, or else selected by state.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ids-file', help='File with one item id per line.')
+        parser.add_argument(
+            '--state', 
+            default=Item.ERROR, 
+            choices=[choice for choice, _ in Item.STATE_CHOICES],
+            help='State of the items to refund when no ids file is given.'
+        )
+
+    def read_ids(self, path):
+        ids = []
+        with open(path) as stream:
+            for line_no, line in enumerate(stream, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    ids.append(uuid.UUID(line))
+                except ValueError:
+                    raise CommandError('Invalid item id on line %d: %s' % (line_no, line))
+        return ids
+
+    def handle(self, *args, **options):
+        if options['ids_file']:
+            item_ids = self.read_ids(options['ids_file'])
+        else:
+            item_ids = [
+                pk
+                for queryset in shards.across(Item.objects.filter(state=options['state']))
+                for pk in queryset.values_list('pk', flat=True)
+            ]
+
+        refunded, skipped = batch.refund_items(item_ids)
+
+        self.stdout.write('Refunded %d items, skipped %d' % (len(refunded), len(skipped)))
+        for reason, count in Counter(skipped.values()).most_common():
+            self.stdout.write('  %d: %s' % (count, reason))
+        if options['verbosity'] > 1:
+            for item_id, reason in skipped.items():
+                self.stdout.write('  %s: %s' % (item_id, reason))
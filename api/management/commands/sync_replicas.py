@@ -0,0 +1,47 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def copy_database(path):
+    """
+    Copies the primary SQLite database into the file at path, with SQLite's
+    online backup, so the primary stays writable while it is copied.
+    """
+    primary = connections[DEFAULT_DB_ALIAS]
+    primary.ensure_connection()
+    replica = sqlite3.connect(path)
+    try:
+        primary.connection.backup(replica)
+    finally:
+        replica.close()
+
+
+class Command(BaseCommand):
+    help = 'Copies the primary SQLite database into the files of the DATABASE_REPLICAS.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--interval', type=float,
+            help='Copy again every INTERVAL seconds, until interrupted.'
+        )
+
+    def handle(self, *args, **options):
+        if connections[DEFAULT_DB_ALIAS].vendor != 'sqlite':
+            raise CommandError('Replicas of other databases are kept in sync by the database.')
+
+        primary_name = settings.DATABASES[DEFAULT_DB_ALIAS]['NAME']
+        paths = [
+            settings.DATABASES[alias]['NAME'] for alias in settings.DATABASE_REPLICAS
+            if settings.DATABASES[alias]['NAME'] != primary_name
+        ]
+        while True:
+            for path in paths:
+                copy_database(path)
+            self.stdout.write('Synced %d replicas' % len(paths))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,262 @@
+"""
+In-process metrics registry, exposed at /metrics in the Prometheus text format.
+
+Updates only touch a dict under a lock. With METRICS_DIR set, every worker
+process also writes a snapshot of its values to its own file in that
+directory, at most every METRICS_FLUSH_INTERVAL seconds and when it exits,
+and /metrics sums the snapshots of all processes. Files of processes that
+exited are kept so counters never go backwards; empty the directory when
+(re)starting the server.
+"""
+import atexit
+import glob
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import transaction
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self.values = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.next_flush = 0.0
+        # pids are reused, so a new process never overwrites an old snapshot
+        self.file_name = '%s-%s.json' % (os.getpid(), uuid.uuid4().hex)
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        self.values[metric.name] = {}
+
+    def update(self, name, labels, update):
+        with self.lock:
+            series = self.values[name]
+            series[labels] = update(series.get(labels))
+            flush = settings.METRICS_DIR and time.monotonic() >= self.next_flush
+            if flush:
+                self.next_flush = time.monotonic() + settings.METRICS_FLUSH_INTERVAL
+        if flush:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name: [
+                    [list(labels), list(value) if isinstance(value, list) else value]
+                    for labels, value in series.items()
+                ]
+                for name, series in self.values.items()
+            }
+
+    def flush(self):
+        """
+        Writes this process's values to its file in METRICS_DIR.
+        """
+        with self.flush_lock:
+            os.makedirs(settings.METRICS_DIR, exist_ok=True)
+            path = os.path.join(settings.METRICS_DIR, self.file_name)
+            tmp_path = '%s.tmp' % path
+            with open(tmp_path, 'w') as tmp:
+                json.dump(self.snapshot(), tmp)
+            os.replace(tmp_path, path)
+
+    def collect(self):
+        """
+        Returns {name: {labels: value}} summed over this process and, with
+        METRICS_DIR set, the snapshots of every other process.
+        """
+        snapshots = [self.snapshot()]
+        if settings.METRICS_DIR:
+            own = os.path.join(settings.METRICS_DIR, self.file_name)
+            for path in glob.glob(os.path.join(settings.METRICS_DIR, '*.json')):
+                if path == own:
+                    continue
+                try:
+                    with open(path) as snapshot:
+                        snapshots.append(json.load(snapshot))
+                except (OSError, ValueError):
+                    # removed, or a process wrote it without the rename
+                    continue
+
+        totals = {name: {} for name in self.metrics}
+        for snapshot in snapshots:
+            for name, series in snapshot.items():
+                if name not in self.metrics:
+                    continue
+                merge = self.metrics[name].merge
+                for labels, value in series:
+                    labels = tuple(labels)
+                    totals[name][labels] = merge(totals[name].get(labels), value)
+        return totals
+
+    def render(self):
+        lines = []
+        for name, series in self.collect().items():
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.documentation))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+            for labels, value in sorted(series.items()):
+                lines.extend(metric.render(dict(zip(metric.labelnames, labels)), value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in labels.items()
+    )
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        registry.register(self)
+
+    def _labels(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self.registry.update(self.name, self._labels(labels), lambda value: (value or 0) + amount)
+
+    def merge(self, total, value):
+        return (total or 0) + value
+
+    def render(self, labels, value):
+        return ['%s%s %s' % (self.name, _format_labels(labels), _format_value(value))]
+
+
+class Histogram(Metric):
+    """
+    Values are [count per bucket..., count above the last bucket, sum].
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, amount, **labels):
+        index = next(
+            (i for i, bound in enumerate(self.buckets) if amount <= bound), len(self.buckets)
+        )
+
+        def update(value):
+            value = value or [0] * (len(self.buckets) + 2)
+            value[index] += 1
+            value[-1] += amount
+            return value
+
+        self.registry.update(self.name, self._labels(labels), update)
+
+    def merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def render(self, labels, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf, ), value[:-1]):
+            cumulative += count
+            bucket_labels = dict(labels, le=_format_value(bound))
+            lines.append('%s_bucket%s %s' % (self.name, _format_labels(bucket_labels), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(labels), _format_value(value[-1])))
+        lines.append('%s_count%s %s' % (self.name, _format_labels(labels), cumulative))
+        return lines
+
+
+REQUEST_DURATION = Histogram(
+    'routable_request_duration_seconds',
+    'Time spent serving requests, by view and method.',
+    ('view', 'method')
+)
+REJECTIONS = Counter(
+    'routable_rejections_total',
+    'Requests answered with a 4xx status, by view, status and reason.',
+    ('view', 'status', 'reason')
+)
+DB_QUERY_DURATION = Histogram(
+    'routable_db_query_duration_seconds',
+    'Time spent in SQL queries per request, by view.',
+    ('view', )
+)
+DB_QUERIES = Counter(
+    'routable_db_queries_total',
+    'SQL queries run, by view.',
+    ('view', )
+)
+TRANSITIONS = Counter(
+    'routable_transitions_total',
+    'Committed transaction transitions, by previous status, new status and new location.',
+    ('from_status', 'to_status', 'location')
+)
+ITEM_CACHE_LOOKUPS = Counter(
+    'routable_item_cache_lookups_total',
+    'Lookups of the item detail cache, by outcome (hit or miss).',
+    ('outcome', )
+)
+
+# a 4xx body that is not one of the views' messages, e.g. serializer errors
+INVALID_REQUEST = 'Invalid request'
+
+
+def record_transition(from_status, to_status, location, count=1, using=None):
+    """
+    Counts count transitions once the current transaction of database
+    using commits.
+    """
+    transaction.on_commit(lambda: TRANSITIONS.inc(
+        count, from_status=from_status, to_status=to_status, location=location
+    ), using=using)
+
+
+def record_response(view, request, response, duration, query_stats=None):
+    REQUEST_DURATION.observe(duration, view=view, method=request.method)
+    if 400 <= response.status_code < 500:
+        reason = getattr(response, 'data', None)
+        REJECTIONS.inc(
+            view=view,
+            status=response.status_code,
+            reason=reason if isinstance(reason, str) else INVALID_REQUEST
+        )
+    if query_stats is not None:
+        DB_QUERY_DURATION.observe(query_stats.duration, view=view)
+        DB_QUERIES.inc(query_stats.count, view=view)
+
+
+@atexit.register
+def _flush_at_exit():
+    if settings.configured and settings.METRICS_DIR:
+        REGISTRY.flush()
@@ -0,0 +1,40 @@
+# Generated by Django 3.0.7 on 2026-10-18 17:23
+
+from django.db import migrations, models
+
+
+def deactivate_duplicate_active_transactions(apps, schema_editor):
+    """
+    Keeps only the most recent active transaction of each item active,
+    so the unique constraint below can be created.
+    """
+    Transaction = apps.get_model('api', 'Transaction')
+    seen = set()
+    active = Transaction.objects.filter(is_active=True).order_by('item_id', '-created_at')
+    for trans_id, item_id in active.values_list('id', 'item_id').iterator():
+        if item_id in seen:
+            Transaction.objects.filter(pk=trans_id).update(is_active=False)
+        seen.add(item_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_auto_20200514_1839'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['state', 'created_at'], name='item_state_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['item', 'is_active', 'status'], name='trans_item_active_status_idx'),
+        ),
+        migrations.RunPython(deactivate_duplicate_active_transactions, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(condition=models.Q(is_active=True), fields=('item',), name='unique_active_transaction'),
+        ),
+    ]
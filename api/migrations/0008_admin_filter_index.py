@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-18 17:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['status', 'location', 'created_at'], name='trans_status_location_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 3.0.7 on 2026-10-18 18:16
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def count_existing_rows(apps, schema_editor):
+    """
+    Starts the counters from the rows already stored, see api/stats.py.
+    """
+    using = schema_editor.connection.alias
+    StatCounter = apps.get_model('api', 'StatCounter')
+    totals = {}
+    for name in ('Item', 'ArchivedItem'):
+        rows = apps.get_model('api', name).objects.using(using).order_by().values('state')
+        for row in rows.annotate(count=Count('pk'), total=Sum('amount')):
+            total = totals.setdefault(('item', row['state']), [0, 0])
+            total[0] += row['count']
+            total[1] += int(Decimal(str(row['total'] or 0)).scaleb(2))
+    for name in ('Transaction', 'ArchivedTransaction'):
+        rows = apps.get_model('api', name).objects.using(using).order_by().values('status', 'location')
+        for row in rows.annotate(count=Count('pk')):
+            key = '%s:%s' % (row['status'], row['location'])
+            totals.setdefault(('transaction', key), [0, 0])[0] += row['count']
+    StatCounter.objects.using(using).bulk_create([
+        StatCounter(kind=kind, key=key, slot=0, count=count, amount_cents=amount)
+        for (kind, key), (count, amount) in totals.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('item', 'Item'), ('transaction', 'Transaction')], max_length=16)),
+                ('key', models.CharField(max_length=80)),
+                ('slot', models.PositiveSmallIntegerField()),
+                ('count', models.BigIntegerField(default=0)),
+                ('amount_cents', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='statcounter',
+            constraint=models.UniqueConstraint(fields=('kind', 'key', 'slot'), name='unique_stat_counter_slot'),
+        ),
+        migrations.RunPython(count_existing_rows, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.0.7 on 2026-10-18 18:22
+
+import api.ids
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_stat_counter'),
+    ]
+
+    # the default is applied by Django, not the database: only the state
+    # changes, where an AlterField would rebuild both SQLite tables
+    operations = [
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.AlterField(
+                model_name='item',
+                name='id',
+                field=models.UUIDField(default=api.ids.uuid7, editable=False, primary_key=True, serialize=False),
+            ),
+            migrations.AlterField(
+                model_name='transaction',
+                name='id',
+                field=models.UUIDField(default=api.ids.uuid7, editable=False, primary_key=True, serialize=False),
+            ),
+        ]),
+    ]
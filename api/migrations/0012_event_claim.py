@@ -0,0 +1,26 @@
+# Generated by Django 3.0.7 on 2026-10-18 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_time_ordered_ids'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='event',
+            name='event_pending_idx',
+        ),
+        migrations.AddField(
+            model_name='event',
+            name='lease_token',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='event',
+            index=models.Index(condition=models.Q(('attempts__lt', 10), ('delivered_at__isnull', True)), fields=['next_attempt_at'], name='event_pending_idx'),
+        ),
+    ]
@@ -1,6 +1,34 @@
-import uuid
+import json
 
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, router, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from api import ids, item_cache, metrics, shards
+
+
+class TransitionConflict(Exception):
+    """
+    Raised when a row is no longer in the state a transition was computed from,
+    i.e another request changed it first.
+    """
+
+
+class ShardedQuerySet(models.QuerySet):
+    """
+    Creates rows on the shard of their item, see api/shards.py, unless a
+    database was picked with using().
+    """
+
+    def create(self, **kwargs):
+        if self._db is not None:
+            return super().create(**kwargs)
+        obj = self.model(**kwargs)
+        self._for_write = True
+        # without using, save() asks the router with the instance as hint
+        obj.save(force_insert=True)
+        return obj
 
 
 class Item(models.Model):
@@ -13,32 +41,85 @@ class Item(models.Model):
         (RESOLVED, 'resolved')
     )
 
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=ids.uuid7, editable=False)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     state = models.CharField(max_length=32, choices=STATE_CHOICES, default=PROCESSING)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ShardedQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        from api import stats
+        using = kwargs.get('using') or router.db_for_write(Item, instance=self)
+        changes = stats.Changes()
+        adding = self._state.adding
+        with transaction.atomic(using=using, savepoint=False):
+            if not adding:
+                changes.remove(items=Item.objects.using(using).filter(pk=self.pk))
+            super(Item, self).save(*args, **kwargs)
+            changes.add_items(self.state, 1, self.amount)
+            changes.save(using)
+            if not adding:
+                # e.g. the state edited in the admin
+                item_cache.invalidate([self.pk], using=using)
+
+    def delete(self, using=None, keep_parents=False):
+        from api import stats
+        using = using or router.db_for_write(Item, instance=self)
+        changes = stats.Changes()
+        with transaction.atomic(using=using, savepoint=False):
+            changes.remove(
+                items=Item.objects.using(using).filter(pk=self.pk),
+                transactions=Transaction.objects.using(using).filter(item_id=self.pk)
+            )
+            deleted = super(Item, self).delete(using=using, keep_parents=keep_parents)
+            changes.save(using)
+            item_cache.invalidate([self.pk], using=using)
+        return deleted
+
     def get_new_item_state(self, trans_status):
         """
         Returns the next possible item state
         """
-        if trans_status == Transaction.PROCESSING:
-            return self.PROCESSING
-        elif trans_status == Transaction.ERROR:
-            return self.ERROR
-        elif trans_status in [Transaction.COMPLETED, Transaction.REFUNDED]:
-            return self.RESOLVED
-        elif trans_status in [Transaction.REFUNDING, Transaction.FIXING]:
-            return self.CORRECTING
+        from api import state_machine
+        return state_machine.get_item_state(trans_status)
 
     def update_item_state(self, trans_status):
-        new_state = self.get_new_item_state(trans_status)
-        self.state = new_state
-        self.save()
+        """
+        Writes only the state and updated_at columns of the item, and records
+        the change in the event outbox and the summary counters in the same
+        database transaction.
+        """
+        from api import stats
+        using = router.db_for_write(Item, instance=self)
+        changes = stats.Changes()
+        with transaction.atomic(using=using, savepoint=False):
+            self.write_item_state(trans_status, using, changes).save(using=using)
+            changes.save(using)
+
+    def write_item_state(self, trans_status, using, changes):
+        """
+        Writes only the state and updated_at columns of the item, inside a
+        database transaction of using, and adds the change to the counter
+        changes. Returns the unsaved outbox event of the change.
+        """
+        from_state = self.state
+        self.state = self.get_new_item_state(trans_status)
+        self.updated_at = timezone.now()
+        changes.move_items(from_state, self.state, 1, self.amount)
+        Item.objects.using(using).filter(pk=self.pk).update(
+            state=self.state, updated_at=self.updated_at
+        )
+        item_cache.invalidate([self.pk], using=using)
+        return Event.for_item(self.pk, self.state)
 
     class Meta:
         ordering = ('-created_at', )
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='item_created_id_idx'),
+            models.Index(fields=['state', 'created_at', 'id'], name='item_state_created_id_idx'),
+        ]
 
 
 class Transaction(models.Model):
@@ -66,7 +147,7 @@ class Transaction(models.Model):
 	    (DESTINATION, 'Destination Bank'),
     )
 
-    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    id = models.UUIDField(primary_key=True, default=ids.uuid7, editable=False)
     item = models.ForeignKey(Item, on_delete=models.CASCADE)
     status = models.CharField(max_length=32, choices=STATUS_CHOICES, default=PROCESSING)
     location = models.CharField(max_length=32, choices=LOCATION_CHOICES, default=ORIGIN)
@@ -74,40 +155,291 @@ class Transaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ShardedQuerySet.as_manager()
 
     def save(self, *args, **kwargs):
+        from api import state_machine, stats
         # Sets transaction to Inactive when its' status is completed
-        if self.status in [self.COMPLETED, self.REFUNDED]:
+        if not state_machine.is_active(self.status):
             self.is_active = False
-        super(Transaction, self).save(*args, **kwargs)
+        using = kwargs.get('using') or router.db_for_write(Transaction, instance=self)
+        changes = stats.Changes()
+        with transaction.atomic(using=using, savepoint=False):
+            if not self._state.adding:
+                changes.remove(transactions=Transaction.objects.using(using).filter(pk=self.pk))
+            super(Transaction, self).save(*args, **kwargs)
+            Event.for_transaction(self).save(using=using)
+            changes.add_transactions(self.status, self.location)
+            changes.save(using)
+            item_cache.invalidate([self.item_id], using=using)
+
+    def delete(self, using=None, keep_parents=False):
+        from api import stats
+        using = using or router.db_for_write(Transaction, instance=self)
+        changes = stats.Changes()
+        with transaction.atomic(using=using, savepoint=False):
+            changes.remove(transactions=Transaction.objects.using(using).filter(pk=self.pk))
+            deleted = super(Transaction, self).delete(using=using, keep_parents=keep_parents)
+            changes.save(using)
+            item_cache.invalidate([self.item_id], using=using)
+        return deleted
 
     def get_new_transaction_state(self):
         """
-        Returns the next possible status and location of a transaction
+        Returns the next possible status and location of a transaction.
+        Raises InvalidTransition when the transaction can not be moved.
         """
-        status, location = self.status, self.location
+        from api import state_machine
+        return state_machine.get_transition(state_machine.MOVES, self.status, self.location)
 
-        if status == self.PROCESSING and location == self.ORIGIN:
-            return self.PROCESSING, self.ROUTABLE
-        elif status == self.PROCESSING  and location == self.ROUTABLE:
-            return self.COMPLETED, self.DESTINATION
-        elif status == self.FIXING and location == self.ROUTABLE:
-            return self.PROCESSING, self.ROUTABLE
-        elif status == self.REFUNDING and location == self.ROUTABLE:
-            return self.REFUNDED, self.ORIGIN
+    def compare_and_swap(self, item=None, **values):
+        """
+        Writes values with a single UPDATE, guarded on the row still having the
+        status, location and is_active last read into this instance. When
+        item is given its state follows the new status, written in the same
+        database transaction with a single write of the events and counters.
+        Raises TransitionConflict when another request changed the row first.
+        """
+        from api import stats
+        values['updated_at'] = timezone.now()
+        from_status = self.status
+        changes = stats.Changes()
+        changes.move_transactions(
+            (self.status, self.location),
+            (values.get('status', self.status), values.get('location', self.location))
+        )
+        using = router.db_for_write(Transaction, instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            updated = Transaction.objects.using(using).filter(
+                pk=self.pk,
+                status=self.status,
+                location=self.location,
+                is_active=self.is_active
+            ).update(**values)
+            if updated:
+                for field, value in values.items():
+                    setattr(self, field, value)
+                events = [Event.for_transaction(self)]
+                if item is not None:
+                    events.append(item.write_item_state(self.status, using, changes))
+                Event.objects.using(using).bulk_create(events)
+                changes.save(using)
+        if not updated:
+            raise TransitionConflict
+        if 'status' in values:
+            metrics.record_transition(from_status, self.status, self.location, using=using)
 
     def deactivate_transaction(self):
-        self.is_active = False
-        self.save()
+        self.compare_and_swap(is_active=False)
+
+    def replace_transaction(self, new_status, new_location):
+        """
+        Deactivates the transaction and creates the one replacing it at
+        new_status and new_location. Returns the new transaction.
+        Raises TransitionConflict when another request changed the row first.
+        """
+        self.deactivate_transaction()
+        replacement = Transaction.objects.create(
+            item_id=self.item_id,
+            status=new_status,
+            location=new_location
+        )
+        metrics.record_transition(
+            self.status, new_status, new_location, using=replacement._state.db
+        )
+        return replacement
 
-    def error_transaction(self):
-        self.status = Transaction.ERROR
-        self.save()
+    def error_transaction(self, item=None):
+        from api import state_machine
+        new_status, new_location = state_machine.get_transition(
+            state_machine.ERRORS, self.status, self.location
+        )
+        self.compare_and_swap(item, status=new_status, location=new_location)
     
-    def move_transaction(self, new_status, new_location):
-        self.status = new_status
-        self.location = new_location
-        self.save()
+    def move_transaction(self, new_status, new_location, item=None):
+        from api import state_machine
+        self.compare_and_swap(
+            item,
+            status=new_status,
+            location=new_location,
+            is_active=state_machine.is_active(new_status)
+        )
+
+    @classmethod
+    def get_create_block_reason(cls, item_pk):
+        """
+        Returns why a new transaction can not be created for the item, or None.
+        All three rules are checked with one aggregate over the
+        (item, is_active, status) index of the item's shard.
+        """
+        counts = cls.objects.using(shards.for_item(item_pk)).filter(item_id=item_pk).aggregate(
+            active=Count('pk', filter=Q(is_active=True)),
+            completed=Count('pk', filter=Q(status=cls.COMPLETED)),
+            refunded=Count('pk', filter=Q(status=cls.REFUNDED)),
+        )
+        if counts['active']:
+            return 'There is an active transaction for this item'
+        elif counts['completed']:
+            return 'Item transaction completed'
+        elif counts['refunded']:
+            return 'Item transaction refunded'
 
     class Meta:
         ordering = ('-created_at',)
+        indexes = [
+            models.Index(fields=['item', 'is_active', 'status'], name='trans_item_active_status_idx'),
+            models.Index(fields=['item', 'created_at', 'id'], name='trans_item_created_id_idx'),
+            models.Index(fields=['status', 'location', 'created_at'], name='trans_status_location_idx'),
+        ]
+        constraints = [
+            # an item can have at most one active transaction
+            models.UniqueConstraint(
+                fields=['item'],
+                condition=Q(is_active=True),
+                name='unique_active_transaction'
+            ),
+        ]
+
+
+class ArchivedItem(models.Model):
+    """
+    Resolved item moved out of the Item table by the archive command, see
+    api/archive.py. It keeps the item's id and timestamps.
+    """
+
+    id = models.UUIDField(primary_key=True, editable=False)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    state = models.CharField(max_length=32, choices=Item.STATE_CHOICES)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('-created_at', )
+
+
+class ArchivedTransaction(models.Model):
+    """
+    Transaction of an ArchivedItem, moved out of the Transaction table with it.
+    """
+
+    id = models.UUIDField(primary_key=True, editable=False)
+    item = models.ForeignKey(ArchivedItem, on_delete=models.CASCADE)
+    status = models.CharField(max_length=32, choices=Transaction.STATUS_CHOICES)
+    location = models.CharField(max_length=32, choices=Transaction.LOCATION_CHOICES)
+    is_active = models.BooleanField(default=False)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ('-created_at', )
+        indexes = [
+            models.Index(fields=['item', 'created_at', 'id'], name='archived_trans_item_idx'),
+        ]
+
+
+class StatCounter(models.Model):
+    """
+    One slot of a summary counter of items in a state, or of transactions
+    in a "status:location", see api/stats.py.
+    """
+
+    ITEM, TRANSACTION = ('item', 'transaction')
+    KIND_CHOICES = (
+        (ITEM, 'Item'),
+        (TRANSACTION, 'Transaction'),
+    )
+
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    key = models.CharField(max_length=80)
+    slot = models.PositiveSmallIntegerField()
+    count = models.BigIntegerField(default=0)
+    amount_cents = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'key', 'slot'], name='unique_stat_counter_slot'),
+        ]
+
+
+# Delivery attempts of an event, after which it is no longer retried. Part of
+# the pending events index, so changing it needs a migration.
+EVENT_MAX_ATTEMPTS = 10
+
+
+class Event(models.Model):
+    """
+    Outbox of item and transaction changes, written in the same database
+    transaction as the change and delivered to the webhook by the
+    dispatch_events command.
+    """
+
+    ITEM_STATE_CHANGED = 'item.state_changed'
+    TRANSACTION_CHANGED = 'transaction.changed'
+    TYPE_CHOICES = (
+        (ITEM_STATE_CHANGED, 'Item state changed'),
+        (TRANSACTION_CHANGED, 'Transaction changed'),
+    )
+
+    type = models.CharField(max_length=32, choices=TYPE_CHOICES)
+    payload = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # set by the dispatcher that last claimed the event, see api/events.py
+    lease_token = models.UUIDField(null=True, blank=True, editable=False)
+
+    @classmethod
+    def build(cls, type, **data):
+        return cls(type=type, payload=json.dumps(data, cls=DjangoJSONEncoder))
+
+    @classmethod
+    def for_item(cls, item_id, state):
+        return cls.build(cls.ITEM_STATE_CHANGED, item=item_id, state=state)
+
+    @classmethod
+    def for_transaction(cls, trans):
+        return cls.build(
+            cls.TRANSACTION_CHANGED,
+            transaction=trans.pk,
+            item=trans.item_id,
+            status=trans.status,
+            location=trans.location,
+            is_active=trans.is_active
+        )
+
+    class Meta:
+        ordering = ('id',)
+        indexes = [
+            # only undelivered events with attempts left are ever polled
+            models.Index(
+                fields=['next_attempt_at'],
+                condition=Q(delivered_at__isnull=True, attempts__lt=EVENT_MAX_ATTEMPTS),
+                name='event_pending_idx'
+            ),
+        ]
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response stored for an Idempotency-Key header, replayed to retries of the
+    same request until it expires. A row without status_code belongs to a
+    request still in progress, which holds it for IDEMPOTENCY_LEASE seconds
+    from claimed_at.
+    """
+
+    key = models.CharField(max_length=255)
+    path = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    body = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    claimed_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['key', 'path'], name='unique_idempotency_key'),
+        ]
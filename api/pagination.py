@@ -0,0 +1,127 @@
+import base64
+import binascii
+import heapq
+import uuid
+from collections import OrderedDict
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from api import shards
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginates on ('-created_at', '-id'), or on '-id' alone with
+    KEYSET_PAGINATION_ON_ID, with an opaque cursor holding the position of
+    the last row of the previous page.
+    Each page is a range scan on the ordering index, so page N costs the
+    same as page 1: there is no OFFSET and no COUNT(*).
+    """
+    page_size = 50
+    max_page_size = 500
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_querysets([queryset], request, view)
+
+    def paginate_querysets(self, querysets, request, view=None):
+        """
+        Paginates the rows of several querysets, e.g. of every shard, as one:
+        each one reads a page and the pages are merged.
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+
+        keyset = self.get_keyset()
+        pages = []
+        for queryset in querysets:
+            queryset = queryset.order_by(*['-' + field for field in keyset])
+            if position:
+                queryset = queryset.filter(self.get_after_filter(keyset, position))
+            # one extra row tells whether there is a next page
+            pages.append(queryset[:page_size + 1])
+
+        def key(row):
+            return tuple(getattr(row, field) for field in keyset)
+
+        rows = shards.fan_out(list, pages)
+        if len(rows) == 1:
+            rows = rows[0]
+        else:
+            rows = list(islice(heapq.merge(*rows, key=key, reverse=True), page_size + 1))
+        self.next_position = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            self.next_position = key(rows[-1])
+        return rows
+
+    def get_keyset(self):
+        """
+        Returns the fields pages are ordered on, newest first. Time-ordered
+        ids (see api/ids.py) sort by creation on their own.
+        """
+        if settings.KEYSET_PAGINATION_ON_ID:
+            return ('id', )
+        return ('created_at', 'id')
+
+    def get_after_filter(self, keyset, position):
+        """
+        Returns the filter of the rows ordered after position.
+        """
+        after = Q()
+        for index, field in enumerate(keyset):
+            equal = dict(zip(keyset[:index], position[:index]))
+            after |= Q(**equal, **{field + '__lt': position[index]})
+        return after
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            decoded = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            *created_at, pk = decoded.split('|')
+            position = (uuid.UUID(pk), )
+            if created_at:
+                position = (parse_datetime(*created_at), ) + position
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        # cursors of the other keyset, e.g. from before a settings change,
+        # point nowhere
+        if None in position or len(position) != len(self.get_keyset()):
+            raise NotFound(self.invalid_cursor_message)
+        return position
+
+    def encode_cursor(self, position):
+        *created_at, pk = position
+        raw = '|'.join([value.isoformat() for value in created_at] + [str(pk)])
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
@@ -0,0 +1,69 @@
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import OperationalError, connections
+from django.utils.functional import cached_property
+
+
+def estimate_count(model, using='default'):
+    """
+    Returns the database's estimate of the number of rows of model's table,
+    or None when the backend has none.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                'SELECT table_rows FROM information_schema.tables '
+                'WHERE table_schema = DATABASE() AND table_name = %s',
+                [table]
+            )
+        elif connection.vendor == 'sqlite':
+            # the row count of the last ANALYZE, see refresh_estimates; a
+            # stat is "<rows> <rows per key>..."
+            try:
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+            except OperationalError:
+                # never analyzed
+                return None
+            row = cursor.fetchone()
+            return int(row[0].split()[0]) if row else None
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+def refresh_estimates(models, using='default'):
+    """
+    Updates the size estimates of the tables of models after many rows were
+    added or deleted. Other databases keep theirs up to date, SQLite's are
+    only gathered by ANALYZE, which reads the tables.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for model in models:
+            cursor.execute('ANALYZE %s' % connection.ops.quote_name(model._meta.db_table))
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator using the table size estimate instead of COUNT(*) for
+    unfiltered querysets over large tables, where an exact count means a
+    full scan.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_count(queryset.model, queryset.db)
+            if estimate is not None and estimate >= settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
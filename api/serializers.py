@@ -1,17 +1,203 @@
-from rest_framework import serializers
+import copy
+import decimal
+from collections import OrderedDict
 
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
+from django.utils.functional import cached_property
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+
+from api import shards
 from api.models import Item, Transaction
 
 
-class ItemSerializer(serializers.ModelSerializer):
+class ItemListSerializer(serializers.ListSerializer):
+    """
+    Validates a batch of items row by row, so one bad row does not fail
+    the whole batch.
+    """
+
+    def partition(self):
+        """
+        Returns a list of (index, validated_data) for the valid rows and a
+        list of (index, errors) for the invalid ones, in input order.
+        """
+        data = self.initial_data
+        if not isinstance(data, list):
+            raise serializers.ValidationError('Expected a list of items')
+
+        valid, invalid = [], []
+        for index, row in enumerate(data):
+            try:
+                valid.append((index, self.child.run_validation(row)))
+            except serializers.ValidationError as exc:
+                invalid.append((index, exc.detail))
+        return valid, invalid
+
+
+def _get_converter(field):
+    """
+    Returns a function of (attribute, current timezone) making the output of
+    field from a non null attribute, as field.to_representation does, or
+    None for the field to make it.
+    """
+    if isinstance(field, serializers.PrimaryKeyRelatedField):
+        # the key read from the foreign key column, as with the pk only
+        # optimization
+        return (lambda value, tz: value) if field.pk_field is None else None
+    if isinstance(field, serializers.UUIDField) and field.uuid_format == 'hex_verbose':
+        return lambda value, tz: str(value)
+    if isinstance(field, serializers.DecimalField):
+        coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+        if not coerce_to_string or field.localize or field.decimal_places is None:
+            return None
+        quantum = decimal.Decimal('.1') ** field.decimal_places
+        context = decimal.Context(prec=field.max_digits) if field.max_digits else None
+
+        def convert(value, tz):
+            if not isinstance(value, decimal.Decimal):
+                value = decimal.Decimal(str(value).strip())
+            return '{:f}'.format(value.quantize(quantum, rounding=field.rounding, context=context))
+        return convert
+    if isinstance(field, serializers.DateTimeField):
+        output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+        if output_format is None or output_format.lower() != ISO_8601 or hasattr(field, 'timezone'):
+            return None
+
+        def convert(value, tz):
+            if tz is not None and timezone.is_aware(value):
+                value = value.astimezone(tz)
+            else:
+                value = field.enforce_timezone(value)
+            value = value.isoformat()
+            return value[:-6] + 'Z' if value.endswith('+00:00') else value
+        return convert
+    if isinstance(field, serializers.ChoiceField):
+        choices = field.choice_strings_to_values
+        return lambda value, tz: choices.get(str(value), value)
+    if isinstance(field, serializers.BooleanField):
+        return lambda value, tz: bool(value)
+    return None
+
+
+class FastModelSerializer(serializers.ModelSerializer):
+    """
+    ModelSerializer introspecting its model once per class instead of once
+    per instance, for the serializers of the hot endpoints.
+
+    The first instance builds the fields and validators, the next ones get
+    shallow copies of them. Output is a dict built from the instance's
+    attributes by a converter picked ahead for each field, giving what the
+    field's to_representation gives; fields without one make their own.
+    """
+
+    def get_fields(self):
+        cls = type(self)
+        if '_field_templates' not in cls.__dict__:
+            cls._field_templates = super().get_fields()
+        # the templates are never bound, and fields do not change their
+        # arguments, which the copies share
+        return OrderedDict((name, copy.copy(field)) for name, field in cls._field_templates.items())
+
+    def get_validators(self):
+        cls = type(self)
+        if '_validator_templates' not in cls.__dict__:
+            cls._validator_templates = super().get_validators()
+        return list(cls._validator_templates)
+
+    def get_output_fields(self):
+        """
+        Returns (field name, attribute, converter) for the readable fields,
+        attribute and converter None for fields making their own output.
+        """
+        cls = type(self)
+        if '_output_fields' not in cls.__dict__:
+            output_fields = []
+            for field in self._readable_fields:
+                convert = _get_converter(field) if len(field.source_attrs) == 1 else None
+                attribute = field.source if convert is not None else None
+                if attribute and isinstance(field, serializers.PrimaryKeyRelatedField):
+                    attribute = self.Meta.model._meta.get_field(field.source).attname
+                output_fields.append((field.field_name, attribute, convert))
+            cls._output_fields = output_fields
+        return cls._output_fields
+
+    @cached_property
+    def output_timezone(self):
+        return timezone.get_current_timezone() if settings.USE_TZ else None
+
+    def to_representation(self, instance):
+        tz = self.output_timezone
+        data = {}
+        for name, attribute, convert in self.get_output_fields():
+            if attribute is None:
+                data.update(self._field_representation(self.fields[name], instance))
+                continue
+            value = getattr(instance, attribute)
+            data[name] = None if value is None else convert(value, tz)
+        return data
+
+    def _field_representation(self, field, instance):
+        try:
+            attribute = field.get_attribute(instance)
+        except serializers.SkipField:
+            return {}
+        check_for_none = attribute.pk if isinstance(attribute, serializers.PKOnlyObject) else attribute
+        if check_for_none is None:
+            return {field.field_name: None}
+        return {field.field_name: field.to_representation(attribute)}
+
+
+class ItemSerializer(FastModelSerializer):
     class Meta:
         model = Item
         read_only_fields = ['id' , 'created_at', 'updated_at', 'state']
         fields = read_only_fields + ['amount']
+        list_serializer_class = ItemListSerializer
+
 
+class ItemPrimaryKeyField(serializers.PrimaryKeyRelatedField):
+    """
+    Looks the item up on its shard.
+    """
+
+    def to_internal_value(self, data):
+        queryset = self.get_queryset().using(shards.for_item(data))
+        try:
+            return queryset.get(pk=data)
+        except ObjectDoesNotExist:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+class TransactionSerializer(FastModelSerializer):
+    item = ItemPrimaryKeyField(queryset=Item.objects.all())
 
-class TransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = Transaction
         read_only_fields = ['id', 'is_active', 'created_at', 'updated_at']
         fields = read_only_fields + ['item', 'status', 'location']
+
+
+class ItemIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(child=serializers.UUIDField(), allow_empty=False)
+
+
+class ItemFilterSerializer(serializers.Serializer):
+    state = serializers.ChoiceField(choices=Item.STATE_CHOICES, required=False)
+
+
+class ExportFilterSerializer(serializers.Serializer):
+    output = serializers.ChoiceField(choices=('csv', 'ndjson'), default='csv')
+    state = serializers.ChoiceField(choices=Item.STATE_CHOICES, required=False)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+
+
+class TransactionFilterSerializer(serializers.Serializer):
+    status = serializers.ChoiceField(choices=Transaction.STATUS_CHOICES, required=False)
+    location = serializers.ChoiceField(choices=Transaction.LOCATION_CHOICES, required=False)
+    is_active = serializers.BooleanField(required=False)
@@ -0,0 +1,155 @@
+"""
+Hash sharding of items across DATABASE_SHARDS.
+
+An item, its transactions, the outbox events of their changes and their
+archived copies live on the shard picked by hashing the item id, so every
+request about one item runs on a single database. The first shard is the default database, which
+also holds everything that is not sharded: users, sessions, idempotency
+keys.
+
+Item and Transaction saves find their shard through ShardRouter. Queries
+filtering on an item id are sent to for_item() explicitly, and listings
+read every shard through across() and fan_out() and merge the rows by
+created_at. Writes to several shards, e.g. batch transitions, run one
+database transaction per shard.
+"""
+import contextlib
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+
+from routable import routers
+
+
+SHARDED_MODELS = ('item', 'transaction', 'event', 'archiveditem', 'archivedtransaction')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def for_item(pk):
+    """
+    Returns the alias of the shard holding item pk. Invalid ids go to the
+    first shard, where looking them up fails as it would unsharded.
+    """
+    shards = settings.DATABASE_SHARDS
+    if len(shards) == 1:
+        return shards[0]
+    try:
+        key = uuid.UUID(str(pk)).bytes
+    except ValueError:
+        return shards[0]
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return shards[int.from_bytes(digest, 'big') % len(shards)]
+
+
+def partition(values, key=None):
+    """
+    Groups values by the shard of key(value), the value itself being the
+    item id by default. Returns {alias: [value, ...]} in input order.
+    """
+    groups = OrderedDict()
+    for value in values:
+        groups.setdefault(for_item(key(value) if key else value), []).append(value)
+    return groups
+
+
+def across(queryset):
+    """
+    Returns queryset on every shard, each read from where the current
+    request reads that shard from, see routers.get_read_alias.
+    """
+    return [
+        queryset.using(routers.get_read_alias(alias)) for alias in settings.DATABASE_SHARDS
+    ]
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.SHARD_FAN_OUT_WORKERS or len(settings.DATABASE_SHARDS),
+                thread_name_prefix='shard-fan-out'
+            )
+        return _executor
+
+
+def _run(function, queryset, wrappers):
+    close_old_connections()
+    try:
+        with contextlib.ExitStack() as stack:
+            for wrapper in wrappers:
+                stack.enter_context(connections[queryset.db].execute_wrapper(wrapper))
+            return function(queryset)
+    finally:
+        close_old_connections()
+
+
+def fan_out(function, querysets):
+    """
+    Returns [function(queryset) for queryset in querysets], running the
+    calls on a thread pool when they read more than one database.
+
+    The calling thread's execute wrappers are installed in the pool threads
+    too, so query budgets and metrics count their queries. Inside a
+    transaction the calls run in the calling thread, the only one seeing
+    its uncommitted rows.
+    """
+    if len({queryset.db for queryset in querysets}) < 2 or any(
+        connections[queryset.db].in_atomic_block for queryset in querysets
+    ):
+        return [function(queryset) for queryset in querysets]
+
+    futures = [
+        _get_executor().submit(
+            _run, function, queryset, list(connections[queryset.db].execute_wrappers)
+        )
+        for queryset in querysets
+    ]
+    return [future.result() for future in futures]
+
+
+class ShardRouter:
+    """
+    Writes items and transactions to the shard of their item, and reads
+    related objects from the database their instance came from.
+    """
+
+    def _is_sharded(self, model):
+        return model._meta.app_label == 'api' and model._meta.model_name in SHARDED_MODELS
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if self._is_sharded(model) and instance is not None and instance._state.db:
+            return instance._state.db
+        return None
+
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        if not self._is_sharded(model) or instance is None:
+            return None
+        routers.pin_to_primary()
+        # the instance is the related object when a foreign key is assigned
+        if instance._meta.model_name == 'item':
+            return for_item(instance.pk)
+        if instance._meta.model_name == 'transaction':
+            # not set yet while the transaction is built from an unsaved
+            # item, and reading the deferred field would query for it
+            item_id = instance.__dict__.get('item_id')
+            return for_item(item_id) if item_id is not None else None
+        # events are saved with an explicit database, next to their item
+        if instance._state.db in settings.DATABASE_REPLICAS:
+            return DEFAULT_DB_ALIAS
+        return instance._state.db
+
+    def allow_migrate(self, db, app_label, **hints):
+        # the shards besides the default database only hold the api tables
+        if db != DEFAULT_DB_ALIAS and db not in settings.DATABASE_REPLICAS:
+            return app_label == 'api'
+        return None
@@ -0,0 +1,83 @@
+"""
+SQLite tuning for the production database profile.
+
+Every new SQLite connection gets the SQLITE_PRAGMAS of the settings: with
+the production profile WAL journaling, so readers no longer block the
+writer, synchronous=NORMAL, a busy timeout and larger page and mmap caches.
+
+WAL still allows a single writer. A transaction that read before another
+one committed its write fails with SQLITE_BUSY when it tries to write,
+without waiting on the busy timeout, so transition views are wrapped in
+retry_on_busy, which runs them again from the start. Batch transitions
+commit one transaction per shard, and retry each shard on its own with
+run_retrying_busy, so a retry never applies the shards already committed
+again.
+"""
+import functools
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connections
+
+from routable.middleware import exempt_from_query_budget
+
+
+BUSY_MESSAGES = ('database is locked', 'database table is locked')
+
+
+def set_pragmas(sender, connection, **kwargs):
+    """
+    connection_created receiver applying SQLITE_PRAGMAS.
+    """
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+
+
+def is_busy(exc):
+    return any(message in str(exc) for message in BUSY_MESSAGES)
+
+
+def run_retrying_busy(function, on_retry=None):
+    """
+    Calls function, again up to SQLITE_BUSY_RETRIES times with a jittered
+    exponential backoff when it fails because the database is locked, and
+    returns its result. on_retry is called before every retry. Calls made
+    inside a transaction are not retried, the transaction has to be rolled
+    back first.
+    """
+    attempt = 0
+    while True:
+        try:
+            return function()
+        except OperationalError as exc:
+            if (
+                not is_busy(exc)
+                or attempt >= settings.SQLITE_BUSY_RETRIES
+                or any(connection.in_atomic_block for connection in connections.all())
+            ):
+                raise
+        if on_retry is not None:
+            on_retry()
+        delay = settings.SQLITE_BUSY_BACKOFF * 2 ** attempt
+        time.sleep(delay + random.uniform(0, delay))
+        attempt += 1
+
+
+def retry_on_busy(view_method):
+    """
+    Runs a view method again, with run_retrying_busy, when it fails because
+    the database is locked. Only for views writing in a single database
+    transaction: a retry runs the whole view again.
+    """
+    @functools.wraps(view_method)
+    def wrapper(view, request, *args, **kwargs):
+        return run_retrying_busy(
+            lambda: view_method(view, request, *args, **kwargs),
+            # the retry runs the view's queries again
+            on_retry=lambda: exempt_from_query_budget(request),
+        )
+    return wrapper
@@ -0,0 +1,129 @@
+"""
+Transition rules for items and their transactions.
+
+The rules live in lookup tables keyed by a transaction's (status, location),
+validated once at import, so that applying a transition costs a dict
+lookup whether it is done for one object or for a whole queryset.
+"""
+from django.core.exceptions import ImproperlyConfigured
+
+from api.models import Item, Transaction
+
+
+class InvalidTransition(Exception):
+    """
+    Raised when there is no transition out of a transaction's current state.
+    """
+
+
+# (status, location) -> (status, location) of a transaction moved forward.
+MOVES = {
+    (Transaction.PROCESSING, Transaction.ORIGIN): (Transaction.PROCESSING, Transaction.ROUTABLE),
+    (Transaction.PROCESSING, Transaction.ROUTABLE): (Transaction.COMPLETED, Transaction.DESTINATION),
+    (Transaction.FIXING, Transaction.ROUTABLE): (Transaction.PROCESSING, Transaction.ROUTABLE),
+    (Transaction.REFUNDING, Transaction.ROUTABLE): (Transaction.REFUNDED, Transaction.ORIGIN),
+}
+
+# (status, location) -> (status, location) of a transaction marked as errored.
+ERRORS = {
+    (Transaction.PROCESSING, Transaction.ROUTABLE): (Transaction.ERROR, Transaction.ROUTABLE),
+}
+
+# (status, location) of an errored transaction -> (status, location) of the
+# new transaction replacing it.
+FIXES = {
+    (Transaction.ERROR, Transaction.ROUTABLE): (Transaction.FIXING, Transaction.ROUTABLE),
+}
+REFUNDS = {
+    (Transaction.ERROR, Transaction.ROUTABLE): (Transaction.REFUNDING, Transaction.ROUTABLE),
+}
+
+# Transaction status -> state of its item.
+ITEM_STATES = {
+    Transaction.PROCESSING: Item.PROCESSING,
+    Transaction.ERROR: Item.ERROR,
+    Transaction.COMPLETED: Item.RESOLVED,
+    Transaction.REFUNDED: Item.RESOLVED,
+    Transaction.REFUNDING: Item.CORRECTING,
+    Transaction.FIXING: Item.CORRECTING,
+}
+
+# Transactions in these statuses are finished and no longer active.
+INACTIVE_STATUSES = frozenset((Transaction.COMPLETED, Transaction.REFUNDED))
+
+
+def _validate():
+    statuses = {choice for choice, _ in Transaction.STATUS_CHOICES}
+    locations = {choice for choice, _ in Transaction.LOCATION_CHOICES}
+    item_states = {choice for choice, _ in Item.STATE_CHOICES}
+
+    for table in (MOVES, ERRORS, FIXES, REFUNDS):
+        for status, location in list(table) + list(table.values()):
+            if status not in statuses or location not in locations:
+                raise ImproperlyConfigured(
+                    'Unknown transaction state (%s, %s) in transition table' % (status, location)
+                )
+    if set(ITEM_STATES) != statuses or not set(ITEM_STATES.values()) <= item_states:
+        raise ImproperlyConfigured('Item states must be defined for every transaction status')
+    if not INACTIVE_STATUSES <= statuses:
+        raise ImproperlyConfigured('Unknown inactive transaction status')
+
+
+_validate()
+
+
+def get_transition(table, status, location):
+    """
+    Returns the (status, location) a transaction moves to through table.
+    Raises InvalidTransition when table has no transition out of its state.
+    """
+    try:
+        return table[(status, location)]
+    except KeyError:
+        raise InvalidTransition((status, location))
+
+
+def get_item_state(trans_status):
+    """
+    Returns the item state matching the status of its active transaction.
+    """
+    try:
+        return ITEM_STATES[trans_status]
+    except KeyError:
+        raise InvalidTransition(trans_status)
+
+
+def is_active(trans_status):
+    return trans_status not in INACTIVE_STATUSES
+
+
+def get_next_states(queryset, table=MOVES):
+    """
+    Returns {pk: (status, location)} with the next state of every
+    transaction of queryset that has a transition through table, reading
+    only the status and location columns.
+    """
+    rows = queryset.values_list('pk', 'status', 'location')
+    return {
+        pk: table[(status, location)]
+        for pk, status, location in rows.iterator()
+        if (status, location) in table
+    }
+
+
+def group_transitions(rows, table):
+    """
+    Groups (trans_id, item_id, status, location) rows by their current state.
+    Returns {(status, location): (target, [(trans_id, item_id), ...])} for
+    the states with a transition through table, and
+    {item_id: (status, location)} for the rows without one.
+    """
+    groups, stuck = {}, {}
+    for trans_id, item_id, status, location in rows:
+        key = (status, location)
+        target = table.get(key)
+        if target is None:
+            stuck[item_id] = key
+        else:
+            groups.setdefault(key, (target, []))[1].append((trans_id, item_id))
+    return groups, stuck
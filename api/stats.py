@@ -0,0 +1,192 @@
+"""
+Summary counters of items per state, with their total amount, and of
+transactions per (status, location), served by `GET /api/stats`.
+
+Every write changing these numbers also adds its changes to StatCounter
+rows of its shard, in the same database transaction. Each counter is split
+into STATS_COUNTER_SLOTS rows, a write adding to one picked at random, so
+concurrent writes rarely update the same row. Reading a counter sums its
+slots on every shard, a read independent of the size of the tables.
+Archived items and transactions stay counted. `manage.py rebuild_stats`
+recomputes the counters from the tables, e.g. after changes made outside
+the application.
+"""
+import random
+from collections import Counter, defaultdict
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Sum
+
+from api import shards
+from api.models import ArchivedItem, ArchivedTransaction, Item, StatCounter, Transaction
+
+
+def _transaction_key(status, location):
+    return '%s:%s' % (status, location)
+
+
+def _cents(amount):
+    return int(Decimal(str(amount)).scaleb(2))
+
+
+def format_cents(cents):
+    return str(Decimal(cents).scaleb(-2))
+
+
+class Changes:
+    """
+    Changes to the counters of one database transaction, written with save().
+    """
+
+    def __init__(self):
+        self.counts = Counter()
+        self.amounts = Counter()
+
+    def add_items(self, state, count=1, amount=0):
+        """
+        Adds count items of total amount in state, removes them when negative.
+        """
+        self.counts[StatCounter.ITEM, state] += count
+        self.amounts[StatCounter.ITEM, state] += _cents(amount)
+
+    def move_items(self, from_state, to_state, count=1, amount=0):
+        if from_state != to_state:
+            self.add_items(from_state, -count, -Decimal(str(amount)))
+            self.add_items(to_state, count, amount)
+
+    def add_transactions(self, status, location, count=1):
+        self.counts[StatCounter.TRANSACTION, _transaction_key(status, location)] += count
+
+    def move_transactions(self, from_state, to_state, count=1):
+        """
+        Moves count transactions from one (status, location) to another.
+        """
+        if from_state != to_state:
+            self.add_transactions(*from_state, count=-count)
+            self.add_transactions(*to_state, count=count)
+
+    def remove(self, items=None, transactions=None):
+        """
+        Removes the rows of the item and transaction querysets, about to be
+        deleted.
+        """
+        if items is not None:
+            for state, (count, amount) in item_totals(items).items():
+                self.add_items(state, -count, -amount)
+        if transactions is not None:
+            for (status, location), count in transaction_totals(transactions).items():
+                self.add_transactions(status, location, -count)
+
+    def save(self, using):
+        """
+        Adds the changes to one slot of each counter of database using, with
+        one statement.
+        """
+        keys = [key for key in self.counts if self.counts[key] or self.amounts[key]]
+        if not keys:
+            return
+        connection = connections[using]
+        table = connection.ops.quote_name(StatCounter._meta.db_table)
+        count, amount = connection.ops.quote_name('count'), connection.ops.quote_name('amount_cents')
+        sql = (
+            'INSERT INTO {table} ({kind}, {key}, {slot}, {count}, {amount}) VALUES (%s, %s, %s, %s, %s) '
+            'ON CONFLICT ({kind}, {key}, {slot}) DO UPDATE SET '
+            '{count} = {table}.{count} + excluded.{count}, '
+            '{amount} = {table}.{amount} + excluded.{amount}'
+        ).format(
+            table=table, count=count, amount=amount,
+            kind=connection.ops.quote_name('kind'),
+            key=connection.ops.quote_name('key'),
+            slot=connection.ops.quote_name('slot'),
+        )
+        slot = random.randrange(settings.STATS_COUNTER_SLOTS)
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, [
+                (kind, key, slot, self.counts[kind, key], self.amounts[kind, key])
+                for kind, key in keys
+            ])
+
+
+def item_totals(queryset):
+    """
+    Returns {state: (count, amount)} of the items of queryset.
+    """
+    rows = queryset.order_by().values('state').annotate(count=Count('pk'), total=Sum('amount'))
+    return {row['state']: (row['count'], row['total'] or Decimal(0)) for row in rows}
+
+
+def transaction_totals(queryset):
+    """
+    Returns {(status, location): count} of the transactions of queryset.
+    """
+    rows = queryset.order_by().values('status', 'location').annotate(count=Count('pk'))
+    return {(row['status'], row['location']): row['count'] for row in rows}
+
+
+def _read_counters(queryset):
+    return list(
+        queryset.order_by().values('kind', 'key').annotate(count=Sum('count'), amount=Sum('amount_cents'))
+    )
+
+
+def read_counters(querysets):
+    """
+    Returns {(kind, key): (count, amount in cents)} summed over the counter
+    rows of querysets.
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for rows in shards.fan_out(_read_counters, querysets):
+        for row in rows:
+            total = totals[row['kind'], row['key']]
+            total[0] += row['count']
+            total[1] += row['amount']
+    return {key: tuple(total) for key, total in totals.items()}
+
+
+def get_stats():
+    """
+    Returns the counters of every shard as the body of `GET /api/stats`.
+    """
+    counters = read_counters(shards.across(StatCounter.objects.all()))
+    items = {}
+    for state, _ in Item.STATE_CHOICES:
+        count, cents = counters.get((StatCounter.ITEM, state), (0, 0))
+        items[state] = {'count': count, 'amount': format_cents(cents)}
+    transactions = {
+        status: {
+            location: counters.get((StatCounter.TRANSACTION, _transaction_key(status, location)), (0, 0))[0]
+            for location, _ in Transaction.LOCATION_CHOICES
+        }
+        for status, _ in Transaction.STATUS_CHOICES
+    }
+    return {'items': items, 'transactions': transactions}
+
+
+def count_rows(using):
+    """
+    Returns {(kind, key): (count, amount in cents)} counted from the tables
+    of database using, archive included.
+    """
+    totals = defaultdict(lambda: [0, 0])
+    for model in (Item, ArchivedItem):
+        for state, (count, amount) in item_totals(model.objects.using(using)).items():
+            totals[StatCounter.ITEM, state][0] += count
+            totals[StatCounter.ITEM, state][1] += _cents(amount)
+    for model in (Transaction, ArchivedTransaction):
+        for (status, location), count in transaction_totals(model.objects.using(using)).items():
+            totals[StatCounter.TRANSACTION, _transaction_key(status, location)][0] += count
+    return {key: tuple(total) for key, total in totals.items() if total != [0, 0]}
+
+
+def reset(using, totals):
+    """
+    Replaces the counters of database using with totals, as returned by
+    count_rows.
+    """
+    StatCounter.objects.using(using).all().delete()
+    StatCounter.objects.using(using).bulk_create([
+        StatCounter(kind=kind, key=key, slot=0, count=count, amount_cents=amount)
+        for (kind, key), (count, amount) in totals.items()
+    ])
@@ -1,14 +1,64 @@
-from django.urls import reverse
+import asyncio
+import datetime
+import decimal
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import types
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
 
-from rest_framework import status
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import (
+    IntegrityError, OperationalError, connection, connections, router as db_router, transaction,
+)
+from django.db.backends.signals import connection_created
+from django.db.models.sql.compiler import SQLCompiler
+from django.http import HttpRequest
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+from rest_framework import serializers, status
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APITestCase
-from rest_framework.views import status
 
-from api.models import Item, Transaction
+from api import (
+    archive, batch, events, ids, item_cache, ledger, metrics, paginators, shards, sqlite, state_machine,
+    stats,
+    urls as api_urls,
+)
+from api.cache_backends import FileBasedCache
+from api.management.commands.sync_replicas import copy_database
+from api.models import (
+    EVENT_MAX_ATTEMPTS, ArchivedItem, ArchivedTransaction, Event, IdempotencyKey, Item, StatCounter,
+    Transaction, TransitionConflict,
+)
+from api.parsers import FastJSONParser
+from api.renderers import FastJSONRenderer
+from api.serializers import ItemSerializer, TransactionSerializer
+from api.views import ItemTransactionListView
+from routable import middleware, routers, schema
+from routable.handlers import ConcurrentASGIHandler
+from routable.test_runner import TEST_SHARD
 
-import json
 
 class RoutableAPITestCase(APITestCase):
+    databases = '__all__'
 
     def setUp(self):
         self.item_1 = Item.objects.create(amount=1234)
@@ -31,7 +81,7 @@ class RoutableAPITestCase(APITestCase):
         res = self.client.post('/api/items', data)
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
-#Transaction tests
+    # Transaction tests
 
     def test_create_item_transaction(self):
         data = {
@@ -107,7 +157,7 @@ class RoutableAPITestCase(APITestCase):
         self.assertEqual(res.data, "Item transaction refunded")
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
-# Move Item Tests
+    # Move Item Tests
 
     def test_move_item(self):
         item = Item.objects.create(amount=12345)
@@ -153,7 +203,7 @@ class RoutableAPITestCase(APITestCase):
         self.assertEqual(res.data, "Transaction errored, can not be moved")
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
-# Test Error Items
+    # Test Error Items
     def test_error_item(self):
         item = Item.objects.create(amount=12345)
         Transaction.objects.create(
@@ -219,7 +269,7 @@ class RoutableAPITestCase(APITestCase):
         self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
 
 
-# test fixing transaction
+    # test fixing transaction
 
     def test_fix_item_transaction(self):
         item = Item.objects.create(amount=12345)
@@ -256,4 +306,1825 @@ class RoutableAPITestCase(APITestCase):
             res.data, 
             'Action failed'
             )
-        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    # Bulk create tests
+
+    def test_bulk_create_items(self):
+        data = [{"amount": 10}, {"amount": 20}, {"amount": 30}]
+        res = self.client.post(reverse('bulk_create_items'), data, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(res.data['ids']), 3)
+        self.assertEqual(res.data['errors'], [])
+        amounts = [Item.objects.get(pk=pk).amount for pk in res.data['ids']]
+        self.assertEqual(amounts, [10, 20, 30])
+
+    def test_bulk_create_items_from_ndjson(self):
+        body = '{"amount": 10}\n\n{"amount": 20}\n'
+        res = self.client.post(
+            reverse('bulk_create_items'), 
+            body, 
+            content_type='application/x-ndjson'
+        )
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(res.data['ids']), 2)
+
+    def test_bulk_create_items_with_invalid_rows(self):
+        data = [{"amount": 10}, {"amount": " "}, {"amount": 30}]
+        res = self.client.post(reverse('bulk_create_items'), data, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(res.data['ids']), 2)
+        self.assertEqual(res.data['errors'][0]['index'], 1)
+        self.assertIn('amount', res.data['errors'][0]['errors'])
+
+    def test_bulk_create_items_with_all_rows_invalid(self):
+        data = [{"amount": " "}]
+        res = self.client.post(reverse('bulk_create_items'), data, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Item.objects.count(), 3)
+
+    def test_bulk_create_items_with_invalid_ndjson(self):
+        res = self.client.post(
+            reverse('bulk_create_items'), 
+            '{"amount": 10}\n{amount', 
+            content_type='application/x-ndjson'
+        )
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+    # Batch transition tests
+
+    def _create_items_with_transactions(self, count, **kwargs):
+        items = [Item.objects.create(amount=100) for _ in range(count)]
+        for item in items:
+            Transaction.objects.create(item=item, **kwargs)
+        return items
+
+    def test_batch_move_items(self):
+        origin = self._create_items_with_transactions(2)
+        routable = self._create_items_with_transactions(2, location="routable")
+        ids = [str(item.id) for item in origin + routable]
+        res = self.client.put(reverse('batch_move_items'), {"ids": ids}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([str(pk) for pk in res.data['moved']], ids)
+        self.assertEqual(res.data['rejected'], [])
+        for item in origin:
+            trans = Transaction.objects.get(item=item)
+            self.assertEqual((trans.status, trans.location), ("processing", "routable"))
+        for item in routable:
+            trans = Transaction.objects.get(item=item)
+            self.assertEqual((trans.status, trans.location), ("completed", "destination_bank"))
+            self.assertFalse(trans.is_active)
+            self.assertEqual(Item.objects.get(pk=item.id).state, Item.RESOLVED)
+
+    def test_batch_move_items_rejections(self):
+        errored = self._create_items_with_transactions(1, status="error", location="routable")
+        ids = [str(errored[0].id), str(self.item_1.id)]
+        res = self.client.put(reverse('batch_move_items'), {"ids": ids}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['moved'], [])
+        self.assertEqual(
+            [rejected['reason'] for rejected in res.data['rejected']],
+            [
+                "Transaction errored, can not be moved",
+                "Item has no active transaction or Item doesnt exist"
+            ]
+        )
+
+    def test_batch_move_items_with_invalid_data(self):
+        res = self.client.put(reverse('batch_move_items'), {"ids": ["abc"]}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_batch_error_items(self):
+        routable = self._create_items_with_transactions(2, location="routable")
+        ids = [str(item.id) for item in routable] + [str(self.item_2.id)]
+        res = self.client.put(reverse('batch_error_items'), {"ids": ids}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.data['moved']), 2)
+        self.assertEqual(res.data['rejected'][0]['id'], self.item_2.id)
+        for item in routable:
+            self.assertEqual(Transaction.objects.get(item=item).status, Transaction.ERROR)
+            self.assertEqual(Item.objects.get(pk=item.id).state, Item.ERROR)
+
+    def test_batch_fix_items(self):
+        errored = self._create_items_with_transactions(2, status="error", location="routable")
+        ids = [str(item.id) for item in errored]
+        res = self.client.put(reverse('batch_fix_items'), {"ids": ids}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(res.data['moved']), 2)
+        for item in errored:
+            trans = Transaction.objects.get(item=item, is_active=True)
+            self.assertEqual(trans.status, Transaction.FIXING)
+            self.assertEqual(Item.objects.get(pk=item.id).state, Item.CORRECTING)
+
+
+
+    # Race safe transition tests
+
+    def test_move_stale_transaction_raises_conflict(self):
+        stale = Transaction.objects.get(pk=self.transaction.id)
+        self.client.put(reverse('move_item', kwargs={'pk':self.item_2.id}))
+        with self.assertRaises(TransitionConflict):
+            stale.move_transaction(Transaction.PROCESSING, Transaction.ROUTABLE)
+        trans = Transaction.objects.get(pk=self.transaction.id)
+        self.assertEqual(trans.location, Transaction.ROUTABLE)
+
+    def test_move_item_lost_race(self):
+        get_new_state = Transaction.get_new_transaction_state
+
+        def concurrent_move(trans_obj):
+            # another request moves the transaction between our read and write
+            Transaction.objects.filter(pk=trans_obj.pk).update(location=Transaction.ROUTABLE)
+            return get_new_state(trans_obj)
+
+        with mock.patch.object(Transaction, 'get_new_transaction_state', concurrent_move):
+            res = self.client.put(reverse('move_item', kwargs={'pk':self.item_2.id}))
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        trans = Transaction.objects.get(pk=self.transaction.id)
+        self.assertEqual((trans.status, trans.location), ("processing", "routable"))
+        self.assertEqual(Item.objects.get(pk=self.item_2.id).state, Item.PROCESSING)
+
+    def test_move_item_only_writes_state_columns(self):
+        # select, transaction and item updates, their events, counters
+        with self.assertNumQueries(5):
+            self.client.put(reverse('move_item', kwargs={'pk':self.item_2.id}))
+
+
+
+    # Transaction constraint tests
+
+    def test_item_can_not_have_two_active_transactions(self):
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Transaction.objects.create(item=self.item_2)
+
+    def test_create_item_transaction_checks_rules_in_one_query(self):
+        data = {
+            "item": self.item_2.id, 
+            "status":"processing", 
+            "location":"origination_bank"
+        }
+        # item lookup and one aggregate over the item transactions
+        with self.assertNumQueries(2):
+            res = self.client.post('/api/items/transaction', data)
+        self.assertEqual(res.data, "There is an active transaction for this item")
+
+
+
+    # State machine tests
+
+    def test_move_item_without_transition_from_current_state(self):
+        item = Item.objects.create(amount=12345)
+        Transaction.objects.create(
+            item=item, 
+            status="processing",
+            location="destination_bank"
+        )
+        res = self.client.put(reverse('move_item', kwargs={'pk':item.id}))
+        self.assertEqual(res.data, "Transaction can not be moved from its current state")
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_unknown_transition_raises(self):
+        with self.assertRaises(state_machine.InvalidTransition):
+            state_machine.get_transition(
+                state_machine.MOVES, Transaction.COMPLETED, Transaction.DESTINATION
+            )
+
+    def test_get_next_states_for_queryset(self):
+        item = Item.objects.create(amount=12345)
+        routable = Transaction.objects.create(item=item, location="routable")
+        next_states = state_machine.get_next_states(Transaction.objects.filter(is_active=True))
+        self.assertEqual(
+            next_states,
+            {
+                self.transaction.id: (Transaction.PROCESSING, Transaction.ROUTABLE),
+                routable.id: (Transaction.COMPLETED, Transaction.DESTINATION),
+            }
+        )
+
+
+    # List endpoint tests
+
+    def _collect_pages(self, url, page_size):
+        ids, next_url = [], '%s?page_size=%d' % (url, page_size)
+        while next_url:
+            res = self.client.get(next_url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            ids.extend(row['id'] for row in res.data['results'])
+            next_url = res.data['next']
+        return ids
+
+    def test_list_items(self):
+        res = self.client.get('/api/items')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [row['id'] for row in res.data['results']],
+            [str(self.item_3.id), str(self.item_2.id), str(self.item_1.id)]
+        )
+        self.assertIsNone(res.data['next'])
+
+    def test_list_items_pages_with_equal_created_at(self):
+        Item.objects.update(created_at=self.item_1.created_at)
+        expected = sorted(str(item.id) for item in Item.objects.all())[::-1]
+        self.assertEqual(self._collect_pages('/api/items', 2), expected)
+
+    def test_list_items_page_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            self.client.get('/api/items?page_size=1&state=processing')
+
+    def test_list_items_filtered_by_state(self):
+        self.item_1.update_item_state(Transaction.ERROR)
+        res = self.client.get('/api/items?state=error')
+        self.assertEqual([row['id'] for row in res.data['results']], [str(self.item_1.id)])
+
+    def test_list_items_with_invalid_filter(self):
+        res = self.client.get('/api/items?state=unknown')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_items_with_invalid_cursor(self):
+        res = self.client.get('/api/items?cursor=abc')
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_item_transactions(self):
+        Transaction.objects.filter(pk=self.transaction.id).update(is_active=False, status="error")
+        fixing = Transaction.objects.create(item=self.item_2, status="fixing", location="routable")
+        url = reverse('list_item_transactions', kwargs={'pk':self.item_2.id})
+        self.assertEqual(
+            self._collect_pages(url, 1),
+            [str(fixing.id), str(self.transaction.id)]
+        )
+        res = self.client.get(url + '?is_active=false')
+        self.assertEqual([row['id'] for row in res.data['results']], [str(self.transaction.id)])
+        res = self.client.get(url + '?status=fixing&location=routable')
+        self.assertEqual([row['id'] for row in res.data['results']], [str(fixing.id)])
+
+
+    # Export tests
+
+    def test_export_items_as_csv(self):
+        res = self.client.get(reverse('export_items'))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'text/csv')
+        lines = b''.join(res.streaming_content).decode().splitlines()
+        self.assertTrue(lines[0].startswith('item_id,item_amount'))
+        # one line per item, item_2 has a transaction, the others none
+        self.assertEqual(len(lines), 4)
+        self.assertIn(str(self.transaction.id), lines[2])
+
+    def test_export_items_as_ndjson(self):
+        res = self.client.get(reverse('export_items') + '?output=ndjson&state=processing')
+        rows = [json.loads(line) for line in b''.join(res.streaming_content).splitlines()]
+        self.assertEqual(
+            [row['id'] for row in rows],
+            [str(self.item_1.id), str(self.item_2.id), str(self.item_3.id)]
+        )
+        self.assertEqual(rows[1]['transactions'][0]['id'], str(self.transaction.id))
+
+    def test_export_items_with_invalid_filter(self):
+        res = self.client.get(reverse('export_items') + '?created_after=yesterday')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_items_command(self):
+        out = io.StringIO()
+        call_command('export_items', '--format', 'ndjson', '--chunk-size', '2', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(len(rows), 3)
+
+    def test_export_items_command_created_range(self):
+        Item.objects.filter(pk=self.item_1.id).update(created_at='2020-01-01T00:00:00Z')
+        with tempfile.NamedTemporaryFile(mode='r', suffix='.csv') as output:
+            call_command(
+                'export_items', 
+                '--output', output.name, 
+                '--created-before', '2020-06-01'
+            )
+            lines = output.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith(str(self.item_1.id)))
+
+
+
+# creating an item is a write transaction, which the in-memory test database
+# fails with "table is locked" instead of waiting on a concurrent one
+@override_settings(SQLITE_BUSY_RETRIES=5)
+class ConcurrentASGIHandlerTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def request(self, application, method, path, body=b''):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': b'',
+            'root_path': '',
+            'headers': [
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+            ],
+            'server': ('testserver', 80),
+            'client': ('127.0.0.1', 50000),
+        }
+        return application(scope, receive, send), messages
+
+    def test_serves_concurrent_requests(self):
+        application = ConcurrentASGIHandler(max_workers=4)
+        calls = [
+            self.request(application, 'POST', '/api/items', b'{"amount": 10}')
+            for _ in range(8)
+        ]
+
+        async def main():
+            await asyncio.gather(*(call for call, _ in calls))
+
+        asyncio.run(main())
+        for _, messages in calls:
+            self.assertEqual(messages[0]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(Item.objects.count(), 8)
+
+    def test_streams_exports_from_the_pool(self):
+        item = Item.objects.create(amount=10)
+        Transaction.objects.create(item=item)
+        call, messages = self.request(ConcurrentASGIHandler(max_workers=2), 'GET', '/api/items/export')
+        asyncio.run(call)
+        self.assertEqual(messages[0]['status'], status.HTTP_200_OK)
+        body = b''.join(message.get('body', b'') for message in messages[1:]).decode()
+        self.assertEqual(len(body.splitlines()), 2)
+        self.assertIn(str(item.id), body)
+
+
+
+class WebhookStandIn:
+    """
+    Local HTTP server recording the JSON bodies POSTed to it, failing the
+    first `failures` requests with a 500.
+    """
+
+    def __init__(self, failures=0):
+        self.received = []
+        self.failures = failures
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with lock:
+                    failing = stand_in.failures > 0
+                    stand_in.failures -= 1
+                    if not failing:
+                        stand_in.received.append(json.loads(body))
+                self.send_response(500 if failing else 200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        lock = threading.Lock()
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class EventOutboxTestCase(APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.item = Item.objects.create(amount=1000)
+        Transaction.objects.create(item=self.item)
+        self.client.put(reverse('move_item', kwargs={'pk':self.item.id}))
+
+    def test_transitions_write_events(self):
+        types = list(Event.objects.values_list('type', flat=True))
+        # transaction created, transaction moved, item state updated
+        self.assertEqual(
+            types, 
+            [Event.TRANSACTION_CHANGED, Event.TRANSACTION_CHANGED, Event.ITEM_STATE_CHANGED]
+        )
+        payload = json.loads(Event.objects.filter(type=Event.TRANSACTION_CHANGED).last().payload)
+        self.assertEqual(payload['location'], Transaction.ROUTABLE)
+
+    def test_lost_race_writes_no_event(self):
+        stale = Transaction.objects.get(item=self.item)
+        Transaction.objects.filter(pk=stale.pk).update(status=Transaction.ERROR)
+        count = Event.objects.count()
+        with self.assertRaises(TransitionConflict):
+            stale.move_transaction(Transaction.COMPLETED, Transaction.DESTINATION)
+        self.assertEqual(Event.objects.count(), count)
+
+    def test_batch_transitions_write_events(self):
+        Event.objects.all().delete()
+        self.client.put(reverse('batch_error_items'), {"ids": [str(self.item.id)]}, format='json')
+        self.client.put(reverse('batch_fix_items'), {"ids": [str(self.item.id)]}, format='json')
+        payloads = [json.loads(event.payload) for event in Event.objects.all()]
+        self.assertEqual(
+            [(payload.get('status'), payload.get('state')) for payload in payloads],
+            [
+                ('error', None), (None, 'error'),
+                ('error', None), ('fixing', None), (None, 'correcting'),
+            ]
+        )
+
+    def test_dispatch_events(self):
+        with WebhookStandIn() as webhook:
+            delivered, failed = events.dispatch(webhook.url, batch_size=2, workers=2, once=True)
+        self.assertEqual((delivered, failed), (3, 0))
+        self.assertEqual(
+            sorted(event['id'] for event in webhook.received), 
+            list(Event.objects.values_list('id', flat=True))
+        )
+        self.assertFalse(Event.objects.filter(delivered_at__isnull=True).exists())
+
+    def test_dispatch_events_retries_with_backoff(self):
+        with WebhookStandIn(failures=1) as webhook:
+            delivered, failed = events.dispatch(webhook.url, workers=1, once=True)
+            self.assertEqual((delivered, failed), (2, 1))
+            retry = Event.objects.get(delivered_at__isnull=True)
+            self.assertEqual(retry.attempts, 1)
+            self.assertIn('500', retry.last_error)
+
+            Event.objects.filter(pk=retry.pk).update(next_attempt_at=retry.created_at)
+            call_command('dispatch_events', '--url', webhook.url, '--once', stdout=io.StringIO())
+        self.assertEqual(len(webhook.received), 3)
+        self.assertFalse(Event.objects.filter(delivered_at__isnull=True).exists())
+
+    def test_claimed_events_are_not_claimed_again(self):
+        # one UPDATE leases the events, one SELECT reads them back
+        with self.assertNumQueries(2):
+            first = events.claim(2)
+        second = events.claim(10)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(
+            sorted(event.id for event in first + second),
+            list(Event.objects.values_list('id', flat=True))
+        )
+        self.assertEqual(events.claim(10), [])
+
+    def test_events_out_of_attempts_are_not_claimed(self):
+        Event.objects.update(attempts=EVENT_MAX_ATTEMPTS)
+        self.assertEqual(events.claim(10), [])
+
+    def test_backoff_is_capped(self):
+        self.assertEqual(events.get_backoff(1).total_seconds(), 2)
+        self.assertEqual(events.get_backoff(3).total_seconds(), 8)
+        self.assertEqual(events.get_backoff(30).total_seconds(), 3600)
+
+
+
+class IdempotencyKeyTestCase(APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_retry_replays_stored_response(self):
+        data = {"amount": 123}
+        res = self.client.post('/api/items', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        with self.assertNumQueries(0):
+            retry = self.client.post('/api/items', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data, json.loads(json.dumps(res.data, default=str)))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_retry_replays_from_table_when_not_cached(self):
+        data = {"amount": 123}
+        res = self.client.post('/api/items', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        cache.clear()
+        retry = self.client.post('/api/items', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(retry.data['id'], str(res.data['id']))
+        self.assertEqual(Item.objects.count(), 1)
+
+    def test_requests_without_key_are_not_stored(self):
+        self.client.post('/api/items', {"amount": 123})
+        self.client.post('/api/items', {"amount": 123})
+        self.assertEqual(Item.objects.count(), 2)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_key_reused_with_different_body(self):
+        self.client.post('/api/items', {"amount": 123}, HTTP_IDEMPOTENCY_KEY='key-1')
+        res = self.client.post('/api/items', {"amount": 5}, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(res.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    def test_retried_transaction_create(self):
+        item = Item.objects.create(amount=1000)
+        data = {
+            "item": item.id, 
+            "status":"processing", 
+            "location":"origination_bank"
+        }
+        res = self.client.post('/api/items/transaction', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        retry = self.client.post('/api/items/transaction', data, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.data['id'], str(res.data['id']))
+
+    def test_expired_key_runs_request_again(self):
+        self.client.post('/api/items', {"amount": 123}, HTTP_IDEMPOTENCY_KEY='key-1')
+        cache.clear()
+        IdempotencyKey.objects.update(expires_at='2020-01-01T00:00:00Z')
+        self.client.post('/api/items', {"amount": 123}, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(Item.objects.count(), 2)
+        call_command('purge_idempotency_keys', stdout=io.StringIO())
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+
+class ConcurrentIdempotencyKeyTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_request_waits_for_first(self):
+        body = json.dumps({"amount": 123}).encode()
+        item = Item.objects.create(amount=123)
+        record = IdempotencyKey.objects.create(
+            key='key-1',
+            path='/api/items',
+            fingerprint=hashlib.sha256(body).hexdigest(),
+            expires_at='2100-01-01T00:00:00Z'
+        )
+
+        def finish_first_request():
+            IdempotencyKey.objects.filter(pk=record.pk).update(
+                status_code=201, body=json.dumps({"id": str(item.id)})
+            )
+
+        timer = threading.Timer(0.2, finish_first_request)
+        timer.start()
+        res = self.client.post(
+            '/api/items', body, content_type='application/json', HTTP_IDEMPOTENCY_KEY='key-1'
+        )
+        timer.join()
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.json(), {"id": str(item.id)})
+        self.assertEqual(Item.objects.count(), 1)
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0.1)
+    def test_concurrent_request_times_out(self):
+        IdempotencyKey.objects.create(
+            key='key-1',
+            path='/api/items',
+            fingerprint='',
+            expires_at='2100-01-01T00:00:00Z'
+        )
+        res = self.client.post('/api/items', {"amount": 123}, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+
+    @override_settings(IDEMPOTENCY_WAIT_TIMEOUT=0.1)
+    def test_stale_request_in_progress_is_taken_over(self):
+        # left by a worker killed while running the first request
+        IdempotencyKey.objects.create(
+            key='key-1',
+            path='/api/items',
+            fingerprint='',
+            claimed_at='2020-01-01T00:00:00Z',
+            expires_at='2100-01-01T00:00:00Z'
+        )
+        res = self.client.post('/api/items', {"amount": 123}, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        cache.clear()
+        retry = self.client.post('/api/items', {"amount": 123}, HTTP_IDEMPOTENCY_KEY='key-1')
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(retry.json(), res.json())
+        self.assertEqual(Item.objects.count(), 1)
+
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'items': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'items'},
+})
+class ItemDetailCacheTestCase(APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.item = Item.objects.create(amount=1000)
+        Transaction.objects.create(item=self.item, location="routable")
+        self.url = reverse('item_detail', kwargs={'pk':self.item.id})
+
+    def test_item_detail_is_read_through(self):
+        stats = item_cache.get_stats()
+        with self.assertNumQueries(1):
+            res = self.client.get(self.url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['state'], Item.PROCESSING)
+        with self.assertNumQueries(0):
+            res = self.client.get(self.url)
+        self.assertEqual(res.data['id'], str(self.item.id))
+        new_stats = item_cache.get_stats()
+        self.assertEqual(new_stats['hits'], stats['hits'] + 1)
+        self.assertEqual(new_stats['misses'], stats['misses'] + 1)
+
+    def test_non_existant_item(self):
+        url = reverse('item_detail', kwargs={'pk':"d0ef03f4-e2e9-4830-98bd-2df78db5da65"})
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_transition_invalidates_item(self):
+        self.client.get(self.url)
+        self.client.put(reverse('error_item', kwargs={'pk':self.item.id}))
+        self.assertEqual(self.client.get(self.url).data['state'], Item.ERROR)
+        self.client.put(reverse('fix_item', kwargs={'pk':self.item.id}))
+        self.assertEqual(self.client.get(self.url).data['state'], Item.CORRECTING)
+
+    def test_batch_transition_invalidates_item(self):
+        self.client.get(self.url)
+        self.client.put(reverse('batch_move_items'), {"ids": [str(self.item.id)]}, format='json')
+        self.assertEqual(self.client.get(self.url).data['state'], Item.RESOLVED)
+
+    def test_saving_an_item_invalidates_it(self):
+        self.client.get(self.url)
+        # as the admin change page does
+        self.item.state = Item.ERROR
+        self.item.save()
+        self.assertEqual(self.client.get(self.url).data['state'], Item.ERROR)
+
+    def test_saving_a_transaction_invalidates_its_item(self):
+        stats = item_cache.get_stats()
+        self.client.get(self.url)
+        trans = Transaction.objects.get(item=self.item)
+        trans.status = Transaction.ERROR
+        trans.save()
+        self.client.get(self.url)
+        trans.delete()
+        self.client.get(self.url)
+        self.assertEqual(item_cache.get_stats()['misses'], stats['misses'] + 3)
+
+    def test_value_read_before_a_commit_is_not_served(self):
+        def load_then_commit_concurrently():
+            data = dict(ItemSerializer(Item.objects.get(pk=self.item.id)).data)
+            # another request commits a transition after our read
+            Item.objects.get(pk=self.item.id).update_item_state(Transaction.ERROR)
+            return data
+
+        stale = item_cache.get(self.item.id, load_then_commit_concurrently)
+        self.assertEqual(stale['state'], Item.PROCESSING)
+        self.assertEqual(self.client.get(self.url).data['state'], Item.ERROR)
+
+    def test_cache_stats(self):
+        self.client.get(self.url)
+        res = self.client.get(reverse('item_cache_stats'))
+        self.assertEqual(set(res.data), {'hits', 'misses', 'hit_rate'})
+
+    def test_cache_stats_of_other_processes_are_summed(self):
+        with tempfile.TemporaryDirectory() as metrics_dir, self.settings(METRICS_DIR=metrics_dir):
+            before = item_cache.get_stats()
+            # another worker process, with its own registry and snapshot file
+            other = metrics.Registry()
+            lookups = metrics.ITEM_CACHE_LOOKUPS
+            metrics.Counter(lookups.name, 'Lookups.', lookups.labelnames, other).inc(3, outcome='hit')
+            other.flush()
+            self.client.get(self.url)
+            stats = item_cache.get_stats()
+        self.assertEqual(stats['hits'], before['hits'] + 3)
+        self.assertEqual(stats['misses'], before['misses'] + 1)
+
+    def test_file_cache_culls_every_n_writes(self):
+        with tempfile.TemporaryDirectory() as location:
+            file_cache = FileBasedCache(location, {
+                'OPTIONS': {'MAX_ENTRIES': 4, 'CULL_FREQUENCY': 2, 'CULL_EVERY': 5},
+            })
+            with mock.patch.object(file_cache, '_list_cache_files', wraps=file_cache._list_cache_files) as listed:
+                for i in range(10):
+                    file_cache.set('key%s' % i, i)
+            self.assertEqual(listed.call_count, 2)
+            self.assertLessEqual(len(file_cache._list_cache_files()), 4 + 5)
+
+
+class AdminPerformanceTestCase(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def create_items(self, count):
+        for _ in range(count):
+            item = Item.objects.create(amount=1000)
+            Transaction.objects.create(item=item)
+
+    def test_transaction_changelist_query_count_does_not_grow_with_rows(self):
+        url = reverse('admin:api_transaction_changelist')
+        self.create_items(3)
+        # session, user, size estimate, exact count below the estimate
+        # threshold, the page joined with its items and two date hierarchy
+        # queries
+        with self.assertNumQueries(7):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.create_items(30)
+        with self.assertNumQueries(7):
+            self.client.get(url)
+
+    def test_item_changelist_query_count_does_not_grow_with_rows(self):
+        url = reverse('admin:api_item_changelist')
+        self.create_items(3)
+        # session, user, filtered count, the page and two date hierarchy queries
+        with self.assertNumQueries(6):
+            self.assertEqual(self.client.get(url + '?state=processing').status_code, 200)
+        self.create_items(30)
+        with self.assertNumQueries(6):
+            self.client.get(url + '?state=processing')
+
+    @override_settings(ADMIN_ESTIMATED_COUNT_THRESHOLD=10)
+    def test_changelist_uses_estimated_count(self):
+        url = reverse('admin:api_item_changelist')
+        self.create_items(12)
+        # without statistics the count is exact
+        self.assertIsNone(paginators.estimate_count(Item))
+        paginators.refresh_estimates([Item])
+        for item in Item.objects.order_by('created_at')[:2]:
+            item.delete()
+        # the estimate counts the deleted rows, the filtered count is exact
+        self.assertEqual(self.client.get(url).context['cl'].result_count, 12)
+        self.assertEqual(self.client.get(url + '?state=processing').context['cl'].result_count, 10)
+        paginators.refresh_estimates([Item])
+        self.assertEqual(paginators.estimate_count(Item), 10)
+
+    @override_settings(ADMIN_RECENT_TRANSACTIONS=2)
+    def test_item_change_page_shows_recent_transactions(self):
+        item = Item.objects.create(amount=1000)
+        for _ in range(4):
+            Transaction.objects.create(item=item, is_active=False)
+        res = self.client.get(reverse('admin:api_item_change', args=[item.pk]))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.context['inline_admin_formsets'][0].formset.forms), 2)
+        link = reverse('admin:api_transaction_changelist') + '?item__id__exact=%s' % item.pk
+        self.assertEqual(self.client.get(link).status_code, 200)
+
+
+class BulkRefundTestCase(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.errored = []
+        for _ in range(3):
+            item = Item.objects.create(amount=1000, state=Item.ERROR)
+            Transaction.objects.create(item=item, status="error", location="routable")
+            self.errored.append(item)
+        self.processing = Item.objects.create(amount=1000)
+        Transaction.objects.create(item=self.processing)
+
+    def assertRefunding(self, item):
+        trans = Transaction.objects.get(item=item, is_active=True)
+        self.assertEqual((trans.status, trans.location), ("refunding", "routable"))
+        self.assertEqual(Item.objects.get(pk=item.pk).state, Item.CORRECTING)
+
+    def test_admin_bulk_refund_action(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        data = {
+            'action': 'refund_selected',
+            '_selected_action': [str(item.pk) for item in self.errored + [self.processing]],
+        }
+        res = self.client.post(reverse('admin:api_item_changelist'), data, follow=True)
+        messages = [str(message) for message in res.context['messages']]
+        self.assertEqual(
+            messages, 
+            [
+                "Refunding 3 Items", 
+                "Skipped 1 Items: Transaction can not be moved from its current state"
+            ]
+        )
+        for item in self.errored:
+            self.assertRefunding(item)
+
+    @override_settings(ITEM_BATCH_UPDATE_SIZE=2)
+    def test_refund_items_command_by_state(self):
+        out = io.StringIO()
+        call_command('refund_items', stdout=out)
+        self.assertIn('Refunded 3 items, skipped 0', out.getvalue())
+        for item in self.errored:
+            self.assertRefunding(item)
+
+    def test_refund_items_command_from_ids_file(self):
+        missing = "d0ef03f4-e2e9-4830-98bd-2df78db5da65"
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.txt') as ids_file:
+            ids_file.write('%s\n\n%s\n%s\n' % (self.errored[0].pk, self.processing.pk, missing))
+            ids_file.flush()
+            out = io.StringIO()
+            call_command('refund_items', '--ids-file', ids_file.name, verbosity=2, stdout=out)
+        self.assertIn('Refunded 1 items, skipped 2', out.getvalue())
+        self.assertIn('%s: Item has no active transaction or Item doesnt exist' % missing, out.getvalue())
+        self.assertRefunding(self.errored[0])
+        self.assertEqual(Item.objects.get(pk=self.errored[1].pk).state, Item.ERROR)
+
+
+class QueryBudgetTestCase(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.item = Item.objects.create(amount=1000)
+        self.trans = Transaction.objects.create(item=self.item)
+
+    def login(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def test_every_api_view_declares_a_budget(self):
+        for pattern in api_urls.urlpatterns:
+            budget = getattr(pattern.callback.cls, 'query_budget', None)
+            self.assertIsInstance(budget, int, pattern.name)
+
+    def test_every_admin_page_declares_a_budget(self):
+        for model, model_admin in admin.site._registry.items():
+            if model._meta.app_label != 'api':
+                continue
+            for pattern in model_admin.urls:
+                if pattern.name:
+                    self.assertIsInstance(middleware.get_admin_budget(pattern.name), int, pattern.name)
+
+    def test_admin_pages_stay_within_budget(self):
+        self.login()
+        # the test runner fails requests going over their budget
+        for obj in (self.item, self.trans, Event.objects.first()):
+            opts = obj._meta
+            prefix = 'admin:%s_%s_' % (opts.app_label, opts.model_name)
+            self.assertEqual(self.client.get(reverse(prefix + 'changelist')).status_code, 200)
+            self.assertEqual(self.client.get(reverse(prefix + 'add')).status_code, 200)
+            for page in ('change', 'history', 'delete'):
+                res = self.client.get(reverse(prefix + page, args=[obj.pk]))
+                self.assertEqual(res.status_code, 200)
+
+    def test_admin_refund_action_stays_within_budget(self):
+        self.login()
+        item = Item.objects.create(amount=1000, state=Item.ERROR)
+        Transaction.objects.create(item=item, status="error", location="routable")
+        url = reverse('admin:api_item_actions', kwargs={'pk': item.pk, 'tool': 'refund'})
+        self.assertEqual(self.client.post(url).status_code, 302)
+        self.assertEqual(Transaction.objects.get(item=item, is_active=True).status, "refunding")
+
+    def test_request_over_budget_fails(self):
+        url = reverse('list_item_transactions', kwargs={'pk': self.item.id})
+        with mock.patch.object(ItemTransactionListView, 'query_budget', 0):
+            with self.assertLogs('routable.queries', 'WARNING'):
+                with self.assertRaises(middleware.QueryBudgetExceeded):
+                    self.client.get(url)
+
+    @override_settings(QUERY_BUDGET_HEADERS=True)
+    def test_query_headers(self):
+        res = self.client.get(reverse('list_item_transactions', kwargs={'pk': self.item.id}))
+        self.assertEqual(res['X-Query-Count'], '1')
+        self.assertEqual(res['X-Query-Budget'], str(ItemTransactionListView.query_budget))
+        self.assertIn('X-Query-Time-Ms', res)
+        self.assertIn('X-Slowest-Query-Ms', res)
+
+    @override_settings(QUERY_BUDGET_HEADERS=False)
+    def test_no_query_headers_in_production(self):
+        res = self.client.get(reverse('list_item_transactions', kwargs={'pk': self.item.id}))
+        self.assertNotIn('X-Query-Count', res)
+
+
+class MetricsTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.item = Item.objects.create(amount=1000)
+        Transaction.objects.create(item=self.item, location="routable")
+
+    def value(self, metric, **labels):
+        series = metrics.REGISTRY.collect()[metric.name]
+        return series.get(metric._labels(labels), 0)
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('item_detail', kwargs={'pk': self.item.id}))
+        res = self.client.get(reverse('metrics'))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], metrics.CONTENT_TYPE)
+        body = res.content.decode()
+        self.assertIn('# TYPE routable_request_duration_seconds histogram', body)
+        self.assertIn('routable_request_duration_seconds_bucket{view="item_detail",method="GET",le="+Inf"}', body)
+        self.assertIn('# TYPE routable_transitions_total counter', body)
+
+    def test_request_latency_and_queries(self):
+        def observations():
+            value = self.value(metrics.REQUEST_DURATION, view='item_detail', method='GET')
+            # bucket counts followed by the sum
+            return sum(value[:-1]) if value else 0
+
+        before = observations(), self.value(metrics.DB_QUERIES, view='item_detail')
+        self.client.get(reverse('item_detail', kwargs={'pk': self.item.id}))
+        self.assertEqual(observations(), before[0] + 1)
+        self.assertEqual(self.value(metrics.DB_QUERIES, view='item_detail'), before[1] + 1)
+
+    def test_rejections_by_reason(self):
+        reason = 'There is an active transaction for this item'
+        labels = {'view': 'create_transaction', 'status': 400, 'reason': reason}
+        before = self.value(metrics.REJECTIONS, **labels)
+        data = {"item": self.item.id, "status": "processing", "location": "origination_bank"}
+        self.client.post('/api/items/transaction', data)
+        self.assertEqual(self.value(metrics.REJECTIONS, **labels), before + 1)
+
+    def test_transitions_are_counted_on_commit(self):
+        moved = {'from_status': 'processing', 'to_status': 'error', 'location': 'routable'}
+        fixed = {'from_status': 'error', 'to_status': 'fixing', 'location': 'routable'}
+        before = self.value(metrics.TRANSITIONS, **moved), self.value(metrics.TRANSITIONS, **fixed)
+        self.client.put(reverse('error_item', kwargs={'pk': self.item.id}))
+        self.client.put(
+            reverse('batch_fix_items'),
+            json.dumps({"ids": [str(self.item.id)]}),
+            content_type='application/json'
+        )
+        self.assertEqual(self.value(metrics.TRANSITIONS, **moved), before[0] + 1)
+        self.assertEqual(self.value(metrics.TRANSITIONS, **fixed), before[1] + 1)
+
+    def test_rolled_back_transition_is_not_counted(self):
+        labels = {'from_status': 'processing', 'to_status': 'error', 'location': 'routable'}
+        before = self.value(metrics.TRANSITIONS, **labels)
+        trans = Transaction.objects.get(item=self.item)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                trans.error_transaction()
+                raise IntegrityError
+        self.assertEqual(self.value(metrics.TRANSITIONS, **labels), before)
+
+    def test_histogram_buckets(self):
+        registry = metrics.Registry()
+        histogram = metrics.Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0), registry=registry)
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1.0"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+        ])
+
+    def test_metrics_of_other_processes_are_summed(self):
+        labels = {'from_status': 'processing', 'to_status': 'completed', 'location': 'destination_bank'}
+        with tempfile.TemporaryDirectory() as metrics_dir, self.settings(METRICS_DIR=metrics_dir):
+            before = self.value(metrics.TRANSITIONS, **labels)
+            # another worker process, with its own registry and snapshot file
+            other = metrics.Registry()
+            counter = metrics.Counter(metrics.TRANSITIONS.name, 'Transitions.', metrics.TRANSITIONS.labelnames, other)
+            counter.inc(3, **labels)
+            other.flush()
+            metrics.TRANSITIONS.inc(**labels)
+            metrics.REGISTRY.flush()
+            self.assertEqual(self.value(metrics.TRANSITIONS, **labels), before + 4)
+
+
+@override_settings(SQLITE_BUSY_RETRIES=2, SQLITE_BUSY_BACKOFF=0)
+class SQLiteProfileTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def flaky(self, failures, message='database is locked'):
+        calls = []
+
+        @sqlite.retry_on_busy
+        def write(view, request):
+            calls.append(1)
+            if len(calls) <= failures:
+                raise OperationalError(message)
+            return 'written'
+        return write, calls
+
+    @override_settings(SQLITE_PRAGMAS={'cache_size': -1234})
+    def test_pragmas_are_set_on_new_connections(self):
+        # the in memory test database is never closed, run the receiver directly
+        connection_created.send(sender=connection.__class__, connection=connection)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertEqual(cursor.fetchone()[0], -1234)
+
+    def test_busy_write_is_retried(self):
+        write, calls = self.flaky(2)
+        self.assertEqual(write(None, HttpRequest()), 'written')
+        self.assertEqual(len(calls), 3)
+
+    def test_retries_are_bounded(self):
+        write, calls = self.flaky(3)
+        with self.assertRaises(OperationalError):
+            write(None, HttpRequest())
+        self.assertEqual(len(calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        write, calls = self.flaky(1, 'no such table: api_item')
+        with self.assertRaises(OperationalError):
+            write(None, HttpRequest())
+        self.assertEqual(len(calls), 1)
+
+    def test_writes_inside_a_transaction_are_not_retried(self):
+        write, calls = self.flaky(1)
+        with self.assertRaises(OperationalError):
+            with transaction.atomic():
+                write(None, HttpRequest())
+        self.assertEqual(len(calls), 1)
+
+    def test_transition_view_retries_when_locked(self):
+        item = Item.objects.create(amount=1000)
+        Transaction.objects.create(item=item)
+        compare_and_swap = Transaction.compare_and_swap
+        calls = []
+
+        def locked_once(trans, item=None, **values):
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return compare_and_swap(trans, item, **values)
+
+        with mock.patch.object(Transaction, 'compare_and_swap', locked_once):
+            res = self.client.put(reverse('move_item', kwargs={'pk': item.id}))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(Transaction.objects.get(item=item).location, "routable")
+
+    @override_settings(DATABASE_SHARDS=['default', TEST_SHARD])
+    def test_batch_retries_only_the_locked_shard(self):
+        items = []
+        for using in settings.DATABASE_SHARDS:
+            pk = next(pk for pk in iter(ids.uuid7, None) if shards.for_item(pk) == using)
+            items.append(Item.objects.create(id=pk, amount=1000))
+            Transaction.objects.create(item=items[-1])
+        group = batch._group
+        calls = []
+
+        def locked_once(*args, **kwargs):
+            calls.append(1)
+            # the second shard, once the first one committed
+            if len(calls) == 2:
+                raise OperationalError('database is locked')
+            return group(*args, **kwargs)
+
+        with mock.patch.object(batch, '_group', locked_once):
+            res = self.client.put(
+                reverse('batch_move_items'), json.dumps({"ids": [str(item.id) for item in items]}),
+                content_type='application/json'
+            )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(calls), 3)
+        for item in items:
+            trans = Transaction.objects.using(item._state.db).get(item=item)
+            self.assertEqual(trans.location, Transaction.ROUTABLE)
+
+
+class ReplicaRouterTestCase(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.item = Item.objects.create(amount=1000)
+        Transaction.objects.create(item=self.item)
+
+    def routed_reads(self, request):
+        """
+        Returns the databases the SELECTs of request() ran on.
+        """
+        aliases = []
+        execute_sql = SQLCompiler.execute_sql
+
+        def spy(compiler, *args, **kwargs):
+            if type(compiler) is SQLCompiler:
+                aliases.append(compiler.using)
+            return execute_sql(compiler, *args, **kwargs)
+
+        with mock.patch.object(SQLCompiler, 'execute_sql', spy):
+            request()
+        return aliases
+
+    def test_reads_use_the_primary_outside_requests(self):
+        self.assertEqual(db_router.db_for_read(Item), 'default')
+
+    def test_safe_reads_use_a_replica(self):
+        with routers.replica_reads():
+            self.assertIn(db_router.db_for_read(Item), settings.DATABASE_REPLICAS)
+            self.assertEqual(db_router.db_for_read(User), 'default')
+        self.assertEqual(db_router.db_for_read(Item), 'default')
+
+    def test_reads_after_a_write_use_the_primary(self):
+        with routers.replica_reads():
+            Item.objects.create(amount=1000)
+            self.assertEqual(db_router.db_for_read(Item), 'default')
+
+    def test_listing_reads_from_a_replica(self):
+        aliases = self.routed_reads(lambda: self.client.get('/api/items'))
+        self.assertTrue(aliases)
+        self.assertTrue(all(alias in settings.DATABASE_REPLICAS for alias in aliases))
+
+    def test_transitions_read_from_the_primary(self):
+        aliases = self.routed_reads(
+            lambda: self.client.put(reverse('move_item', kwargs={'pk': self.item.id}))
+        )
+        self.assertTrue(aliases)
+        self.assertEqual(set(aliases), {'default'})
+
+    def test_item_detail_reads_from_the_primary(self):
+        aliases = self.routed_reads(
+            lambda: self.client.get(reverse('item_detail', kwargs={'pk': self.item.id}))
+        )
+        self.assertTrue(aliases)
+        self.assertEqual(set(aliases), {'default'})
+
+
+class SyncReplicasTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def test_copy_database(self):
+        Item.objects.create(amount=1000)
+        with tempfile.NamedTemporaryFile(suffix='.sqlite3') as replica:
+            copy_database(replica.name)
+            copy = sqlite3.connect(replica.name)
+            try:
+                count, = copy.execute('SELECT COUNT(*) FROM api_item').fetchone()
+            finally:
+                copy.close()
+        self.assertEqual(count, 1)
+
+
+def create_item_on(alias, **fields):
+    """
+    Creates an item whose id hashes to shard alias.
+    """
+    while True:
+        pk = ids.uuid7()
+        if shards.for_item(pk) == alias:
+            return Item.objects.create(id=pk, **fields)
+
+
+def set_created_at(item, minute):
+    created_at = '2020-05-01T10:%02d:00Z' % minute
+    Item.objects.using(item._state.db).filter(pk=item.pk).update(created_at=created_at)
+
+
+@override_settings(DATABASE_SHARDS=['default', TEST_SHARD])
+class ShardingTestCase(APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.items = [
+            create_item_on('default', amount=1000),
+            create_item_on(TEST_SHARD, amount=1000),
+            create_item_on('default', amount=1000),
+            create_item_on(TEST_SHARD, amount=1000),
+        ]
+        for minute, item in enumerate(self.items):
+            set_created_at(item, minute)
+            Transaction.objects.create(item=item)
+
+    def test_items_are_spread_over_shards(self):
+        ids = [uuid.uuid4() for _ in range(200)]
+        counts = Counter(shards.for_item(pk) for pk in ids)
+        self.assertEqual(set(counts), {'default', TEST_SHARD})
+        self.assertEqual([shards.for_item(pk) for pk in ids], [shards.for_item(str(pk)) for pk in ids])
+
+    def test_items_and_transactions_are_stored_on_their_shard(self):
+        item = self.items[1]
+        self.assertFalse(Item.objects.using('default').filter(pk=item.pk).exists())
+        self.assertTrue(Item.objects.using(TEST_SHARD).filter(pk=item.pk).exists())
+        self.assertTrue(Transaction.objects.using(TEST_SHARD).filter(item_id=item.pk).exists())
+
+    def test_transaction_built_from_unsaved_item(self):
+        pk = next(pk for pk in iter(ids.uuid7, None) if shards.for_item(pk) == TEST_SHARD)
+        item = Item(id=pk, amount=1)
+        trans = Transaction(item=item)
+        self.assertEqual(trans._state.db, TEST_SHARD)
+        item.save()
+        trans.save()
+        self.assertTrue(Transaction.objects.using(TEST_SHARD).filter(pk=trans.pk, item_id=pk).exists())
+
+    def test_created_item_is_stored_on_its_shard(self):
+        res = self.client.post('/api/items', {"amount": 123})
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        using = shards.for_item(res.data['id'])
+        self.assertTrue(Item.objects.using(using).filter(pk=res.data['id']).exists())
+
+    def test_bulk_created_items_are_stored_on_their_shards(self):
+        res = self.client.post('/api/items/bulk', [{"amount": 1}] * 20, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        for pk in res.data['ids']:
+            self.assertTrue(Item.objects.using(shards.for_item(pk)).filter(pk=pk).exists())
+
+    def test_item_requests_touch_one_shard(self):
+        item = self.items[1]
+        Transaction.objects.using(TEST_SHARD).filter(item=item).delete()
+        requests = [
+            lambda: self.client.post(
+                '/api/items/transaction',
+                {"item": str(item.id), "status": "processing", "location": "origination_bank"}
+            ),
+            lambda: self.client.get(reverse('item_detail', kwargs={'pk': item.id})),
+            lambda: self.client.get(reverse('list_item_transactions', kwargs={'pk': item.id})),
+            lambda: self.client.put(reverse('move_item', kwargs={'pk': item.id})),
+            lambda: self.client.put(reverse('error_item', kwargs={'pk': item.id})),
+            lambda: self.client.put(reverse('fix_item', kwargs={'pk': item.id})),
+        ]
+        for request in requests:
+            with CaptureQueriesContext(connections['default']) as queries:
+                res = request()
+            self.assertLess(res.status_code, 300, res.data)
+            self.assertEqual(len(queries), 0)
+        self.assertEqual(Item.objects.using(TEST_SHARD).get(pk=item.pk).state, Item.CORRECTING)
+        self.assertTrue(Event.objects.using(TEST_SHARD).exists())
+
+    def test_listing_merges_shards(self):
+        res = self.client.get('/api/items?page_size=3')
+        ids = [row['id'] for row in res.data['results']]
+        res = self.client.get(res.data['next'])
+        ids += [row['id'] for row in res.data['results']]
+        self.assertIsNone(res.data['next'])
+        self.assertEqual(ids, [str(item.id) for item in reversed(self.items)])
+
+    def test_export_merges_shards(self):
+        res = self.client.get(reverse('export_items') + '?output=ndjson&chunk_size=1')
+        rows = [json.loads(line) for line in b''.join(res.streaming_content).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [str(item.id) for item in self.items])
+        self.assertTrue(all(len(row['transactions']) == 1 for row in rows))
+
+    def test_batch_transitions_span_shards(self):
+        missing = uuid.uuid4()
+        ids = [str(item.id) for item in self.items] + [str(missing)]
+        res = self.client.put(reverse('batch_move_items'), {"ids": ids}, format='json')
+        self.assertEqual(res.data['moved'], [item.id for item in self.items])
+        self.assertEqual([row['id'] for row in res.data['rejected']], [missing])
+        for item in self.items:
+            trans = Transaction.objects.using(item._state.db).get(item=item)
+            self.assertEqual(trans.location, Transaction.ROUTABLE)
+
+    def test_admin_change_page_reads_the_item_shard(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        item = self.items[1]
+        res = self.client.get(reverse('admin:api_item_change', args=(item.id, )))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertContains(res, str(Transaction.objects.using(TEST_SHARD).get(item=item).id))
+
+    def test_imported_items_are_stored_on_their_shards(self):
+        ids = [uuid.uuid4() for _ in range(20)]
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.ndjson') as ledger_file:
+            for pk in ids:
+                ledger_file.write(json.dumps({'id': str(pk), 'amount': 1, 'transactions': [{}]}) + '\n')
+            ledger_file.flush()
+            call_command('import_ledger', ledger_file.name, stdout=io.StringIO())
+        for pk in ids:
+            using = shards.for_item(pk)
+            self.assertTrue(Item.objects.using(using).filter(pk=pk).exists())
+            self.assertTrue(Transaction.objects.using(using).filter(item_id=pk).exists())
+
+    def test_dispatch_events_of_every_shard(self):
+        with WebhookStandIn() as webhook:
+            delivered, failed = events.dispatch(webhook.url, workers=1, once=True)
+        self.assertEqual((delivered, failed), (4, 0))
+        self.assertEqual(
+            Counter(event['shard'] for event in webhook.received),
+            {'default': 2, TEST_SHARD: 2}
+        )
+
+
+@override_settings(DATABASE_SHARDS=['default', TEST_SHARD], QUERY_BUDGET_HEADERS=True)
+class ShardFanOutTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def test_listing_reads_shards_in_parallel(self):
+        items = [create_item_on(alias, amount=1000) for alias in ('default', TEST_SHARD)]
+        for minute, item in enumerate(items):
+            set_created_at(item, minute)
+
+        threads = set()
+        fan_out = shards.fan_out
+
+        def spy(function, querysets):
+            def call(queryset):
+                threads.add(threading.get_ident())
+                return function(queryset)
+            return fan_out(call, querysets)
+
+        with mock.patch.object(shards, 'fan_out', spy):
+            res = self.client.get('/api/items')
+        self.assertEqual([row['id'] for row in res.data['results']], [str(items[1].id), str(items[0].id)])
+        self.assertNotIn(threading.get_ident(), threads)
+        # the queries of the pool threads count against the request's budget
+        self.assertEqual(res['X-Query-Count'], '2')
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_export_reads_shards_in_parallel(self):
+        items = [create_item_on(alias, amount=1000) for alias in ('default', TEST_SHARD) * 3]
+        for minute, item in enumerate(items):
+            set_created_at(item, minute)
+
+        reads = []
+        fan_out = shards.fan_out
+
+        def spy(function, querysets):
+            def call(queryset):
+                reads.append((threading.get_ident(), queryset.db))
+                return function(queryset)
+            return fan_out(call, querysets)
+
+        with mock.patch.object(shards, 'fan_out', spy):
+            res = self.client.get(reverse('export_items') + '?output=ndjson')
+            rows = [json.loads(line) for line in b''.join(res.streaming_content).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [str(item.id) for item in items])
+        self.assertNotIn(threading.get_ident(), {thread for thread, _ in reads})
+        # every chunk of both shards, the default one read from its replica
+        self.assertEqual(len(reads), 4)
+        self.assertIn(TEST_SHARD, {alias for _, alias in reads})
+
+
+class LedgerImportTestCase(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.items = [Item.objects.create(amount=amount) for amount in (10, 20, 30)]
+        for minute, item in enumerate(self.items):
+            set_created_at(item, minute)
+        trans = Transaction.objects.create(item=self.items[0])
+        trans.move_transaction(Transaction.PROCESSING, Transaction.ROUTABLE)
+        trans.error_transaction()
+        trans.replace_transaction(Transaction.FIXING, Transaction.ROUTABLE)
+        Transaction.objects.create(item=self.items[1])
+
+    def export(self, format):
+        output = tempfile.NamedTemporaryFile(mode='w+', suffix='.' + format)
+        call_command('export_items', '--format', format, '--output', output.name)
+        return output
+
+    def snapshot(self):
+        return (
+            list(Item.objects.order_by('pk').values_list()),
+            list(Transaction.objects.order_by('pk').values_list()),
+        )
+
+    def test_import_round_trips_exports(self):
+        expected = self.snapshot()
+        for format in ('csv', 'ndjson'):
+            with self.export(format) as ledger_file:
+                Item.objects.all().delete()
+                out = io.StringIO()
+                call_command('import_ledger', ledger_file.name, stdout=out)
+            self.assertIn('Imported 3 items and 3 transactions, rejected 0 records', out.getvalue())
+            self.assertEqual(self.snapshot(), expected)
+
+    def test_import_validates_in_worker_processes(self):
+        expected = self.snapshot()
+        with self.export('ndjson') as ledger_file:
+            Item.objects.all().delete()
+            call_command(
+                'import_ledger', ledger_file.name, '--workers', '2', '--batch-size', '1',
+                stdout=io.StringIO()
+            )
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_invalid_records_are_rejected(self):
+        lines = [
+            {'id': str(uuid.uuid4()), 'amount': '12.50'},
+            {'id': 'not-a-uuid', 'amount': '1'},
+            {'id': str(uuid.uuid4()), 'amount': '0.001'},
+            {'id': str(uuid.uuid4()), 'amount': '1', 'state': 'lost'},
+            {'id': str(uuid.uuid4()), 'amount': '1', 'transactions': [{}, {'status': 'error'}]},
+        ]
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.ndjson') as ledger_file:
+            ledger_file.write('\n'.join(json.dumps(line) for line in lines) + '\n{\n')
+            ledger_file.flush()
+            out, err = io.StringIO(), io.StringIO()
+            call_command('import_ledger', ledger_file.name, verbosity=2, stdout=out, stderr=err)
+        self.assertIn('Imported 1 items and 0 transactions, rejected 5 records', out.getvalue())
+        self.assertIn('Line 2: Invalid item id', err.getvalue())
+        self.assertIn('Line 5: More than one active transaction', err.getvalue())
+        self.assertTrue(Item.objects.filter(pk=lines[0]['id'], state=Item.PROCESSING).exists())
+
+    def test_import_resumes_from_checkpoint(self):
+        with self.export('csv') as ledger_file, tempfile.TemporaryDirectory() as directory:
+            Item.objects.exclude(pk=self.items[0].pk).delete()
+            checkpoint = os.path.join(directory, 'checkpoint.json')
+            with open(checkpoint, 'w') as stream:
+                json.dump({'records': 1, 'items': 1, 'transactions': 2, 'rejected': 0}, stream)
+            out = io.StringIO()
+            call_command(
+                'import_ledger', ledger_file.name, '--checkpoint', checkpoint, stdout=out
+            )
+            with open(checkpoint) as stream:
+                self.assertEqual(json.load(stream)['records'], 3)
+        self.assertIn('Imported 3 items and 3 transactions', out.getvalue())
+        self.assertEqual(Item.objects.count(), 3)
+
+    def test_interrupted_batch_is_not_imported_twice(self):
+        with self.export('ndjson') as ledger_file, tempfile.TemporaryDirectory() as directory:
+            Item.objects.exclude(pk=self.items[0].pk).delete()
+            out = io.StringIO()
+            call_command(
+                'import_ledger', ledger_file.name,
+                '--checkpoint', os.path.join(directory, 'checkpoint.json'), stdout=out
+            )
+        self.assertIn('Imported 2 items and 1 transactions', out.getvalue())
+        self.assertEqual(Item.objects.count(), 3)
+
+    def test_deferred_indexes_are_rebuilt(self):
+        def index_names():
+            with connection.cursor() as cursor:
+                return set(connection.introspection.get_constraints(cursor, Transaction._meta.db_table))
+
+        indexes = index_names()
+        with self.export('csv') as ledger_file:
+            Item.objects.all().delete()
+            call_command('import_ledger', ledger_file.name, '--defer-indexes', stdout=io.StringIO())
+        self.assertEqual(index_names(), indexes)
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_import_resumes_with_indexes_dropped(self):
+        def index_names():
+            with connection.cursor() as cursor:
+                return set(connection.introspection.get_constraints(cursor, Item._meta.db_table))
+
+        indexes = index_names()
+        with self.export('csv') as ledger_file:
+            Item.objects.all().delete()
+            # as left by an import killed before rebuilding them
+            ledger.drop_indexes('default')
+            call_command('import_ledger', ledger_file.name, '--defer-indexes', stdout=io.StringIO())
+        self.assertEqual(index_names(), indexes)
+        ledger.create_indexes('default')
+        self.assertEqual(index_names(), indexes)
+        self.assertEqual(Item.objects.count(), 3)
+
+
+def resolve_item(item, days_ago):
+    """
+    Completes a transaction of item and backdates its resolution.
+    """
+    trans = Transaction.objects.create(item=item)
+    trans.move_transaction(Transaction.COMPLETED, Transaction.DESTINATION)
+    trans.item.update_item_state(trans.status)
+    resolved_at = timezone.now() - datetime.timedelta(days=days_ago)
+    Item.objects.using(item._state.db).filter(pk=item.pk).update(updated_at=resolved_at)
+    return trans
+
+
+class ArchiveTestCase(APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.old = Item.objects.create(amount=10)
+        self.trans = resolve_item(self.old, days_ago=100)
+        self.recent = Item.objects.create(amount=20)
+        resolve_item(self.recent, days_ago=1)
+        self.processing = Item.objects.create(amount=30)
+        Item.objects.filter(pk=self.processing.pk).update(
+            updated_at=timezone.now() - datetime.timedelta(days=100)
+        )
+
+    def archive(self, *args):
+        out = io.StringIO()
+        call_command('archive', *args, stdout=out)
+        return out.getvalue()
+
+    def test_archive_moves_old_resolved_items(self):
+        self.assertIn('Archived 1 items and 1 transactions', self.archive())
+        self.assertEqual(set(Item.objects.values_list('pk', flat=True)), {self.recent.pk, self.processing.pk})
+        self.assertFalse(Transaction.objects.filter(item_id=self.old.pk).exists())
+
+        archived = ArchivedItem.objects.get(pk=self.old.pk)
+        self.assertEqual((archived.amount, archived.state), (10, Item.RESOLVED))
+        self.assertEqual(archived.created_at, self.old.created_at)
+        archived_trans = ArchivedTransaction.objects.get(item=archived)
+        self.assertEqual(
+            (archived_trans.pk, archived_trans.status, archived_trans.is_active),
+            (self.trans.pk, Transaction.COMPLETED, False)
+        )
+        self.assertIn('Archived 0 items', self.archive())
+
+    def test_archive_runs_in_batches(self):
+        resolve_item(Item.objects.create(amount=40), days_ago=100)
+        self.assertIn('Archived 3 items', self.archive('--days', '0', '--batch-size', '2'))
+        self.assertEqual(ArchivedItem.objects.count(), 3)
+        self.assertEqual(Item.objects.get().pk, self.processing.pk)
+
+    def test_archive_refreshes_the_size_estimates(self):
+        self.archive('--days', '0')
+        self.assertEqual(paginators.estimate_count(Item), 1)
+        # ANALYZE keeps no statistics of empty tables, they are counted
+        self.assertIsNone(paginators.estimate_count(Transaction))
+
+    def test_item_lookups_fall_back_to_the_archive(self):
+        url = reverse('item_detail', kwargs={'pk': self.old.pk})
+        self.assertEqual(self.client.get(url).data['state'], Item.RESOLVED)
+        self.archive()
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['id'], str(self.old.pk))
+
+        res = self.client.get(reverse('list_item_transactions', kwargs={'pk': self.old.pk}))
+        self.assertEqual([row['id'] for row in res.data['results']], [str(self.trans.pk)])
+        self.assertEqual(res.data['results'][0]['item'], self.old.pk)
+
+        self.assertEqual(self.client.get(reverse('item_detail', kwargs={'pk': uuid.uuid4()})).status_code, 404)
+
+    def test_transactions_of_archived_items_are_rejected(self):
+        self.archive()
+        res = self.client.post(
+            '/api/items/transaction',
+            {"item": str(self.old.pk), "status": "processing", "location": "origination_bank"}
+        )
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(res.data, 'Item is resolved and archived')
+
+    def test_admin_shows_archived_items(self):
+        self.archive()
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        self.assertContains(self.client.get(reverse('admin:api_archiveditem_changelist')), str(self.old.pk))
+        res = self.client.get(reverse('admin:api_archiveditem_change', args=(self.old.pk, )))
+        self.assertContains(res, str(self.trans.pk))
+
+    @override_settings(DATABASE_SHARDS=['default', TEST_SHARD])
+    def test_items_are_archived_on_their_shard(self):
+        items = [create_item_on(alias, amount=1) for alias in ('default', TEST_SHARD)]
+        for item in items:
+            resolve_item(item, days_ago=100)
+        self.archive()
+        for item in items:
+            self.assertTrue(ArchivedItem.objects.using(item._state.db).filter(pk=item.pk).exists())
+            self.assertTrue(ArchivedTransaction.objects.using(item._state.db).filter(item_id=item.pk).exists())
+            self.assertEqual(archive.get_item(item.pk).pk, item.pk)
+
+
+class StatsTestCase(APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.items = [Item.objects.create(amount=amount) for amount in ('10.50', '20.25', '30.00')]
+        for item in self.items:
+            Transaction.objects.create(item=item)
+
+    def assertCountersMatchRows(self):
+        for using in settings.DATABASE_SHARDS:
+            counters = stats.read_counters([StatCounter.objects.using(using)])
+            self.assertEqual(
+                {key: total for key, total in counters.items() if total != (0, 0)},
+                stats.count_rows(using)
+            )
+
+    def test_stats_are_read_from_the_counters(self):
+        with self.assertNumQueries(1):
+            res = self.client.get(reverse('stats'))
+        self.assertEqual(res.data['items']['processing'], {'count': 3, 'amount': '60.75'})
+        self.assertEqual(res.data['items']['resolved'], {'count': 0, 'amount': '0.00'})
+        self.assertEqual(res.data['transactions']['processing']['origination_bank'], 3)
+        self.assertEqual(res.data['transactions']['completed']['destination_bank'], 0)
+
+    def test_counters_follow_every_write(self):
+        item = self.items[0]
+        self.client.post('/api/items', {"amount": 5})
+        self.client.post('/api/items/bulk', [{"amount": 1}] * 3, format='json')
+        self.client.put(reverse('move_item', kwargs={'pk': item.id}))
+        self.client.put(reverse('error_item', kwargs={'pk': item.id}))
+        self.client.put(reverse('fix_item', kwargs={'pk': item.id}))
+        ids = [str(item.id) for item in self.items]
+        self.client.put(reverse('batch_move_items'), {"ids": ids}, format='json')
+        self.client.put(reverse('batch_move_items'), {"ids": ids}, format='json')
+        self.client.put(reverse('batch_error_items'), {"ids": ids}, format='json')
+        self.client.put(reverse('batch_fix_items'), {"ids": ids}, format='json')
+        batch.refund_items(ids)
+        self.assertCountersMatchRows()
+
+        res = self.client.get(reverse('stats'))
+        self.assertEqual(res.data['items']['processing'], {'count': 4, 'amount': '8.00'})
+        self.assertEqual(sum(state['count'] for state in res.data['items'].values()), 7)
+
+    def test_admin_changes_and_deletes_update_the_counters(self):
+        item = self.items[0]
+        item.amount, item.state = 99, Item.ERROR
+        item.save()
+        Transaction.objects.get(item=self.items[1]).delete()
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        data = {'action': 'delete_selected', '_selected_action': [str(self.items[2].pk)], 'post': 'yes'}
+        res = self.client.post(reverse('admin:api_item_changelist'), data)
+        self.assertEqual(res.status_code, status.HTTP_302_FOUND)
+        self.assertEqual(Item.objects.count(), 2)
+        self.assertCountersMatchRows()
+
+    def test_imported_and_archived_items_stay_counted(self):
+        trans = Transaction.objects.get(item=self.items[0])
+        trans.move_transaction(Transaction.COMPLETED, Transaction.DESTINATION)
+        trans.item.update_item_state(trans.status)
+        call_command('archive', '--days', '0', stdout=io.StringIO())
+        self.assertEqual(ArchivedItem.objects.count(), 1)
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.ndjson') as ledger_file:
+            ledger_file.write(json.dumps({'id': str(uuid.uuid4()), 'amount': '2.00', 'transactions': [{}]}))
+            ledger_file.flush()
+            call_command('import_ledger', ledger_file.name, stdout=io.StringIO())
+        self.assertCountersMatchRows()
+        self.assertEqual(self.client.get(reverse('stats')).data['items']['resolved']['count'], 1)
+
+    def test_rebuild_stats_reports_and_fixes_drift(self):
+        Item.objects.filter(pk=self.items[0].pk).update(state=Item.ERROR)
+        out = io.StringIO()
+        call_command('rebuild_stats', '--dry-run', stdout=out)
+        self.assertIn('default: item error counted 0 (0.00), actually 1 (10.50)', out.getvalue())
+        self.assertIn('Found 2 drifted counters', out.getvalue())
+
+        out = io.StringIO()
+        call_command('rebuild_stats', stdout=out)
+        self.assertIn('fixed 2 drifted counters', out.getvalue())
+        self.assertCountersMatchRows()
+        self.assertEqual(StatCounter.objects.filter(kind=StatCounter.ITEM).count(), 2)
+
+    @override_settings(DATABASE_SHARDS=['default', TEST_SHARD])
+    def test_counters_are_kept_per_shard(self):
+        items = [create_item_on(alias, amount=1) for alias in ('default', TEST_SHARD)]
+        self.client.put(
+            reverse('batch_move_items'), {"ids": [str(item.id) for item in items]}, format='json'
+        )
+        self.assertCountersMatchRows()
+        self.assertTrue(StatCounter.objects.using(TEST_SHARD).exists())
+        self.assertEqual(self.client.get(reverse('stats')).data['items']['processing']['count'], 5)
+
+
+class TimeOrderedIdTestCase(APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.items = [Item.objects.create(amount=amount) for amount in range(1, 6)]
+
+    def collect_pages(self, url, page_size):
+        pks, next_url = [], '%s?page_size=%d' % (url, page_size)
+        while next_url:
+            res = self.client.get(next_url)
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            pks.extend(row['id'] for row in res.data['results'])
+            next_url = res.data['next']
+        return pks
+
+    def test_ids_are_ordered_by_creation(self):
+        generated = [ids.uuid7() for _ in range(10000)]
+        self.assertEqual(len(set(generated)), len(generated))
+        self.assertEqual(sorted(generated), generated)
+        self.assertEqual(sorted(pk.hex for pk in generated), [pk.hex for pk in generated])
+        self.assertEqual({pk.version for pk in generated}, {7})
+
+        trans = Transaction.objects.create(item=self.items[0])
+        self.assertEqual((self.items[0].id.version, trans.id.version), (7, 7))
+        self.assertEqual(sorted(item.id for item in self.items), [item.id for item in self.items])
+
+    def test_uuid4_rows_keep_working(self):
+        legacy = Item.objects.create(id=uuid.uuid4(), amount=1)
+        Transaction.objects.create(id=uuid.uuid4(), item=legacy)
+        res = self.client.get(reverse('item_detail', kwargs={'pk': legacy.id}))
+        self.assertEqual(res.data['id'], str(legacy.id))
+        res = self.client.put(reverse('move_item', kwargs={'pk': legacy.id}))
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(self.collect_pages('/api/items', 2)), 6)
+
+    @override_settings(KEYSET_PAGINATION_ON_ID=True)
+    def test_pagination_on_id_alone(self):
+        Item.objects.update(created_at=self.items[0].created_at)
+        with CaptureQueriesContext(connection) as queries:
+            pks = self.collect_pages('/api/items', 2)
+        self.assertEqual(pks, [str(item.id) for item in reversed(self.items)])
+        self.assertIn('ORDER BY "api_item"."id" DESC LIMIT', queries[0]['sql'])
+        self.assertNotIn('created_at', queries[-1]['sql'].split('WHERE')[1])
+
+    def test_cursors_of_the_other_ordering_are_rejected(self):
+        res = self.client.get('/api/items?page_size=2')
+        with override_settings(KEYSET_PAGINATION_ON_ID=True):
+            self.assertEqual(self.client.get(res.data['next']).status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(KEYSET_PAGINATION_ON_ID=True, DATABASE_SHARDS=['default', TEST_SHARD])
+    def test_pagination_on_id_merges_shards(self):
+        items = self.items + [create_item_on(alias, amount=1) for alias in ('default', TEST_SHARD) * 2]
+        self.assertEqual(self.collect_pages('/api/items', 3), [str(item.id) for item in reversed(items)])
+
+
+class FastSerializationTestCase(APITestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.item = Item.objects.create(amount=10.5)
+        self.trans = Transaction.objects.create(item=self.item)
+        self.item.refresh_from_db()
+        self.trans.refresh_from_db()
+
+    def test_output_matches_the_fields(self):
+        for serializer in (ItemSerializer(self.item), TransactionSerializer(self.trans)):
+            instance = serializer.instance
+            self.assertEqual(serializer.data, serializers.Serializer.to_representation(serializer, instance))
+        self.assertEqual(ItemSerializer(self.item).data['amount'], '10.50')
+        self.assertEqual(TransactionSerializer(self.trans).data['item'], self.item.id)
+
+        unsaved = Item(amount=3)
+        self.assertEqual(ItemSerializer(unsaved).data['amount'], '3.00')
+        self.assertIsNone(ItemSerializer(unsaved).data['created_at'])
+
+    def test_instances_get_their_own_fields(self):
+        first, second = ItemSerializer(), ItemSerializer()
+        self.assertIsNot(first.fields['amount'], second.fields['amount'])
+        self.assertIs(second.fields['amount'].parent, second)
+
+        serializer = ItemSerializer(data={'amount': 'abc'})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors, {'amount': ['A valid number is required.']})
+        serializer = TransactionSerializer(data={'item': str(uuid.uuid4())})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['item'][0].code, 'does_not_exist')
+
+    def test_renderer_matches_json_renderer(self):
+        data = {
+            'id': uuid.uuid4(),
+            'amount': decimal.Decimal('10.50'),
+            'created_at': timezone.now().replace(microsecond=123456),
+            'date': datetime.date(2020, 5, 1),
+            'message': 'line\u2028separator caf\xe9',
+            'errors': serializers.ValidationError({'amount': ['Invalid']}).detail,
+            'rows': [ItemSerializer(self.item).data],
+            1: None,
+        }
+        for media_type in (None, 'application/json; indent=2'):
+            self.assertEqual(
+                FastJSONRenderer().render(data, media_type), JSONRenderer().render(data, media_type)
+            )
+        with mock.patch('api.renderers.orjson', None):
+            self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render(None), b'')
+
+    def test_parser(self):
+        body = json.dumps({'amount': '10.50', 'name': 'caf\xe9'}).encode()
+        self.assertEqual(FastJSONParser().parse(io.BytesIO(body)), {'amount': '10.50', 'name': 'caf\xe9'})
+        for invalid in (b'{"amount": ', b'{"amount": NaN}'):
+            with self.assertRaises(ParseError):
+                FastJSONParser().parse(io.BytesIO(invalid))
+        with mock.patch('api.parsers.orjson', None):
+            self.assertEqual(FastJSONParser().parse(io.BytesIO(body))['name'], 'caf\xe9')
+
+    def test_endpoints_render_with_fast_json(self):
+        res = self.client.post('/api/items', {'amount': 12}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.content, FastJSONRenderer().render(res.data))
+        self.assertEqual(json.loads(res.content)['amount'], '12.00')
+
+
+class SchemaTestCase(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.schema_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.schema_dir)
+        call_command('generate_schema', output=self.schema_dir, stdout=io.StringIO())
+
+    def use_urls(self, schema_dir):
+        urls = types.ModuleType('schema_urls')
+        urls.urlpatterns = [path('api/', include('api.urls'))] + schema.get_urlpatterns(schema_dir)
+        return override_settings(ROOT_URLCONF=urls)
+
+    def get_urls(self, document):
+        return {document['basePath'].rstrip('/') + url for url in document['paths']}
+
+    def test_generate_schema_check(self):
+        call_command('generate_schema', output=self.schema_dir, check=True, stdout=io.StringIO())
+        with open(os.path.join(self.schema_dir, 'openapi.json'), 'wb') as stale:
+            stale.write(b'{}')
+        with self.assertRaises(CommandError):
+            call_command('generate_schema', output=self.schema_dir, check=True, stdout=io.StringIO())
+
+    def test_documents_are_served_with_an_etag(self):
+        with self.use_urls(self.schema_dir):
+            res = self.client.get('/swagger.json')
+            self.assertEqual(res['Content-Type'], 'application/json; charset=utf-8')
+            self.assertIn('/api/items', json.loads(res.content)['paths'])
+            self.assertIn('no-cache', res['Cache-Control'])
+
+            cached = self.client.get('/swagger.json', HTTP_IF_NONE_MATCH=res['ETag'])
+            self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
+            self.assertEqual(cached['ETag'], res['ETag'])
+
+            ui_schema = self.client.get('/?format=openapi')
+            self.assertEqual(ui_schema.content, res.content)
+            self.assertEqual(ui_schema['Content-Type'], 'application/openapi+json; charset=utf-8')
+            self.assertTrue(self.client.get('/swagger.yaml').content.startswith(b"swagger: '2.0'"))
+            self.assertEqual(self.client.get('/?format=xml').status_code, status.HTTP_404_NOT_FOUND)
+
+            page = self.client.get('/')
+            self.assertContains(page, 'swagger-ui-bundle.js')
+            self.assertContains(page, 'csrfmiddlewaretoken')
+
+    def test_schema_is_generated_per_request_without_artifacts(self):
+        with self.use_urls(os.path.join(self.schema_dir, 'missing')):
+            res = self.client.get('/swagger.json')
+        with open(os.path.join(self.schema_dir, 'openapi.json'), 'rb') as artifact:
+            self.assertEqual(self.get_urls(json.loads(res.content)), self.get_urls(json.loads(artifact.read())))
+
+    def test_drf_yasg_views_are_not_imported_with_artifacts(self):
+        code = (
+            'import sys, django; django.setup(); import routable.urls; '
+            'print(sorted(m for m in ("drf_yasg.views", "drf_yasg.codecs") if m in sys.modules))'
+        )
+        for schema_dir, imported in ((self.schema_dir, '[]'), (os.path.join(self.schema_dir, 'missing'), 'drf_yasg')):
+            output = subprocess.run(
+                [sys.executable, '-c', code], cwd=settings.BASE_DIR, check=True, stdout=subprocess.PIPE,
+                universal_newlines=True,
+                env=dict(os.environ, DJANGO_SETTINGS_MODULE='routable.settings', SCHEMA_DIR=schema_dir),
+            ).stdout
+            self.assertIn(imported, output)
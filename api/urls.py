@@ -5,8 +5,17 @@ from api import views
 
 urlpatterns = [
     path('items', views.ItemCreateView.as_view(), name='create_item'),
+    path('items/bulk', views.ItemBulkCreateView.as_view(), name='bulk_create_items'),
+    path('items/export', views.ItemExportView.as_view(), name='export_items'),
+    path('items/cache/stats', views.ItemCacheStatsView.as_view(), name='item_cache_stats'),
+    path('items/<uuid:pk>', views.ItemDetailView.as_view(), name='item_detail'),
+    path('items/<uuid:pk>/transactions', views.ItemTransactionListView.as_view(), name='list_item_transactions'),
     path('items/transaction', views.TransactionCreateView.as_view(), name='create_transaction'),
+    path('items/move', views.BatchMoveItemView.as_view(), name='batch_move_items'),
+    path('items/error', views.BatchErrorItemView.as_view(), name='batch_error_items'),
+    path('items/fix', views.BatchFixItemView.as_view(), name='batch_fix_items'),
     path('items/move/<uuid:pk>/', views.MoveItemView.as_view(), name="move_item"),
     path('items/error/<uuid:pk>/', views.ErrorItemView.as_view(), name='error_item'),
     path('items/fix/<uuid:pk>/', views.FixItemView.as_view(), name='fix_item'),
+    path('stats', views.StatsView.as_view(), name='stats'),
 ]
@@ -1,20 +1,64 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from drf_yasg.utils import swagger_auto_schema
 
-from api.models import Item, Transaction
-from api.serializers import ItemSerializer, TransactionSerializer
+from api import archive, batch, export, idempotency, item_cache, metrics, shards, state_machine, stats
+from api.idempotency import idempotent
+from api.models import ArchivedTransaction, Item, Transaction, TransitionConflict
+from api.pagination import KeysetPagination
+from api.parsers import FastJSONParser, NDJSONParser
+from api.serializers import (
+    ExportFilterSerializer, ItemFilterSerializer, ItemIdsSerializer, ItemSerializer, TransactionFilterSerializer,
+    TransactionSerializer,
+)
+from api.sqlite import retry_on_busy
+from api.state_machine import InvalidTransition
+from routable import routers
+from routable.middleware import exempt_from_query_budget
+
+
+TRANSITION_CONFLICT = 'Item transaction was changed by another request'
+ITEM_ARCHIVED = 'Item is resolved and archived'
 
 
 class ItemCreateView(APIView):
     """
+    get:
+    Lists items, newest first, a page at a time.
+    params :
+        - state (optional)
+        - cursor (optional), from the `next` link of the previous page
+        - page_size (optional)
+
+    post:
     Creates a new item.
     params :
         - amount
     """
+    # the listing reads a page from every shard, a creation also writes the
+    # summary counters
+    query_budget = 1 + idempotency.QUERY_BUDGET
+    query_budget_per_shard = 1
+
+    @swagger_auto_schema(query_serializer=ItemFilterSerializer, operation_description="List items")
+    def get(self, request):
+        filters = ItemFilterSerializer(data=request.query_params.dict())
+        if not filters.is_valid():
+            return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = KeysetPagination()
+        page = paginator.paginate_querysets(
+            shards.across(Item.objects.filter(**filters.validated_data)), request, view=self
+        )
+        return paginator.get_paginated_response(ItemSerializer(page, many=True).data)
 
     @swagger_auto_schema(request_body=ItemSerializer,operation_description="Create transaction item")
+    @idempotent
+    @retry_on_busy
     def post(self, request):
         serializer = ItemSerializer(data=request.data)
         if serializer.is_valid():
@@ -24,6 +68,138 @@ class ItemCreateView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class ItemBulkCreateView(APIView):
+    """
+    Creates items in bulk from a JSON array or an NDJSON body.
+    Rows failing validation are reported back and do not fail the batch.
+    params :
+        - [{amount}, ...]
+    """
+    # one INSERT per ITEM_BULK_CREATE_BATCH_SIZE rows and the counters, in a
+    # transaction per shard
+    query_budget = 0
+    query_budget_per_shard = 4
+    parser_classes = (FastJSONParser, NDJSONParser)
+
+    @swagger_auto_schema(request_body=ItemSerializer(many=True), operation_description="Create items in bulk")
+    def post(self, request):
+        serializer = ItemSerializer(data=request.data, many=True)
+        valid, invalid = serializer.partition()
+
+        # ids are generated client side, so they are known before the insert
+        items = [Item(**data) for _, data in valid]
+        for using, shard_items in shards.partition(items, key=lambda item: item.pk).items():
+            changes = stats.Changes()
+            for item in shard_items:
+                changes.add_items(item.state, 1, item.amount)
+            with transaction.atomic(using=using):
+                Item.objects.using(using).bulk_create(
+                    shard_items, batch_size=settings.ITEM_BULK_CREATE_BATCH_SIZE
+                )
+                changes.save(using)
+
+        data = {
+            'ids': [item.id for item in items],
+            'errors': [{'index': index, 'errors': errors} for index, errors in invalid],
+        }
+        if invalid and not items:
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+class ItemDetailView(APIView):
+    """
+    Returns an Item, served from the item cache when possible. Archived
+    items are read from the archive.
+    """
+    query_budget = 2
+    # a lagging replica would put a stale item in the cache
+    use_replica = False
+
+    def get(self, request, pk):
+        def load():
+            item = archive.get_item(pk)
+            return dict(ItemSerializer(item).data) if item else None
+
+        data = item_cache.get(pk, load)
+        if data is None:
+            return Response('Item doesnt exist', status=status.HTTP_404_NOT_FOUND)
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class ItemCacheStatsView(APIView):
+    """
+    Returns the hit and miss counts of the item cache in this process.
+    """
+    query_budget = 0
+
+    def get(self, request):
+        return Response(item_cache.get_stats(), status=status.HTTP_200_OK)
+
+
+class ItemTransactionListView(APIView):
+    """
+    Lists an Item's transactions, newest first, a page at a time, from the
+    archive once the item was archived.
+    params :
+        - status, location, is_active (optional)
+        - cursor (optional), from the `next` link of the previous page
+        - page_size (optional)
+    """
+    query_budget = 2
+
+    @swagger_auto_schema(query_serializer=TransactionFilterSerializer)
+    def get(self, request, pk):
+        filters = TransactionFilterSerializer(data=request.query_params.dict())
+        if not filters.is_valid():
+            return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        using = routers.get_read_alias(shards.for_item(pk))
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(
+            Transaction.objects.using(using).filter(item_id=pk, **filters.validated_data),
+            request, view=self
+        )
+        if not page:
+            # archiving moves all the transactions of an item at once
+            page = paginator.paginate_queryset(
+                ArchivedTransaction.objects.using(using).filter(item_id=pk, **filters.validated_data),
+                request, view=self
+            )
+        return paginator.get_paginated_response(TransactionSerializer(page, many=True).data)
+
+
+class ItemExportView(APIView):
+    """
+    Streams every Item with its transactions as CSV (one row per transaction)
+    or NDJSON (one line per item), oldest first.
+    params :
+        - output = csv | ndjson (optional)
+        - state, created_after, created_before (optional)
+    """
+    # the export runs its queries while the response streams, after the
+    # budget is checked
+    query_budget = 0
+
+    @swagger_auto_schema(query_serializer=ExportFilterSerializer)
+    def get(self, request):
+        filters = ExportFilterSerializer(data=request.query_params.dict())
+        if not filters.is_valid():
+            return Response(filters.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        options = dict(filters.validated_data)
+        output = options.pop('output')
+        # the rows are read while streaming, after the request's routing
+        # ended, so the export is bound to its databases now
+        querysets = shards.across(export.filter_items(**options))
+        response = StreamingHttpResponse(
+            export.iter_export(querysets, output),
+            content_type=export.CONTENT_TYPES[output]
+        )
+        response['Content-Disposition'] = 'attachment; filename="items.%s"' % output
+        return response
+
+
 class TransactionCreateView(APIView):
     """
     Creates a new Item transaction, if it has no existing active transaction.
@@ -33,34 +209,26 @@ class TransactionCreateView(APIView):
         - status = processing
         - location = origination_bank
     """
+    query_budget = 7 + idempotency.QUERY_BUDGET
     @swagger_auto_schema(request_body=TransactionSerializer, operation_description='Create Item Transaction')
+    @idempotent
     def post(self, request):
         data = request.data
         item_pk = data.get('item', None)
         status_ = data.get('status', None)
         location = data.get('location', None)
 
+        using = shards.for_item(item_pk)
         try:
-            item_obj = Item.objects.get(id=item_pk)
+            item_obj = Item.objects.using(using).get(id=item_pk)
         except Item.DoesNotExist:
+            if archive.is_archived(item_pk):
+                return Response(ITEM_ARCHIVED, status=status.HTTP_400_BAD_REQUEST)
             return Response('Item doesnt exist', status=status.HTTP_400_BAD_REQUEST)
 
-        transactions = Transaction.objects.filter(item__pk=item_pk)
-        if transactions.filter(is_active=True):
-            return Response(
-                'There is an active transaction for this item', 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        elif transactions.filter(status=Transaction.COMPLETED):
-            return Response(
-                'Item transaction completed', 
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        elif transactions.filter(status=Transaction.REFUNDED):
-            return Response(
-                'Item transaction refunded', 
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        reason = Transaction.get_create_block_reason(item_pk)
+        if reason:
+            return Response(reason, status=status.HTTP_400_BAD_REQUEST)
         
         # Ensure for each new transaction status = processing and location = origin on creation
         if status_ != Transaction.PROCESSING or location != Transaction.ORIGIN:
@@ -71,7 +239,15 @@ class TransactionCreateView(APIView):
         
         serializer = TransactionSerializer(data=request.data)
         if serializer.is_valid():
-            serializer.save()
+            try:
+                with transaction.atomic(using=using):
+                    serializer.save()
+            except IntegrityError:
+                # a concurrent request created the active transaction first
+                return Response(
+                    'There is an active transaction for this item', 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -81,10 +257,13 @@ class MoveItemView(APIView):
     """
     Moves an Item’s active Transaction status and location to next possible states 
     """
-    def put(self, request, pk):
+    query_budget = 6
 
+    @retry_on_busy
+    def put(self, request, pk):
+        using = shards.for_item(pk)
         try:
-            trans_obj = Transaction.objects.get(
+            trans_obj = Transaction.objects.using(using).select_related('item').get(
                 item__pk=pk, 
                 is_active=True
             )
@@ -100,13 +279,16 @@ class MoveItemView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        new_status, new_location = trans_obj.get_new_transaction_state()
-        # update transaction status and location
-        trans_obj.move_transaction(new_status, new_location)
+        try:
+            new_status, new_location = trans_obj.get_new_transaction_state()
+        except InvalidTransition:
+            return Response(batch.INVALID_STATE, status=status.HTTP_400_BAD_REQUEST)
 
-        # update item state
-        item_obj = Item.objects.get(pk=pk)
-        item_obj.update_item_state(trans_obj.status)
+        try:
+            # update transaction status and location, and item state
+            trans_obj.move_transaction(new_status, new_location, item=trans_obj.item)
+        except TransitionConflict:
+            return Response(TRANSITION_CONFLICT, status=status.HTTP_409_CONFLICT)
 
         return Response("Item moved", status=status.HTTP_200_OK)
 
@@ -115,9 +297,13 @@ class ErrorItemView(APIView):
     """
     Marks an Item’s active Transaction status from processing to error
     """
+    query_budget = 6
+
+    @retry_on_busy
     def put(self, request, pk):
+        using = shards.for_item(pk)
         try:
-            trans_obj = Transaction.objects.get(
+            trans_obj = Transaction.objects.using(using).select_related('item').get(
                 item__pk=pk, 
                 is_active=True, 
                 location=Transaction.ROUTABLE,
@@ -133,12 +319,11 @@ class ErrorItemView(APIView):
                 'Item transaction already errored', 
                 status=status.HTTP_400_BAD_REQUEST
             )
-        # update item transaction state to error
-        trans_obj.error_transaction()
-
-        # update item state
-        item_obj = Item.objects.get(pk=pk)
-        item_obj.update_item_state(trans_obj.status)
+        try:
+            # update item transaction state to error, and item state
+            trans_obj.error_transaction(item=trans_obj.item)
+        except TransitionConflict:
+            return Response(TRANSITION_CONFLICT, status=status.HTTP_409_CONFLICT)
 
         return Response(
             "Item status changed to error", 
@@ -150,9 +335,13 @@ class FixItemView(APIView):
     """
     Fixes the transaction in error state, creates new transaction with status fixing.
     """
+    query_budget = 12
+
+    @retry_on_busy
     def put(self, request, pk):
+        using = shards.for_item(pk)
         try:
-            trans_obj = Transaction.objects.get(
+            trans_obj = Transaction.objects.using(using).select_related('item').get(
                 item__pk=pk, 
                 is_active=True,
                 status=Transaction.ERROR
@@ -162,17 +351,116 @@ class FixItemView(APIView):
                 'Action failed', 
                 status=status.HTTP_400_BAD_REQUEST
             )
-        # deactivate current active transaction in error state.
-        trans_obj.deactivate_transaction()
-
-        # Create a new transaction
-        trans_obj = Transaction.objects.create(
-            item_id=pk, 
-            status="fixing",
-            location="routable"
-        )
-        # update item state
-        item_obj = Item.objects.get(pk=pk)
-        item_obj.update_item_state(trans_obj.status)
+        try:
+            new_status, new_location = state_machine.get_transition(
+                state_machine.FIXES, trans_obj.status, trans_obj.location
+            )
+        except InvalidTransition:
+            return Response('Action failed', status=status.HTTP_400_BAD_REQUEST)
+
+        item_obj = trans_obj.item
+        try:
+            with transaction.atomic(using=using):
+                # deactivate current active transaction in error state and
+                # create a new one
+                trans_obj = trans_obj.replace_transaction(new_status, new_location)
+
+                # update item state
+                item_obj.update_item_state(trans_obj.status)
+        except TransitionConflict:
+            return Response(TRANSITION_CONFLICT, status=status.HTTP_409_CONFLICT)
 
         return Response("Fixing Item transaction", status=status.HTTP_200_OK)
+
+
+class BatchTransitionView(APIView):
+    """
+    Applies a transition to the active transactions of a list of items.
+    Items are grouped by shard and by their current status and location, and
+    each group is moved with set based updates. Query budgets hold for up to
+    ITEM_BATCH_UPDATE_SIZE ids per shard.
+    params :
+        - ids
+    """
+    transition = None
+    query_budget = None
+
+    @swagger_auto_schema(request_body=ItemIdsSerializer)
+    def put(self, request):
+        serializer = ItemIdsSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # every shard is retried on its own when the database is locked, a
+        # retry of the whole request would apply the committed shards again
+        moved, rejected = self.transition(
+            serializer.validated_data['ids'],
+            on_retry=lambda: exempt_from_query_budget(request),
+        )
+        return Response(
+            {
+                'moved': moved,
+                'rejected': [{'id': pk, 'reason': reason} for pk, reason in rejected.items()],
+            },
+            status=status.HTTP_200_OK
+        )
+
+
+class BatchMoveItemView(BatchTransitionView):
+    """
+    Moves the active transactions of a list of items to their next possible states.
+    params :
+        - ids
+    """
+    transition = staticmethod(batch.move_items)
+    # per shard, one locking SELECT and the counters, then 4 statements per
+    # (status, location) group
+    query_budget = 0
+    query_budget_per_shard = 4 + 4 * len(state_machine.MOVES)
+
+
+class BatchErrorItemView(BatchTransitionView):
+    """
+    Marks the active transactions of a list of items from processing to error.
+    params :
+        - ids
+    """
+    transition = staticmethod(batch.error_items)
+    query_budget = 0
+    query_budget_per_shard = 4 + 4 * len(state_machine.ERRORS)
+
+
+class BatchFixItemView(BatchTransitionView):
+    """
+    Fixes the transactions in error state of a list of items.
+    params :
+        - ids
+    """
+    transition = staticmethod(batch.fix_items)
+    # the errored transactions are replaced, 6 statements per group
+    query_budget = 0
+    query_budget_per_shard = 4 + 6 * len(state_machine.FIXES)
+
+
+class StatsView(APIView):
+    """
+    Returns the number and total amount of items per state, and the number
+    of transactions per status and location, read from the summary counters.
+    """
+    query_budget = 0
+    query_budget_per_shard = 1
+
+    def get(self, request):
+        return Response(stats.get_stats(), status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    """
+    Exposes request latency, rejections, SQL time and transition counts of
+    every worker process in the Prometheus text format.
+    """
+    query_budget = 0
+
+    @swagger_auto_schema(auto_schema=None)
+    def get(self, request):
+        return HttpResponse(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,164 @@
+"""
+Compares concurrent request throughput of the WSGI application, Django's
+stock ASGI handler and routable.handlers.ConcurrentASGIHandler.
+
+Every request is a POST /api/items followed by GET /api/items, issued by
+`--concurrency` clients at once. Requests are driven in process, so no
+server is needed.
+
+SQLite queries do not wait on the network, so with the default settings
+all three are bound by the GIL. `--query-latency-ms` adds a sleep to every
+query to stand in for the round trip to a database server, which is where
+serving requests from one thread costs throughput.
+
+    python -m benchmarks.asgi_vs_wsgi --requests 2000 --concurrency 16 --query-latency-ms 2
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.utils import setup_django
+
+
+CREATE_BODY = json.dumps({'amount': '12.50'}).encode()
+
+
+def wsgi_environ(method, path, body=b''):
+    return {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': '',
+        'SERVER_NAME': 'bench',
+        'SERVER_PORT': '80',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.url_scheme': 'http',
+        'wsgi.errors': io.StringIO(),
+    }
+
+
+def run_wsgi(application, requests, concurrency):
+    def start_response(status, headers, exc_info=None):
+        assert status[:3] in ('200', '201'), status
+        return lambda data: None
+
+    def call(index):
+        for method, body in (('POST', CREATE_BODY), ('GET', b'')):
+            response = application(wsgi_environ(method, '/api/items', body), start_response)
+            for _ in response:
+                pass
+            response.close()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(requests)))
+
+
+def asgi_scope(method, path, body):
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [
+            (b'host', b'bench'),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+        'server': ('bench', 80),
+        'client': ('127.0.0.1', 50000),
+    }
+
+
+def run_asgi(application, requests, concurrency):
+    statuses = []
+
+    async def call(method, body):
+        async def receive():
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+
+        await application(asgi_scope(method, '/api/items', body), receive, send)
+
+    async def client(queue):
+        while not queue.empty():
+            queue.get_nowait()
+            await call('POST', CREATE_BODY)
+            await call('GET', b'')
+
+    async def main():
+        queue = asyncio.Queue()
+        for index in range(requests):
+            queue.put_nowait(index)
+        await asyncio.gather(*(client(queue) for _ in range(concurrency)))
+
+    asyncio.run(main())
+    assert set(statuses) <= {200, 201}, set(statuses)
+
+
+def add_query_latency(seconds):
+    from django.db.backends.signals import connection_created
+
+    def wrapper(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        connection.execute_wrappers.append(wrapper)
+
+    connection_created.connect(install, weak=False)
+
+
+def measure(name, run, application, requests, concurrency):
+    start = time.perf_counter()
+    run(application, requests, concurrency)
+    elapsed = time.perf_counter() - start
+    # each request is a create and a list call
+    rate = 2 * requests / elapsed
+    print('%-24s %8.1f req/s  (%d requests in %.2fs)' % (name, rate, 2 * requests, elapsed))
+    return {'handler': name, 'requests_per_second': rate, 'seconds': elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--query-latency-ms', type=float, default=0)
+    parser.add_argument('--output', help='Writes the results as JSON to this file.')
+    args = parser.parse_args()
+
+    db_name = setup_django()
+    if args.query_latency_ms:
+        add_query_latency(args.query_latency_ms / 1000)
+    try:
+        from django.core.handlers.asgi import ASGIHandler
+        from django.core.wsgi import get_wsgi_application
+        from routable.handlers import ConcurrentASGIHandler
+
+        results = [
+            measure('wsgi (thread pool)', run_wsgi, get_wsgi_application(), args.requests, args.concurrency),
+            measure('asgi (django)', run_asgi, ASGIHandler(), args.requests, args.concurrency),
+            measure('asgi (concurrent)', run_asgi, ConcurrentASGIHandler(args.concurrency), args.requests, args.concurrency),
+        ]
+    finally:
+        os.remove(db_name)
+
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(results, stream, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+Benchmarks every endpoint of api/urls.py against a seeded SQLite database.
+
+The database is seeded with `--items` items whose transactions follow a
+realistic mix of states, plus enough items in the right state for each
+state changing endpoint to get a fresh target on every request. Each
+endpoint is then called `--requests` times through the Django test client
+and its p50/p95/p99 latency, requests per second and SQL queries per
+request are reported and written as JSON.
+
+    python -m benchmarks.endpoints --items 100000 --requests 500 --output bench.json
+    python -m benchmarks.endpoints --compare bench.json --output bench-new.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from benchmarks.utils import percentile, setup_django
+
+
+# Share of seeded items per state of their active or last transaction,
+# None standing for items without a transaction.
+STATE_MIX = (
+    (0.35, ('processing', 'origination_bank')),
+    (0.20, ('processing', 'routable')),
+    (0.25, ('completed', 'destination_bank')),
+    (0.08, ('error', 'routable')),
+    (0.04, ('fixing', 'routable')),
+    (0.03, ('refunded', 'origination_bank')),
+    (0.05, None),
+)
+
+
+def seed(count, rng):
+    """
+    Inserts count items with transactions following STATE_MIX.
+    """
+    from django.db import transaction
+    from api import state_machine
+    from api.models import Item, Transaction
+
+    weights = [weight for weight, _ in STATE_MIX]
+    states = [state for _, state in STATE_MIX]
+    with transaction.atomic():
+        for start in range(0, count, 5000):
+            items, transactions = [], []
+            for state in rng.choices(states, weights, k=min(5000, count - start)):
+                item = Item(amount=rng.randint(100, 10 ** 6) / 100)
+                items.append(item)
+                if state is None:
+                    continue
+                status, location = state
+                item.state = state_machine.get_item_state(status)
+                transactions.append(Transaction(
+                    item=item,
+                    status=status,
+                    location=location,
+                    is_active=state_machine.is_active(status)
+                ))
+            Item.objects.bulk_create(items)
+            Transaction.objects.bulk_create(transactions)
+
+
+def seed_targets(count, state=None):
+    """
+    Returns the ids of count new items, with an active transaction in state
+    when given.
+    """
+    from api.models import Item, Transaction
+
+    items = Item.objects.bulk_create([Item(amount=100) for _ in range(count)])
+    if state:
+        status, location = state
+        Transaction.objects.bulk_create([
+            Transaction(item=item, status=status, location=location) for item in items
+        ])
+    return [str(item.id) for item in items]
+
+
+def build_scenarios(requests, rng):
+    """
+    Returns (name, method, path_or_factory, body_factory) per endpoint.
+    Targets are seeded up front so the timed loop only issues requests.
+    """
+    from api.models import Item
+
+    no_transaction = seed_targets(requests)
+    at_origin = seed_targets(requests, ('processing', 'origination_bank'))
+    at_routable = seed_targets(requests, ('processing', 'routable'))
+    errored = seed_targets(requests, ('error', 'routable'))
+    batches = seed_targets(requests * 10, ('processing', 'origination_bank'))
+    sample = [str(pk) for pk in Item.objects.values_list('pk', flat=True)[:requests]]
+
+    def pop(pool):
+        return lambda index: pool[index]
+
+    return [
+        ('create_item', 'post', lambda index: '/api/items', lambda index: {'amount': '12.50'}),
+        ('bulk_create_items', 'post', lambda index: '/api/items/bulk',
+            lambda index: [{'amount': '12.50'}] * 100),
+        ('create_transaction', 'post', lambda index: '/api/items/transaction',
+            lambda index: {
+                'item': no_transaction[index],
+                'status': 'processing',
+                'location': 'origination_bank',
+            }),
+        ('move_item', 'put', lambda index: '/api/items/move/%s/' % at_origin[index], None),
+        ('error_item', 'put', lambda index: '/api/items/error/%s/' % at_routable[index], None),
+        ('fix_item', 'put', lambda index: '/api/items/fix/%s/' % errored[index], None),
+        ('batch_move_items', 'put', lambda index: '/api/items/move',
+            lambda index: {'ids': batches[index * 10:index * 10 + 10]}),
+        ('list_items', 'get', lambda index: '/api/items?state=processing', None),
+        ('item_detail', 'get', lambda index: '/api/items/%s' % rng.choice(sample), None),
+        ('list_item_transactions', 'get',
+            lambda index: '/api/items/%s/transactions' % rng.choice(sample), None),
+        ('export_items', 'get', lambda index: '/api/items/export?state=error', None),
+    ]
+
+
+def run_scenario(client, method, path, body, requests):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    latencies, queries, errors = [], 0, 0
+    start = time.perf_counter()
+    for index in range(requests):
+        kwargs = {}
+        if body is not None:
+            kwargs = {'data': json.dumps(body(index)), 'content_type': 'application/json'}
+        with CaptureQueriesContext(connection) as captured:
+            began = time.perf_counter()
+            response = getattr(client, method)(path(index), **kwargs)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            latencies.append(time.perf_counter() - began)
+        queries += len(captured)
+        if response.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - start
+
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'requests_per_second': requests / elapsed,
+        'queries_per_request': queries / requests,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, results, max_regression):
+    """
+    Prints the change of each endpoint against a previous run. Returns the
+    names of the endpoints whose p95 latency or query count regressed by
+    more than max_regression.
+    """
+    regressed = []
+    for name, result in results.items():
+        before = previous['results'].get(name)
+        if before is None:
+            continue
+        p95_change = result['p95_ms'] / before['p95_ms'] - 1 if before['p95_ms'] else 0
+        print('%-24s p95 %+6.1f%%  queries %5.1f -> %5.1f' % (
+            name, 100 * p95_change, before['queries_per_request'], result['queries_per_request']
+        ))
+        if p95_change > max_regression or result['queries_per_request'] > before['queries_per_request']:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--items', type=int, default=10000, help='Number of items to seed.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+    parser.add_argument('--only', nargs='*', help='Endpoints to run, defaults to all.')
+    parser.add_argument('--output', help='Writes the results as JSON to this file.')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with.')
+    parser.add_argument(
+        '--max-regression', 
+        type=float, 
+        default=0.2, 
+        help='Exit with an error when a p95 latency grows by more than this fraction.'
+    )
+    args = parser.parse_args()
+
+    db_name = setup_django()
+    try:
+        from django.test import Client
+
+        rng = random.Random(args.seed)
+        started = time.perf_counter()
+        seed(args.items, rng)
+        scenarios = build_scenarios(args.requests, rng)
+        print('Seeded %d items in %.1fs' % (args.items, time.perf_counter() - started))
+
+        client = Client()
+        results = {}
+        for name, method, path, body in scenarios:
+            if args.only and name not in args.only:
+                continue
+            results[name] = result = run_scenario(client, method, path, body, args.requests)
+            print('%-24s p50 %7.2fms  p95 %7.2fms  p99 %7.2fms  %8.1f req/s  %5.1f queries  %d errors' % (
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                result['requests_per_second'], result['queries_per_request'], result['errors']
+            ))
+    finally:
+        os.remove(db_name)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'items': args.items,
+            'requests': args.requests,
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump(report, stream, indent=2)
+
+    if args.compare:
+        with open(args.compare) as stream:
+            regressed = compare(json.load(stream), results, args.max_regression)
+        if regressed:
+            print('Regressed: %s' % ', '.join(regressed))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
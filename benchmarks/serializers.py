@@ -0,0 +1,104 @@
+"""
+Compares the item and transaction serializers with plain ModelSerializers
+of the same fields, and the orjson renderer and parser with DRF's.
+
+Each step is timed over `--objects` objects, the best of `--repeat` runs:
+serializing one object per serializer (detail and create responses) and a
+list with many=True (list pages), validating one request body per
+serializer, and rendering and parsing the list as JSON. Validating a
+transaction looks its item up, one query on a throwaway SQLite database.
+
+    python -m benchmarks.serializers --objects 10000
+"""
+import argparse
+import io
+import time
+from decimal import Decimal
+
+from benchmarks.utils import setup_django
+
+
+def best_of(repeat, function):
+    """
+    Returns the shortest time of repeat calls of function, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--objects', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    setup_django()
+    from rest_framework import parsers, renderers, serializers
+    from api import parsers as api_parsers, renderers as api_renderers
+    from api.models import Item, Transaction
+    from api.serializers import ItemPrimaryKeyField, ItemSerializer, TransactionSerializer
+
+    class ModelItemSerializer(serializers.ModelSerializer):
+        class Meta(ItemSerializer.Meta):
+            pass
+
+    class ModelTransactionSerializer(serializers.ModelSerializer):
+        item = ItemPrimaryKeyField(queryset=Item.objects.all())
+
+        class Meta(TransactionSerializer.Meta):
+            pass
+
+    items = Item.objects.bulk_create([Item(amount=Decimal('10.50')) for _ in range(args.objects)])
+    transactions = Transaction.objects.bulk_create([Transaction(item=item) for item in items])
+    item_bodies = [{'amount': '%d.50' % index} for index in range(args.objects)]
+    transaction_bodies = [
+        {'item': str(item.id), 'status': Transaction.PROCESSING, 'location': Transaction.ORIGIN}
+        for item in items
+    ]
+
+    def serialize(serializer_class, objects):
+        return lambda: [serializer_class(obj).data for obj in objects]
+
+    def serialize_list(serializer_class, objects):
+        return lambda: serializer_class(objects, many=True).data
+
+    def validate(serializer_class, bodies):
+        return lambda: [serializer_class(data=body).is_valid(raise_exception=True) for body in bodies]
+
+    data = ItemSerializer(items, many=True).data
+    content = renderers.JSONRenderer().render(data)
+    assert api_renderers.FastJSONRenderer().render(data) == content
+
+    def render(renderer_class):
+        return lambda: renderer_class().render(data)
+
+    def parse(parser_class):
+        return lambda: parser_class().parse(io.BytesIO(content))
+
+    steps = [
+        ('serialize items', serialize(ModelItemSerializer, items), serialize(ItemSerializer, items)),
+        ('serialize transactions', serialize(ModelTransactionSerializer, transactions),
+            serialize(TransactionSerializer, transactions)),
+        ('serialize item list', serialize_list(ModelItemSerializer, items),
+            serialize_list(ItemSerializer, items)),
+        ('serialize transaction list', serialize_list(ModelTransactionSerializer, transactions),
+            serialize_list(TransactionSerializer, transactions)),
+        ('validate items', validate(ModelItemSerializer, item_bodies), validate(ItemSerializer, item_bodies)),
+        ('validate transactions', validate(ModelTransactionSerializer, transaction_bodies),
+            validate(TransactionSerializer, transaction_bodies)),
+        ('render item list', render(renderers.JSONRenderer), render(api_renderers.FastJSONRenderer)),
+        ('parse item list', parse(parsers.JSONParser), parse(api_parsers.FastJSONParser)),
+    ]
+    print('%d objects, best of %d runs' % (args.objects, args.repeat))
+    print('%-28s %12s %12s %8s' % ('step', 'before ms', 'after ms', 'speedup'))
+    for name, before, after in steps:
+        before, after = best_of(args.repeat, before), best_of(args.repeat, after)
+        print('%-28s %12.1f %12.1f %7.1fx' % (name, before * 1000, after * 1000, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Measures transition write throughput on a SQLite file under parallel
+writers, with the development and the production database profiles
+(see DATABASE_PROFILE in routable/settings.py).
+
+Each of `--writers` processes, like the workers of a server, walks its own
+`--items` items through the move, error and fix endpoints, one request per
+transition, while `--readers` processes keep listing items. Failed requests, e.g. on "database is locked",
+are counted, not retried by the client. Every profile runs in its own
+process against a fresh database, so its settings are read as in a server.
+
+    python -m benchmarks.sqlite_writers --writers 8 --readers 2 --items 100
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.utils import percentile, setup_django
+
+
+PROFILES = ('development', 'production')
+
+
+def write(item_ids):
+    """
+    Moves, errors and fixes every item, returning the latencies of the
+    successful requests and the number of failed ones.
+    """
+    from django.db import connections
+    from django.test import Client
+    from django.urls import reverse
+
+    client = Client(raise_request_exception=False)
+    latencies, errors = [], 0
+    for item_id in item_ids:
+        for name in ('move_item', 'error_item', 'fix_item'):
+            start = time.perf_counter()
+            status = client.put(reverse(name, kwargs={'pk': item_id})).status_code
+            if status == 200:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+    connections.close_all()
+    return latencies, errors
+
+
+def read(done):
+    from django.db import connections
+    from django.test import Client
+
+    client = Client(raise_request_exception=False)
+    while not done.is_set():
+        client.get('/api/items')
+    connections.close_all()
+
+
+def run_profile(writers, readers, items_per_writer):
+    setup_django()
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+
+    from django.db import connections
+    from api.models import Item, Transaction
+
+    item_ids = []
+    for _ in range(writers):
+        items = Item.objects.bulk_create([Item(amount=1000) for _ in range(items_per_writer)])
+        Transaction.objects.bulk_create([Transaction(item=item) for item in items])
+        item_ids.append([item.id for item in items])
+    # connections must not be shared with the forked workers
+    connections.close_all()
+
+    context = multiprocessing.get_context('fork')
+    done = context.Event()
+    reader_processes = [context.Process(target=read, args=(done, )) for _ in range(readers)]
+    for process in reader_processes:
+        process.start()
+
+    start = time.perf_counter()
+    with context.Pool(writers) as pool:
+        results = pool.map(write, item_ids)
+    elapsed = time.perf_counter() - start
+    done.set()
+    for process in reader_processes:
+        process.join()
+
+    latencies = [latency for writer_latencies, _ in results for latency in writer_latencies]
+    return {
+        'writes': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'writes_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--items', type=int, default=100, help='items per writer')
+    parser.add_argument('--profile', choices=PROFILES, help='run a single profile, in this process')
+    args = parser.parse_args()
+
+    if args.profile:
+        print(json.dumps(run_profile(args.writers, args.readers, args.items)))
+        return
+
+    for profile in PROFILES:
+        env = dict(os.environ, DATABASE_PROFILE=profile, QUERY_LOG_LEVEL='ERROR')
+        output = subprocess.run(
+            [
+                sys.executable, '-m', 'benchmarks.sqlite_writers', '--profile', profile,
+                '--writers', str(args.writers), '--readers', str(args.readers),
+                '--items', str(args.items),
+            ],
+            env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout
+        result = json.loads(output)
+        print(
+            '%-12s %6d writes  %5d errors  %8.1f writes/s  p50 %7.2fms  p95 %7.2fms' % (
+                profile, result['writes'], result['errors'], result['writes_per_second'],
+                result['p50_ms'], result['p95_ms']
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Benchmarks run against a throwaway SQLite file so they need no services
+and never touch db.sqlite3.
+"""
+import os
+import tempfile
+
+import django
+
+
+def setup_django(db_name=None):
+    """
+    Configures Django against a fresh, migrated SQLite database and returns
+    its path. Must be called before importing models.
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'routable.settings')
+    # the per request query log would drown the results
+    os.environ.setdefault('QUERY_LOG_LEVEL', 'WARNING')
+    from django.conf import settings
+
+    if db_name is None:
+        handle, db_name = tempfile.mkstemp(prefix='routable-bench-', suffix='.sqlite3')
+        os.close(handle)
+    settings.DATABASES['default']['NAME'] = db_name
+    settings.ALLOWED_HOSTS = ['*']
+    settings.DEBUG = False
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+    return db_name
+
+
+def percentile(values, fraction):
+    """
+    Returns the value at fraction (0 - 1) of the sorted values, nearest rank.
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[index]
@@ -0,0 +1,103 @@
+"""
+Compares random (version 4) and time-ordered (version 7) UUID primary keys
+on the item table: insert throughput and the size of the primary key index.
+
+Every key kind fills its own copy of a freshly migrated database with
+`--rows` items, `--batch-size` rows per executemany and transaction, as
+the ORM's bulk inserts do. Random keys land on any page of the index, so
+once it outgrows the page cache most inserts read and split a page;
+time-ordered keys append to its right end.
+
+    python -m benchmarks.uuid_keys --rows 10000000
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from decimal import Decimal
+
+from benchmarks.utils import setup_django
+
+
+def insert(path, new_id, rows, batch_size):
+    """
+    Inserts rows items keyed by new_id() into the database at path.
+    Returns the rows per second of the whole run and of the batches of its
+    last tenth.
+    """
+    from django.utils import timezone
+
+    now = timezone.now().isoformat(' ')
+    amount = str(Decimal('10.50'))
+    connection = sqlite3.connect(path, isolation_level=None)
+    sql = (
+        'INSERT INTO api_item (id, amount, state, created_at, updated_at) '
+        "VALUES (?, ?, 'processing', ?, ?)"
+    )
+    tail_offset = rows - rows // 10
+    start = time.perf_counter()
+    tail_start, tail_rows = None, 0
+    for offset in range(0, rows, batch_size):
+        count = min(batch_size, rows - offset)
+        # from the batch holding the first row of the last tenth
+        if offset + count > tail_offset:
+            if tail_start is None:
+                tail_start = time.perf_counter()
+            tail_rows += count
+        connection.execute('BEGIN')
+        connection.executemany(sql, [(new_id().hex, amount, now, now) for _ in range(count)])
+        connection.execute('COMMIT')
+    end = time.perf_counter()
+    connection.close()
+    return rows / (end - start), tail_rows / (end - (tail_start or start))
+
+
+def index_size(path):
+    """
+    Returns the pages and the bytes of the item table's primary key index.
+    """
+    connection = sqlite3.connect(path)
+    name = connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'api_item' "
+        "AND name LIKE 'sqlite_autoindex_%'"
+    ).fetchone()[0]
+    page_size = connection.execute('PRAGMA page_size').fetchone()[0]
+    try:
+        pages = connection.execute('SELECT count(*) FROM dbstat WHERE name = ?', (name, )).fetchone()[0]
+    except sqlite3.OperationalError:
+        # without the dbstat table, count the pages of the whole file
+        pages = connection.execute('PRAGMA page_count').fetchone()[0]
+    connection.close()
+    return pages, pages * page_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    template = setup_django()
+    from api import ids
+
+    results = []
+    for name, new_id in (('uuid4', uuid.uuid4), ('uuid7', ids.uuid7)):
+        path = template.replace('.sqlite3', '-%s.sqlite3' % name)
+        shutil.copyfile(template, path)
+        try:
+            rate, tail_rate = insert(path, new_id, args.rows, args.batch_size)
+            pages, size = index_size(path)
+        finally:
+            os.remove(path)
+        results.append((name, rate, tail_rate, pages, size))
+    os.remove(template)
+
+    print('%-6s %12s %16s %12s %10s' % ('key', 'rows/s', 'last 10% rows/s', 'index pages', 'index MB'))
+    for name, rate, tail_rate, pages, size in results:
+        print('%-6s %12.0f %16.0f %12d %10.1f' % (name, rate, tail_rate, pages, size / 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,24 @@ ASGI config for routable project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Requests are served by routable.handlers.ConcurrentASGIHandler, which runs
+views on a pool of ASGI_THREADS threads instead of Django's single thread
+sensitive executor. Run it with e.g.
+
+    uvicorn routable.asgi:application --workers 4
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 """
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'routable.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+from routable.handlers import ConcurrentASGIHandler  # noqa: E402
+
+application = ConcurrentASGIHandler()
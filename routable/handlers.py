@@ -0,0 +1,92 @@
+"""
+ASGI handler serving requests concurrently from a bounded thread pool.
+
+Django 3.0 cannot run async views: under ASGI every request goes through
+sync_to_async(get_response), which with asgiref >= 3.3 is thread sensitive
+and runs all requests one at a time on a single thread. This handler runs
+get_response on a bounded pool instead, so the event loop can keep
+accepting and reading requests while up to ASGI_THREADS of them run
+their ORM work in parallel.
+
+Streaming responses, such as the exports, run queries while they are
+iterated, which Django does on the event loop thread. They are sent from
+a pool thread too, the whole response from the same one, since the
+queries of a streamed queryset stay on the connection that started them.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.base import BaseHandler
+from django.db import close_old_connections
+
+
+class ConcurrentASGIHandler(ASGIHandler):
+
+    def __init__(self, max_workers=None):
+        super().__init__()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or settings.ASGI_THREADS,
+            thread_name_prefix='asgi-worker'
+        )
+
+    async def get_response(self, request):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(self.get_response_in_worker, request)
+        )
+
+    def get_response_in_worker(self, request):
+        # request_started and request_finished are sent from the event loop
+        # thread, so the worker manages its own thread local connection.
+        close_old_connections()
+        try:
+            return BaseHandler.get_response(self, request)
+        finally:
+            close_old_connections()
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super().send_response(response, send)
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': self.get_response_headers(response),
+        })
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, functools.partial(self.send_body_in_worker, response, send, loop)
+        )
+
+    def get_response_headers(self, response):
+        """
+        Returns the headers and cookies of response, encoded as ASGIHandler
+        sends them.
+        """
+        headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        return headers
+
+    def send_body_in_worker(self, response, send, loop):
+        def send_on_loop(message):
+            # send belongs to the server's event loop
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        close_old_connections()
+        try:
+            for part in response:
+                for chunk, _ in self.chunk_bytes(part):
+                    send_on_loop({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            send_on_loop({'type': 'http.response.body'})
+        finally:
+            response.close()
+            close_old_connections()
@@ -0,0 +1,194 @@
+"""
+Per request SQL instrumentation and metrics.
+
+QueryBudgetMiddleware counts the queries a request runs on every database
+connection, their total time and the slowest statement, and logs them to
+the `routable.queries` logger. Views declare how many queries they may run:
+API views with a `query_budget` attribute, plus `query_budget_per_shard`
+queries for every database of DATABASE_SHARDS when they read or write all
+of them, admin pages with a `query_budgets` dict on their ModelAdmin keyed
+by page (`changelist`, `change`, `add`, ...). Requests going over their budget are logged as
+warnings, and fail when QUERY_BUDGET_STRICT is set, as it is in tests.
+
+Queries run while a streaming response is being sent happen after the
+middleware returns and are not counted.
+
+MetricsMiddleware records the latency, 4xx rejections and SQL time of every
+request routed to a view, see api/metrics.py.
+
+ReplicaMiddleware lets requests with a safe method read from a replica, see
+routable/routers.py.
+"""
+import contextlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.contrib import admin
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+
+from api import metrics
+from routable import routers
+
+
+logger = logging.getLogger('routable.queries')
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats:
+    """
+    Execute wrapper recording the queries run through it, from any thread.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.slowest_duration = 0.0
+        self.slowest_sql = None
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.count += 1
+                self.duration += elapsed
+                if elapsed >= self.slowest_duration:
+                    self.slowest_duration = elapsed
+                    self.slowest_sql = sql
+
+    @contextlib.contextmanager
+    def record(self):
+        with contextlib.ExitStack() as stack:
+            # test mirrors may share their primary's connection
+            for connection in {id(connection): connection for connection in connections.all()}.values():
+                stack.enter_context(connection.execute_wrapper(self))
+            yield self
+
+
+def exempt_from_query_budget(request):
+    """
+    Lifts the budget of a request whose query count depends on timing rather
+    than on data, such as one polling for another request to finish.
+    """
+    getattr(request, '_request', request).query_budget = None
+
+
+def get_admin_budget(url_name):
+    """
+    Returns the budget a ModelAdmin declares for one of its pages, the url
+    name of which is <app_label>_<model_name>_<page>.
+    """
+    for model, model_admin in admin.site._registry.items():
+        prefix = '%s_%s_' % (model._meta.app_label, model._meta.model_name)
+        if url_name.startswith(prefix):
+            return getattr(model_admin, 'query_budgets', {}).get(url_name[len(prefix):])
+    return None
+
+
+def get_view_class(view_func):
+    return getattr(view_func, 'cls', None) or getattr(view_func, 'view_class', None)
+
+
+def get_query_budget(request, view_func):
+    """
+    Returns the number of queries the view may run, or None when it does
+    not declare a budget.
+    """
+    view_class = get_view_class(view_func)
+    if view_class is not None and hasattr(view_class, 'query_budget'):
+        per_shard = getattr(view_class, 'query_budget_per_shard', None)
+        if per_shard is None:
+            return view_class.query_budget
+        return (view_class.query_budget or 0) + per_shard * len(settings.DATABASE_SHARDS)
+
+    match = request.resolver_match
+    if match is not None and match.namespace == admin.site.name and match.url_name:
+        return get_admin_budget(match.url_name)
+    return None
+
+
+class QueryBudgetMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.query_budget = None
+        with QueryStats().record() as stats:
+            response = self.get_response(request)
+        request.query_stats = stats
+
+        budget = request.query_budget
+        over_budget = budget is not None and stats.count > budget
+        logger.log(
+            logging.WARNING if over_budget else logging.INFO,
+            '%s %s: %d queries (budget %s) in %.1fms, slowest %.1fms: %s',
+            request.method,
+            request.path,
+            stats.count,
+            budget,
+            stats.duration * 1000,
+            stats.slowest_duration * 1000,
+            stats.slowest_sql,
+        )
+
+        if settings.QUERY_BUDGET_HEADERS:
+            response['X-Query-Count'] = stats.count
+            response['X-Query-Time-Ms'] = '%.1f' % (stats.duration * 1000)
+            response['X-Slowest-Query-Ms'] = '%.1f' % (stats.slowest_duration * 1000)
+            if budget is not None:
+                response['X-Query-Budget'] = budget
+
+        if over_budget and settings.QUERY_BUDGET_STRICT:
+            raise QueryBudgetExceeded(
+                '%s %s ran %d queries, over its budget of %d' % (
+                    request.method, request.path, stats.count, budget
+                )
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = get_query_budget(request, view_func)
+
+
+class MetricsMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            metrics.record_response(
+                match.view_name, request, response, duration, getattr(request, 'query_stats', None)
+            )
+        return response
+
+
+class ReplicaMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method not in SAFE_METHODS:
+            return self.get_response(request)
+        with routers.replica_reads():
+            return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not getattr(get_view_class(view_func), 'use_replica', True):
+            routers.pin_to_primary()
@@ -0,0 +1,81 @@
+"""
+Routes reads of the api models to read replicas.
+
+Replicas are the databases of DATABASE_REPLICAS, copies of the default
+database, the first item shard (see api/shards.py). Only requests using a
+safe method read from them, see ReplicaMiddleware: every request picks one
+replica, so its reads see a single replica's state, and sticks to the
+primary for the rest of the request after it writes, to read its own
+writes. Everything else, writes, other apps' models (sessions, users),
+management commands and views declaring `use_replica = False`, uses the
+primary.
+"""
+import contextlib
+import random
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+_state = threading.local()
+
+
+def get_replica():
+    """
+    Returns the alias of a random replica, or the primary's without replicas.
+    """
+    if not settings.DATABASE_REPLICAS:
+        return DEFAULT_DB_ALIAS
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+@contextlib.contextmanager
+def replica_reads():
+    """
+    Sends the reads of the api models to one replica until the first write.
+    """
+    previous = getattr(_state, 'replica', None), getattr(_state, 'wrote', False)
+    _state.replica, _state.wrote = get_replica(), False
+    try:
+        yield
+    finally:
+        _state.replica, _state.wrote = previous
+
+
+def pin_to_primary():
+    """
+    Sends the remaining reads of the current replica_reads block to the primary.
+    """
+    _state.wrote = True
+
+
+def get_read_alias(alias):
+    """
+    Returns the database to read the rows of database alias from: the
+    current request's replica for the primary, alias itself otherwise.
+    """
+    replica = getattr(_state, 'replica', None)
+    if alias == DEFAULT_DB_ALIAS and replica and not _state.wrote:
+        return replica
+    return alias
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == 'api':
+            return get_read_alias(DEFAULT_DB_ALIAS)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # replicas get their schema from the primary
+        return db == DEFAULT_DB_ALIAS
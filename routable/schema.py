@@ -0,0 +1,159 @@
+"""
+OpenAPI schema of the API, built ahead by `manage.py generate_schema` and
+served from memory.
+
+Generating the schema introspects every view and serializer, too much work
+for every hit of the health checks and gateways polling `/`. The build
+writes the JSON and YAML documents, and the settings of the Swagger UI
+page, to SCHEMA_DIR, which is regenerated on deploy. Each process reads
+them once, when the url patterns load, and serves the documents with an
+ETag so clients holding the current version get a 304. drf_yasg's views,
+renderers and codecs are only imported to build the artifacts, or to
+generate the schema on every request, as before, when there are none.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+from django.http import Http404, HttpResponse
+from django.template.response import TemplateResponse
+from django.urls import path, re_path
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views import View
+
+
+# format: (file name, content type), the formats of drf_yasg's schema view
+DOCUMENTS = {
+    '.json': ('openapi.json', 'application/json; charset=utf-8'),
+    '.yaml': ('openapi.yaml', 'application/yaml; charset=utf-8'),
+    # what the Swagger UI page fetches, at ?format=openapi
+    'openapi': ('openapi.json', 'application/openapi+json; charset=utf-8'),
+}
+UI_CONTEXT_FILE = 'swagger-ui.json'
+UI_TEMPLATE = 'drf-yasg/swagger-ui.html'
+FILE_NAMES = sorted({name for name, _ in DOCUMENTS.values()} | {UI_CONTEXT_FILE})
+
+
+def get_info():
+    from drf_yasg import openapi
+
+    return openapi.Info(
+        title="Routable API",
+        default_version='v1',
+        contact=openapi.Contact(email="contact@snippets.local"),
+        license=openapi.License(name="BSD License"),
+    )
+
+
+def build():
+    """
+    Returns {file name: content} of the artifacts, generated from the url
+    patterns.
+    """
+    from drf_yasg.codecs import OpenAPICodecJson, OpenAPICodecYaml
+    from drf_yasg.generators import OpenAPISchemaGenerator
+    from drf_yasg.renderers import SwaggerUIRenderer
+
+    # without a request the schema has no host, the UI uses the page's
+    schema = OpenAPISchemaGenerator(get_info()).get_schema(request=None, public=True)
+    ui_context = {}
+    SwaggerUIRenderer().set_context(ui_context, schema)
+    return {
+        'openapi.json': OpenAPICodecJson(validators=[]).encode(schema),
+        'openapi.yaml': OpenAPICodecYaml(validators=[]).encode(schema),
+        UI_CONTEXT_FILE: json.dumps(ui_context, sort_keys=True).encode(),
+    }
+
+
+def write(directory, artifacts):
+    """
+    Writes the artifacts to directory, each file replaced at once so a
+    process starting meanwhile reads either version.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name, content in artifacts.items():
+        handle, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + name)
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(content)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, os.path.join(directory, name))
+
+
+def read(directory):
+    """
+    Returns {file name: content} of the artifacts in directory, or None
+    when some are missing.
+    """
+    artifacts = {}
+    for name in FILE_NAMES:
+        try:
+            with open(os.path.join(directory, name), 'rb') as artifact:
+                artifacts[name] = artifact.read()
+        except FileNotFoundError:
+            return None
+    return artifacts
+
+
+class Document:
+
+    def __init__(self, content, content_type):
+        self.content = content
+        self.content_type = content_type
+        self.etag = '"%s"' % hashlib.sha256(content).hexdigest()
+
+    def serve(self, request):
+        response = get_conditional_response(request, etag=self.etag)
+        if response is None:
+            response = HttpResponse(self.content, content_type=self.content_type)
+        response['ETag'] = self.etag
+        # a deploy may change the schema, clients revalidate
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+class SchemaView(View):
+    """
+    Serves the schema documents and the Swagger UI page from the artifacts.
+    """
+    query_budget = 0
+    documents = None
+    ui_context = None
+
+    def get(self, request, format=None):
+        format = format or request.GET.get('format')
+        if format is None:
+            # the page carries the CSRF token and user of the request
+            return TemplateResponse(request, UI_TEMPLATE, dict(self.ui_context))
+        if format not in self.documents:
+            raise Http404('Unknown schema format %r' % format)
+        return self.documents[format].serve(request)
+
+
+def get_urlpatterns(directory):
+    """
+    Returns the url patterns of the Swagger UI at `/` and of the schema at
+    `/swagger.json` and `/swagger.yaml`, served from the artifacts in
+    directory, or generated on every request when there are none.
+    """
+    artifacts = read(directory)
+    if artifacts is not None:
+        view = SchemaView.as_view(
+            documents={
+                format: Document(artifacts[name], content_type)
+                for format, (name, content_type) in DOCUMENTS.items()
+            },
+            ui_context=json.loads(artifacts[UI_CONTEXT_FILE].decode()),
+        )
+        schema_view, ui_view = view, view
+    else:
+        from drf_yasg.views import get_schema_view
+        from rest_framework import permissions
+
+        live_view = get_schema_view(get_info(), public=True, permission_classes=(permissions.AllowAny,))
+        schema_view = live_view.without_ui(cache_timeout=0)
+        ui_view = live_view.with_ui('swagger', cache_timeout=0)
+    return [
+        re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view, name='schema'),
+        path('', ui_view, name='schema_ui'),
+    ]
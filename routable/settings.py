@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -43,10 +44,13 @@ INSTALLED_APPS = [
     'django_object_actions',
     'drf_yasg',
 
-    'api',
+    'api.apps.ApiConfig',
 ]
 
 MIDDLEWARE = [
+    'routable.middleware.MetricsMiddleware',
+    'routable.middleware.QueryBudgetMiddleware',
+    'routable.middleware.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,6 +80,11 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'routable.wsgi.application'
 
+TEST_RUNNER = 'routable.test_runner.TestRunner'
+
+# Size of the thread pool running views when served through routable/asgi.py.
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 8))
+
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
@@ -87,6 +96,83 @@ DATABASES = {
     }
 }
 
+# DATABASE_PROFILE=production keeps connections open across requests and
+# runs SQLite in WAL mode, see api/sqlite.py. Transition views retry up to
+# SQLITE_BUSY_RETRIES times when the database is locked.
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', 'development')
+SQLITE_PRAGMAS = {}
+SQLITE_BUSY_RETRIES = 0
+# Seconds before the first retry, doubled on every following one.
+SQLITE_BUSY_BACKOFF = 0.01
+
+if DATABASE_PROFILE == 'production':
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        # milliseconds a write waits for the lock before failing
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        # negative sizes are in KiB
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+    }
+    SQLITE_BUSY_RETRIES = 5
+
+# Shards holding the items, their transactions and events, picked by hashing
+# the item id, see api/shards.py. The first shard is the default database,
+# more are added as SQLite files with DATABASE_SHARD_FILES=shard1.sqlite3,...
+# and migrated with `manage.py migrate --database shard1`. Adding a shard
+# changes the shard of most item ids, existing items are not moved.
+DATABASE_SHARDS = ['default']
+for index, name in enumerate(
+    [name for name in os.environ.get('DATABASE_SHARD_FILES', '').split(',') if name], 1
+):
+    DATABASES['shard%d' % index] = dict(DATABASES['default'], NAME=name)
+    DATABASE_SHARDS.append('shard%d' % index)
+# Threads reading the shards of a listing in parallel, one per shard when 0.
+SHARD_FAN_OUT_WORKERS = 0
+
+# Read replicas of the default database, the aliases of DATABASES that GET
+# requests read the api models from, see routable/routers.py. Locally, SQLite files kept in sync
+# with `manage.py sync_replicas` stand in for them, set with
+# DATABASE_REPLICA_FILES=replica1.sqlite3,... ; without it the primary serves the reads.
+DATABASE_REPLICAS = []
+for index, name in enumerate(
+    [name for name in os.environ.get('DATABASE_REPLICA_FILES', '').split(',') if name], 1
+):
+    DATABASES['replica%d' % index] = dict(DATABASES['default'], NAME=name, TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append('replica%d' % index)
+
+DATABASE_ROUTERS = ['api.shards.ShardRouter', 'routable.routers.ReplicaRouter']
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+# The items cache backs GET /api/items/<uuid>. It must be shared by every
+# worker process, so that a transition in one invalidates it for all: the
+# default file backend is shared by the processes of one host, point
+# ITEM_CACHE_LOCATION elsewhere or use memcached for several hosts.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'items': {
+        'BACKEND': os.environ.get(
+            'ITEM_CACHE_BACKEND', 'api.cache_backends.FileBasedCache'
+        ),
+        'LOCATION': os.environ.get(
+            'ITEM_CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'routable-item-cache')
+        ),
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+            'CULL_EVERY': 1000,
+        },
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -126,3 +212,102 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# JSON bodies are parsed and rendered with orjson when it is installed
+# (`pip install orjson`), with the json module otherwise.
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
+
+# Number of rows per INSERT statement on the bulk item create endpoint.
+ITEM_BULK_CREATE_BATCH_SIZE = 500
+
+# Number of ids per UPDATE ... WHERE id IN (...) on the batch transition endpoints.
+ITEM_BATCH_UPDATE_SIZE = 500
+
+# Number of items fetched per query, with their transactions, when exporting.
+EXPORT_CHUNK_SIZE = 2000
+
+# Number of items written per database transaction by `manage.py import_ledger`.
+LEDGER_IMPORT_BATCH_SIZE = 10000
+
+# Resolved items are moved to the archive tables by `manage.py archive` this
+# many days after they were resolved, this many items per database transaction.
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH_SIZE = 1000
+
+# Number of rows each summary counter of `GET /api/stats` is split into, so
+# concurrent writes rarely update the same row.
+STATS_COUNTER_SLOTS = 8
+
+# List pages are ordered on the primary key alone instead of (created_at, id).
+# Only for databases whose rows all have time-ordered ids (see api/ids.py):
+# rows with older UUID4 keys would be listed out of order.
+KEYSET_PAGINATION_ON_ID = False
+
+# OpenAPI schema artifacts written by `manage.py generate_schema` and served
+# from memory. Without them the schema is generated on every request.
+SCHEMA_DIR = os.environ.get('SCHEMA_DIR', os.path.join(BASE_DIR, 'schema'))
+
+# Admin changelists show the estimated table size instead of a COUNT(*) above this many rows.
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+# Number of most recent transactions shown inline on the item change page.
+ADMIN_RECENT_TRANSACTIONS = 20
+
+# Responses of requests with an Idempotency-Key header are replayed for this many seconds.
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+# How long, in seconds, a request waits for a concurrent request with the same key.
+IDEMPOTENCY_WAIT_TIMEOUT = 10
+IDEMPOTENCY_POLL_INTERVAL = 0.05
+# Seconds a request holds its key while in progress. A retry after that takes the key over, its
+# owner may have been killed before releasing it.
+IDEMPOTENCY_LEASE = 60
+
+# Delivery of the event outbox by `manage.py dispatch_events`.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_TIMEOUT = 5
+WEBHOOK_WORKERS = 8
+WEBHOOK_BATCH_SIZE = 100
+WEBHOOK_POLL_INTERVAL = 1
+# Seconds a dispatcher owns the events it claimed before others may retry them.
+WEBHOOK_LEASE = 300
+# Retries back off exponentially from WEBHOOK_BACKOFF_BASE up to WEBHOOK_BACKOFF_MAX seconds.
+WEBHOOK_BACKOFF_BASE = 2
+WEBHOOK_BACKOFF_MAX = 3600
+
+
+# Query budgets, see routable/middleware.py. Responses carry X-Query-* headers
+# when QUERY_BUDGET_HEADERS is set, and requests over their view's budget fail
+# when QUERY_BUDGET_STRICT is set, which the test runner does.
+QUERY_BUDGET_HEADERS = DEBUG
+QUERY_BUDGET_STRICT = False
+
+# Directory shared by the worker processes of a host, each writing its metrics
+# there for /metrics to sum. Leave unset when serving from a single process.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+# Seconds between two writes of a process's metrics to METRICS_DIR.
+METRICS_FLUSH_INTERVAL = 1
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'routable.queries': {
+            'handlers': ['console'],
+            'level': os.environ.get('QUERY_LOG_LEVEL', 'INFO' if DEBUG else 'WARNING'),
+        },
+    },
+}
@@ -0,0 +1,45 @@
+import logging
+import os
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.runner import DiscoverRunner
+
+
+TEST_SHARD = 'shard1'
+TEST_REPLICA = 'replica1'
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Runs the tests with query budgets enforced, so a request going over the
+    budget its view declares fails the test that made it. The per request
+    query log is silenced unless QUERY_LOG_LEVEL is set.
+
+    Replicas are test mirrors of the primary, TEST_REPLICA when none are
+    configured. They share its connection, so reads routed to them see the
+    rows a TestCase wrote in its transaction.
+
+    Tests run on a single shard, the default database. A second one,
+    TEST_SHARD, is created for the tests of sharding, which add it to
+    DATABASE_SHARDS.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        settings.QUERY_BUDGET_STRICT = True
+        settings.DATABASE_SHARDS = [DEFAULT_DB_ALIAS]
+        settings.DATABASES.setdefault(TEST_SHARD, dict(settings.DATABASES[DEFAULT_DB_ALIAS]))
+        if not settings.DATABASE_REPLICAS:
+            settings.DATABASES[TEST_REPLICA] = dict(
+                settings.DATABASES[DEFAULT_DB_ALIAS], TEST={'MIRROR': DEFAULT_DB_ALIAS}
+            )
+            settings.DATABASE_REPLICAS = [TEST_REPLICA]
+        if 'QUERY_LOG_LEVEL' not in os.environ:
+            logging.getLogger('routable.queries').setLevel(logging.WARNING)
+
+    def setup_databases(self, **kwargs):
+        old_config = super().setup_databases(**kwargs)
+        for alias in settings.DATABASE_REPLICAS:
+            connections[alias] = connections[DEFAULT_DB_ALIAS]
+        return old_config